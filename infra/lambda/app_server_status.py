@@ -1,17 +1,30 @@
 import json
-from urllib import request
-from urllib.error import URLError
-import os
+from logic_backend_pool import get_backend_pool
+from logic_admission import create_admission_controller
+from logic_metrics import instrument_handler
 
 
+@instrument_handler
 def lambda_handler(event, context):
-    base_url = os.environ["SD_SERVER_URL"]
-    url = base_url + "/sdapi/v1/options"  #  arbitrary GET endpoint for healthcheck
-    try:
-        with request.urlopen(request.Request(url), timeout=2) as res:
-            status = "AVAILABLE"
-    except URLError as error:
-        status = "UNAVAILABLE"
+    # cached by the pool's circuit breaker, so polling this does not probe
+    # the server on every call
+    backend_pool = get_backend_pool()
+    status = "AVAILABLE" if backend_pool.is_available() else "UNAVAILABLE"
+
+    params = event.get("queryStringParameters") or {}
+    if params.get("detail"):
+        # requests in flight and waiting per plan, the current queue wait and
+        # the circuit breaker
+        return {
+            "statusCode": 200,
+            "body": json.dumps(
+                {
+                    "status": status,
+                    "admission": create_admission_controller().snapshot(),
+                    "circuit": backend_pool.breaker.snapshot(),
+                }
+            ),
+        }
 
     return {
         "statusCode": 200,
@@ -1,17 +1,18 @@
 import json
 from logic_user_usage import UserUsage, validate_admin_user
 from logic_server_controller import ServerController, notify_line
+from logic_metrics import instrument_handler
 
 
+@instrument_handler
 def lambda_handler(event, context):
     command = event["body"]
     server_controller = ServerController()
-    instance = server_controller.target_instance
 
     success = False
     if command == "start":
         if server_controller.get_target_instance_status() == "STOPPED":
-            instance.start()
+            server_controller.start()
             print("instance started")
             notify_line("instance start")
             user_usage = UserUsage(event)
@@ -27,7 +28,7 @@ def lambda_handler(event, context):
             result = "only admin user can stop service server"
 
         if server_controller.get_target_instance_status() == "RUNNING":
-            instance.stop()
+            server_controller.stop()
             notify_line("instance stop")
             result = "successfully stop"
             success = True
@@ -1,8 +1,10 @@
 import json
 from logic_server_controller import ServerController
 from logic_user_usage import validate_admin_user
+from logic_metrics import instrument_handler
 
 
+@instrument_handler
 def lambda_handler(event, context):
     server_controller = ServerController()
     status = server_controller.get_target_instance_status()
@@ -1,26 +1,35 @@
 import json
-from urllib import request
 import base64
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image
-from logic_user_usage import UserUsage
+from typing import Optional
+from logic_user_usage import InsufficientCreditError, UserUsage
+from logic_usage_ledger import STATUS_FAILED, UsageLedger
+from logic_result_cache import cache_key, create_result_cache
+from logic_image_store import ImageNotFoundError, create_image_store
+from logic_multipart import MultipartError, is_multipart, parse_multipart
+from logic_multipart import require_part
+from logic_backend_pool import get_backend_pool
+from logic_admission import AdmissionRejectedError, create_admission_controller
+from logic_admission import rejected_response
+from logic_circuit_breaker import ServerUnavailableError, unavailable_response
+from logic_sd_client import deadline_from_context
+from logic_metrics import count, instrument_handler, span, timed
 
+DETECT_TIMEOUT = float(os.environ.get("DETECT_TIMEOUT", "20"))  # in sec
+TAGGING_TIMEOUT = float(os.environ.get("TAGGING_TIMEOUT", "20"))  # in sec
 
-def lambda_handler(event, context):
-    user_usage = UserUsage(event)
-    usage = user_usage.get_user_usage()
+# returned when only the tagger fails, so the client can still use the edge
+EMPTY_TAGGING_RESULT = {"caption": {"tag": {}, "rating": {}}}
 
-    remaining_credit = int(usage["credit"])
-    credit_consumption = int(os.environ["CREDIT_CONSUMPTION"])
-    if remaining_credit < credit_consumption:
-        return {
-            "statusCode": 400,
-            "body": json.dumps("no sufficient credits remain"),
-        }
+# kept across warm invocations
+result_cache = create_result_cache()
+image_store = create_image_store()
 
-    base_url = os.environ["SD_SERVER_URL"]
-    img_str = event["body"]
+
+def detect_lineart(img_str: str, deadline: Optional[float] = None) -> str:
     data = {
         "controlnet_module": "lineart",
         "controlnet_input_images": [img_str],
@@ -28,16 +37,22 @@ def lambda_handler(event, context):
         "controlnet_threshold_a": 64,
         "controlnet_threshold_b": 64,
     }
-    url = base_url + "/controlnet/detect-only"
-    headers = {"Content-Type": "application/json"}
+    # detection has no side effects, so it is safe to retry
+    body = get_backend_pool().post(
+        "/controlnet/detect-only",
+        data,
+        timeout=DETECT_TIMEOUT,
+        retries=2,
+        deadline=deadline,
+    )
+    return to_grayscale_png(body["images"][0])
+
 
-    with request.urlopen(
-        request.Request(url, json.dumps(data).encode(), headers)
-    ) as res:
-        body = res.read()
-    body = json.loads(body)
+@timed("lineart_png")
+def to_grayscale_png(img_str: str) -> str:
+    from PIL import Image  # only needed on a cache miss
 
-    detected_image = Image.open(BytesIO(base64.b64decode(body["images"][0])))
+    detected_image = Image.open(BytesIO(base64.b64decode(img_str)))
     detected_image = detected_image.convert("L")
     # gave-up making transparent
     # detected_image_np = np.array(detected_image)
@@ -49,9 +64,10 @@ def lambda_handler(event, context):
 
     buffered = BytesIO()
     detected_image.save(buffered, format="PNG")
-    result_img_str = base64.b64encode(buffered.getvalue()).decode()
+    return base64.b64encode(buffered.getvalue()).decode()
 
-    # tag
+
+def interrogate_tags(img_str: str, deadline: Optional[float] = None) -> dict:
     data = {
         "image": img_str,
         "model": "wd-v1-4-moat-tagger.v2",
@@ -59,24 +75,188 @@ def lambda_handler(event, context):
         "queue": "",
         "name_in_queue": "",
     }
-    url = base_url + "/tagger/v1/interrogate"
-    with request.urlopen(
-        request.Request(url, json.dumps(data).encode(), headers)
-    ) as res:
-        body = res.read()
-    tagging_result = json.loads(body)
+    return get_backend_pool().post(
+        "/tagger/v1/interrogate",
+        data,
+        timeout=TAGGING_TIMEOUT,
+        retries=2,
+        deadline=deadline,
+    )
+
+
+@timed("decode")
+def load_image(event: dict) -> str:
+    if is_multipart(event):
+        _, files = parse_multipart(event)
+        return base64.b64encode(require_part(files, "image")).decode()
+    # A raw image body arrives base64-encoded by API Gateway, which is already
+    # what the SD server takes. JSON clients send the data URL as plain text,
+    # or "handle:<sha256>" of an image uploaded before.
+    return image_store.resolve({"image": event["body"]}, ["image"])["image"]
+
+
+def store_images(img_str: str, result_img_str: str) -> dict:
+    # both are sent again with generate, as handles they are uploaded once
+    return {
+        "imageHandle": image_store.put(img_str),
+        "edgeHandle": image_store.put(result_img_str),
+    }
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    try:
+        return func(*args), None, time.perf_counter() - start
+    except Exception as error:
+        return None, error, time.perf_counter() - start
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    user_usage = UserUsage(event)
+    user_usage.record_arrival()
+    usage_ledger = UsageLedger()
+    credit_consumption = int(os.environ["CREDIT_CONSUMPTION"])
+    no_credit_response = {
+        "statusCode": 400,
+        "body": json.dumps("no sufficient credits remain"),
+    }
+
+    try:
+        img_str = load_image(event)
+    except ImageNotFoundError as error:
+        return {
+            "statusCode": 404,
+            "body": json.dumps(
+                {"message": "image not found", "missingHandles": error.handles}
+            ),
+        }
+    except MultipartError as error:
+        return {"statusCode": 400, "body": json.dumps(f"invalid body: {error}")}
+
+    key = cache_key("edge", {"image": img_str})
+    with span("cache.get"):
+        cached = result_cache.get(key)
+    print(f"result cache {result_cache.stats()}")
+    count("cache.hit" if cached is not None else "cache.miss")
+    if cached is not None:
+        # served without the SD server, so no credit is consumed
+        user_info = user_usage.get_user_usage()
+        remaining_credit = int(user_info["credit"])
+        if remaining_credit < credit_consumption:
+            return no_credit_response
+        usage_ledger.record(
+            user_usage.username, "edge", user_info.get("plan"), cached=True
+        )
+        return {
+            "statusCode": 200,
+            "body": json.dumps(
+                {
+                    **cached,
+                    **store_images(img_str, cached["image"]),
+                    "remainingCredit": remaining_credit,
+                    "cached": True,
+                }
+            ),
+        }
+
+    try:
+        # fails fast while the server is known to be stopped or booting
+        get_backend_pool().check_available()
+    except ServerUnavailableError as error:
+        return unavailable_response(error)
+
+    try:
+        remaining_credit = user_usage.reserve_credit(credit_consumption)
+    except InsufficientCreditError:
+        return no_credit_response
+
+    start = None
+    try:
+        admission = create_admission_controller()
+        with admission.admitted(
+            user_usage.username, user_usage.plan, "edge"
+        ) as queue_wait:
+            # detection and tagging are independent, so wall time is max() of the
+            # two, and both give up in time to refund the credit if the server hangs
+            start = time.perf_counter()
+            deadline = deadline_from_context(context)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                detect_future = executor.submit(
+                    _timed, detect_lineart, img_str, deadline
+                )
+                tagging_future = executor.submit(
+                    _timed, interrogate_tags, img_str, deadline
+                )
+                result_img_str, detect_error, detect_time = detect_future.result()
+                tagging_result, tagging_error, tagging_time = tagging_future.result()
+    except AdmissionRejectedError as error:
+        remaining_credit = user_usage.refund_credit(credit_consumption)
+        return rejected_response(error, remainingCredit=remaining_credit)
+    except Exception:
+        # the admission store or the pool failed, not the SD calls
+        user_usage.refund_credit(credit_consumption)
+        usage_ledger.record(
+            user_usage.username,
+            "edge",
+            user_usage.plan,
+            gpu_seconds=time.perf_counter() - start if start else 0.0,
+            status=STATUS_FAILED,
+        )
+        raise
+    timing = {
+        "queueWait": queue_wait,
+        "detect": detect_time,
+        "tagging": tagging_time,
+        "total": time.perf_counter() - start,
+    }
+    print(f"timing {json.dumps(timing)}")
+    print(f"sd backends {json.dumps(get_backend_pool().stats())}")
+
+    if detect_error is not None:
+        print(f"lineart detection failed: {detect_error}")
+        remaining_credit = user_usage.refund_credit(credit_consumption)
+        usage_ledger.record(
+            user_usage.username,
+            "edge",
+            user_usage.plan,
+            gpu_seconds=timing["total"],
+            status=STATUS_FAILED,
+        )
+        if isinstance(detect_error, ServerUnavailableError):
+            return unavailable_response(detect_error, remainingCredit=remaining_credit)
+        return {
+            "statusCode": 502,
+            "body": json.dumps("lineart detection failed"),
+        }
 
-    if credit_consumption != 0:
-        remaining_credit -= credit_consumption
-        user_usage.update_user_credit(remaining_credit)
+    errors = {}
+    if tagging_error is not None:
+        print(f"tagging failed: {tagging_error}")
+        errors["tagging"] = str(tagging_error)
+        tagging_result = EMPTY_TAGGING_RESULT
+    else:
+        result_cache.put(
+            key, {"image": result_img_str, "taggingResult": tagging_result}
+        )
+    usage_ledger.record(
+        user_usage.username,
+        "edge",
+        user_usage.plan,
+        credit=credit_consumption,
+        gpu_seconds=timing["total"],
+    )
 
     return {
         "statusCode": 200,
         "body": json.dumps(
             {
                 "image": result_img_str,
+                **store_images(img_str, result_img_str),
                 "taggingResult": tagging_result,
                 "remainingCredit": remaining_credit,
+                "timing": timing,
+                **({"errors": errors} if errors else {}),
             }
         ),
     }
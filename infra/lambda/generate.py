@@ -1,32 +1,60 @@
 # To use OpenCV in Lambda, this code is written in Python3.8
+# logic_image (OpenCV/NumPy) is imported where it is used, since many requests
+# never touch pixels here and the import dominates the cold start.
 import json
-import boto3
 import base64
 import os
-from urllib import request
-from io import BytesIO
-from logic_user_usage import UserUsage
-import cv2
-from PIL import Image
-import numpy as np
-
-
-def upload_file_to_s3(data: bytes, bucket_name: str, key: str):
-    s3 = boto3.client("s3")
-    s3.upload_fileobj(BytesIO(data), bucket_name, key)
-
-
-def clean_blob(blob: bytes) -> bytes:
-    s = blob.strip().split(b"\r\n")
-    return b"\r\n".join(s[3:])
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from typing import List, Optional, Tuple
+from logic_user_usage import InsufficientCreditError, UserUsage
+from logic_usage_ledger import STATUS_FAILED, STATUS_OK, UsageLedger
+from logic_job_queue import SqsJobQueue, compute_request_hash, is_active_job
+from logic_batching import BatchingDispatcher
+from logic_result_cache import cache_key, create_result_cache
+from logic_image_store import ImageNotFoundError, create_image_store
+from logic_multipart import MultipartError, get_header, is_multipart
+from logic_multipart import parse_multipart, require_part
+from logic_backend_pool import get_backend_pool
+from logic_admission import MAX_WAIT, AdmissionRejectedError, rejected_response
+from logic_admission import create_admission_controller
+from logic_circuit_breaker import ServerUnavailableError, unavailable_response
+from logic_sd_client import DEADLINE_RESERVE, deadline_from_context
+from logic_metrics import count, instrument_handler, span, timed
 
+SHORTEST_TARGET = 512
+INPAINT_PADDING = 32
+IMG2IMG_TIMEOUT = float(os.environ.get("IMG2IMG_TIMEOUT", "30"))  # in sec
+# API Gateway gives up on a sync request after this, whatever the Lambda does
+API_TIMEOUT = float(os.environ.get("API_TIMEOUT", "29"))  # in sec
 
-def getBoundary(event_content_type: str) -> bytes:
-    boundary = event_content_type.split(";", 1)[1].strip().replace("boundary=", "", 1)
-    return ("--" + boundary).encode()
+IMAGE_FIELDS = ("imageData", "maskData", "edgeData", "referenceImageData")
 
+MAX_SWEEP_VARIANTS = int(os.environ.get("MAX_SWEEP_VARIANTS", "8"))
+MAX_SWEEP_BATCH = int(os.environ.get("MAX_SWEEP_BATCH", "4"))  # images per batch
+SWEEP_GRID_FIELDS = ("denosing", "cfgScale")
+# more variants than one batched img2img call renders do not fit the 30s of
+# API Gateway; those go through asyncMode
+MAX_SYNC_SWEEP_VARIANTS = int(
+    os.environ.get("MAX_SYNC_SWEEP_VARIANTS", str(MAX_SWEEP_BATCH))
+)
+MAX_SEED = 2**32 - 1
+# "tiled": true renders the masked part at full resolution in tiles of
+# TILE_SIZE instead of the whole image scaled down to SHORTEST_TARGET
+TILE_SIZE = int(os.environ.get("TILE_SIZE", "512"))
+TILE_OVERLAP = int(os.environ.get("TILE_OVERLAP", "64"))
+MAX_TILES = int(os.environ.get("MAX_TILES", "16"))
+TILE_CONCURRENCY = int(os.environ.get("TILE_CONCURRENCY", "2"))
+# more tiles than render in one round do not fit the 30s of API Gateway, and
+# a killed invocation would keep their credit; those go through asyncMode
+MAX_SYNC_TILES = int(os.environ.get("MAX_SYNC_TILES", str(TILE_CONCURRENCY)))
 
-SHORTEST_TARGET = 512
+# kept across warm invocations
+result_cache = create_result_cache()
+image_store = create_image_store()
 
 
 def limit_size(width: int, height: int):  # -> tuple[int, int]:
@@ -40,21 +68,165 @@ def limit_size(width: int, height: int):  # -> tuple[int, int]:
     return new_width, new_height
 
 
-def lambda_handler(event, context):
-    user_usage = UserUsage(event)
-    usage = user_usage.get_user_usage()
-    user_usage.update_last_called()
+@timed("decode")
+def load_request_body(event: dict) -> dict:
+    # Either the JSON body with base64 data URLs, or multipart/form-data with
+    # the parameters as a JSON "params" field and the images as raw file parts.
+    # Each uploaded image is base64-encoded exactly once, for the SD payload.
+    if not is_multipart(event):
+        return json.loads(event["body"])
 
-    remaining_credit = int(usage["credit"])
-    credit_consumption = int(os.environ["CREDIT_CONSUMPTION"])
-    if remaining_credit < credit_consumption:
+    fields, files = parse_multipart(event)
+    body = json.loads(require_part(fields, "params"))
+    for name in IMAGE_FIELDS:
+        data = files.pop(name, None)
+        if data is not None:
+            body[name] = base64.b64encode(data).decode()
+        else:
+            body.setdefault(name, "")
+    return body
+
+
+@timed("encode")
+def make_response(event: dict, out_image: str, remaining_credit: int, **extra):
+    if get_header(event, "accept") == "image/png":
+        # binary response, avoids wrapping base64 in JSON once more
         return {
-            "statusCode": 400,
-            "body": json.dumps("no sufficient credits remain"),
+            "statusCode": 200,
+            "headers": {
+                "Content-Type": "image/png",
+                "X-Remaining-Credit": str(remaining_credit),
+                **{"X-" + k: json.dumps(v) for k, v in extra.items()},
+            },
+            "body": out_image,
+            "isBase64Encoded": True,
         }
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {"image": out_image, "remainingCredit": remaining_credit, **extra}
+        ),
+    }
+
+
+def request_deadline(context) -> float:
+    # time.monotonic() by which the queue wait and SD calls of a sync request
+    # are done, so that its credit is refunded before API Gateway answers 504
+    deadline = time.monotonic() + API_TIMEOUT - DEADLINE_RESERVE
+    lambda_deadline = deadline_from_context(context)
+    return deadline if lambda_deadline is None else min(deadline, lambda_deadline)
+
+
+def make_job_response(job_queue, job: dict, remaining_credit: int):
+    # the client polls the job status Lambda with jobId
+    return {
+        "statusCode": 202,
+        "body": json.dumps(
+            {
+                "jobId": job["jobId"],
+                "status": job["status"],
+                "queueDepth": job_queue.depth(),
+                "remainingCredit": remaining_credit,
+            }
+        ),
+    }
+
+
+def submit_job(user_usage: UserUsage, body: dict, credit_consumption: int) -> dict:
+    # queues the request for generate_worker, which refunds the reservation
+    # if the job fails
+    job_queue = SqsJobQueue()
+    job = job_queue.get(user_usage.username, compute_request_hash(body))
+    if is_active_job(job):
+        # the same request is already queued and paid for
+        remaining_credit = int(user_usage.get_user_usage()["credit"])
+    else:
+        try:
+            remaining_credit = user_usage.reserve_credit(credit_consumption)
+        except InsufficientCreditError:
+            count("credit.insufficient")
+            return {
+                "statusCode": 400,
+                "body": json.dumps("no sufficient credits remain"),
+            }
+        job, created = job_queue.submit(user_usage.username, body, credit_consumption)
+        if not created:
+            # an identical request was queued in between and paid for the job
+            remaining_credit = user_usage.refund_credit(credit_consumption)
+    return make_job_response(job_queue, job, remaining_credit)
+
+
+@timed("preprocess")
+def preprocess_inputs(body: dict) -> Tuple[dict, Optional[dict]]:
+    # Downscales the inputs to the size SD renders at, so that neither the
+    # network nor the server handles full resolution pixels. With
+    # inpaintOnlyMasked, the inputs are first cropped to the mask's bounding box
+    # and the returned context is used by paste_back() afterwards.
+    only_masked = body.get("inpaintOnlyMasked", False)
+    if not only_masked and min(body["width"], body["height"]) <= SHORTEST_TARGET:
+        return body, None
+
+    from logic_image import decode_image, decode_mask, downscale, encode_image
+    from logic_image import mask_bbox, resize
+    from logic_mask import encode_compact_mask, is_compact_mask
 
-    body = json.loads(event["body"])
+    image = decode_image(body["imageData"])
+    height, width = image.shape[:2]
+    compact = is_compact_mask(body["maskData"])
+    region = None
+    if only_masked or not compact:
+        mask = decode_mask(body["maskData"], (width, height))
+    if only_masked:
+        region = mask_bbox(mask, body.get("inpaintPadding", INPAINT_PADDING))
+    top, bottom, left, right = region or (0, height, 0, width)
+    target = limit_size(right - left, bottom - top)
 
+    def _crop_and_downscale(data: str) -> str:
+        cropped = resize(decode_image(data), (width, height))
+        return encode_image(downscale(cropped[top:bottom, left:right], target))
+
+    body = dict(body)
+    body["width"], body["height"] = right - left, bottom - top
+    body["imageData"] = encode_image(downscale(image[top:bottom, left:right], target))
+    if not compact:
+        body["maskData"] = encode_image(downscale(mask[top:bottom, left:right], target))
+    elif region is not None:
+        # stays compact, SD and the anti-glare filter sample it at their size
+        body["maskData"] = encode_compact_mask(mask[top:bottom, left:right])
+    if body["useEdge"] and body["edgeData"]:
+        body["edgeData"] = _crop_and_downscale(body["edgeData"])
+    if body["useReference"] and body["useAnotherImageForReference"]:
+        reference = decode_image(body["referenceImageData"])
+        size = limit_size(reference.shape[1], reference.shape[0])
+        body["referenceImageData"] = encode_image(downscale(reference, size))
+
+    if region is None:
+        return body, None
+    return body, {
+        "image": image,
+        "mask": mask,
+        "region": region,
+        "maskBlur": body["maskBlur"],
+    }
+
+
+@timed("paste_back")
+def paste_back(out_image: str, context: dict) -> str:
+    from logic_image import blend_masked, decode_image, encode_image, resize
+
+    image = context["image"]
+    top, bottom, left, right = context["region"]
+    generated = resize(decode_image(out_image), (right - left, bottom - top))
+    blend_masked(
+        image[top:bottom, left:right],
+        generated,
+        context["mask"][top:bottom, left:right],
+        context["maskBlur"],
+    )
+    return encode_image(image)
+
+
+def build_img2img_payload(body: dict) -> dict:
     sampler = body["sampler"]  #  "DPM++ 2M Karras"
     steps = body["steps"]  # 30
     seed = body["seed"]
@@ -74,9 +246,6 @@ def lambda_handler(event, context):
     edge_str = body["edgeData"]
     positive_prompt = body["positivePrompt"]
     negative_prompt = body["negativePrompt"]
-    anti_glare_filter_flag = body["antiGlareFilterFlag"]
-    anti_glare_filter_sigma_s = body["antiGlareFilterSigmaS"]
-    anti_glare_filter_sigma_r = body["antiGlareFilterSigmaR"]
     use_edge = body["useEdge"]
     use_reference = body["useReference"]
     use_another_image_for_reference = body["useAnotherImageForReference"]
@@ -84,6 +253,11 @@ def lambda_handler(event, context):
         body["referenceImageData"] if use_another_image_for_reference else img_str
     )
     width, height = limit_size(width, height)
+    if isinstance(mask_str, dict):
+        # a compact mask, checked by the handler; logic_mask needs NumPy
+        from logic_mask import decode_compact_mask, encode_mask_png
+
+        mask_str = encode_mask_png(decode_compact_mask(mask_str, (width, height)))
 
     data = {
         "init_images": [img_str],
@@ -182,59 +356,563 @@ def lambda_handler(event, context):
     }
     data.update(cn_args)
 
-    base_url = os.environ["SD_SERVER_URL"]
-    url = base_url + "/sdapi/v1/img2img"
-    headers = {
-        # "accept": "application/json",
-        "Content-Type": "application/json"
-    }
+    return data
+
 
+def post_img2img(
+    data: dict, on_progress=None, deadline: Optional[float] = None
+) -> list:
     print("issue request")
-    with request.urlopen(
-        request.Request(url, json.dumps(data).encode(), headers), timeout=30
-    ) as res:
-        body = res.read()
+    body = get_backend_pool().post(
+        "/sdapi/v1/img2img",
+        data,
+        timeout=IMG2IMG_TIMEOUT,
+        on_progress=on_progress,
+        deadline=deadline,
+    )
+    return body["images"]
+
+
+def request_img2img(
+    data: dict, on_progress=None, deadline: Optional[float] = None
+) -> str:
+    return post_img2img(data, on_progress, deadline)[0]
+
 
-    body = json.loads(body)
-    out_image = body["images"][0]
+@timed("anti_glare")
+def apply_anti_glare_filters(out_images: List[str], body: dict) -> List[str]:
+    mask_str = body["maskData"]
+    anti_glare_filter_flag = body["antiGlareFilterFlag"]
+    anti_glare_filter_sigma_s = body["antiGlareFilterSigmaS"]
+    anti_glare_filter_sigma_r = body["antiGlareFilterSigmaR"]
 
     if (
-        anti_glare_filter_flag != 0
-        and anti_glare_filter_sigma_s != 0
-        and anti_glare_filter_sigma_r != 0
+        anti_glare_filter_flag == 0
+        or anti_glare_filter_sigma_s == 0
+        or anti_glare_filter_sigma_r == 0
     ):
-        pil_image = Image.open(BytesIO(base64.b64decode(body["images"][0])))
-        cv_image = np.array(pil_image, dtype=np.uint8)
-        cv_image_f = cv2.edgePreservingFilter(
-            cv_image,
+        return out_images
+
+    from logic_image import anti_glare_filter, decode_image, decode_mask
+    from logic_image import encode_image
+
+    # the outputs of one request share their size, so the mask is decoded once
+    mask = None
+    filtered = []
+    for out_image in out_images:
+        image = decode_image(out_image)
+        if mask is None or mask.shape[:2] != image.shape[:2]:
+            mask = decode_mask(mask_str, (image.shape[1], image.shape[0]))
+        anti_glare_filter(
+            image,
+            mask,
             flags=anti_glare_filter_flag,
             sigma_s=anti_glare_filter_sigma_s,
             sigma_r=anti_glare_filter_sigma_r,
+            mask_blur=body.get("antiGlareFilterMaskBlur", 0),
         )
-        cv_mask = np.array(
-            Image.open(BytesIO(base64.b64decode(mask_str.split(",")[1]))).convert("L"),
-            dtype=np.uint8,
+        filtered.append(encode_image(image))
+    return filtered
+
+
+def apply_anti_glare_filter(out_image: str, body: dict) -> str:
+    return apply_anti_glare_filters([out_image], body)[0]
+
+
+def generate_cache_key(body: dict) -> Optional[str]:
+    data = build_img2img_payload(body)
+    if data["seed"] == -1:
+        return None  # random seed, every call is expected to differ
+    anti_glare = {
+        "flag": body["antiGlareFilterFlag"],
+        "sigmaS": body["antiGlareFilterSigmaS"],
+        "sigmaR": body["antiGlareFilterSigmaR"],
+        "maskBlur": body.get("antiGlareFilterMaskBlur", 0),
+    }
+    preprocess = {
+        "inpaintOnlyMasked": body.get("inpaintOnlyMasked", False),
+        "inpaintPadding": body.get("inpaintPadding", INPAINT_PADDING),
+        "tiled": bool(body.get("tiled")),
+    }
+    return cache_key(
+        "generate",
+        {"img2img": data, "antiGlare": anti_glare, "preprocess": preprocess},
+    )
+
+
+def generate_image(
+    body: dict,
+    dispatcher: Optional[BatchingDispatcher] = None,
+    on_progress=None,
+    deadline: Optional[float] = None,
+) -> str:
+    # on_progress receives step progress and previews while SD samples, and
+    # the SD calls give up at deadline, a time.monotonic()
+    if body.get("tiled"):
+        return generate_tiled(body, deadline)
+    body, paste_back_context = preprocess_inputs(body)
+    data = build_img2img_payload(body)
+    if dispatcher is None:
+        out_image = request_img2img(data, on_progress, deadline)
+    else:
+        out_image = dispatcher.request(data, on_progress=on_progress, deadline=deadline)
+    out_image = apply_anti_glare_filter(out_image, body)
+    if paste_back_context is not None:
+        out_image = paste_back(out_image, paste_back_context)
+    return out_image
+
+
+def count_tiles(body: dict) -> int:
+    # raises ValueError when the mask needs more than MAX_TILES. Planned on
+    # the decoded image as generate_tiled() does, not on the width and height
+    # the client states, since the count is what the request is charged.
+    from logic_image import decode_image, decode_mask, plan_tiles
+
+    image = decode_image(body["imageData"])
+    if image is None:
+        raise ValueError("imageData is not an image")
+    height, width = image.shape[:2]
+    mask = decode_mask(body["maskData"], (width, height))
+    n_tiles = len(plan_tiles(mask, TILE_SIZE, TILE_OVERLAP))
+    if n_tiles > MAX_TILES:
+        raise ValueError(f"the mask needs {n_tiles} tiles, at most {MAX_TILES}")
+    return n_tiles
+
+
+@timed("tiled")
+def generate_tiled(body: dict, deadline: Optional[float] = None) -> str:
+    # Renders the masked part of the image at full resolution, as overlapping
+    # tiles of TILE_SIZE blended back into the original one by one. Besides
+    # the original and its mask, only tile-sized buffers are in memory.
+    from logic_image import blend_tile, decode_image, decode_mask, downscale
+    from logic_image import encode_image, plan_tiles, resize
+
+    image = decode_image(body["imageData"])
+    height, width = image.shape[:2]
+    mask = decode_mask(body["maskData"], (width, height))
+    tiles = plan_tiles(mask, TILE_SIZE, TILE_OVERLAP)
+    if len(tiles) > MAX_TILES:
+        raise ValueError(f"the mask needs {len(tiles)} tiles, at most {MAX_TILES}")
+    print(f"tiled {width}x{height} in {len(tiles)} tiles")
+
+    edge = None
+    if body["useEdge"] and body["edgeData"]:
+        edge = decode_image(body["edgeData"])
+    body = dict(body, inpaintOnlyMasked=False)
+    if body["useReference"] and body["useAnotherImageForReference"]:
+        reference = decode_image(body["referenceImageData"])
+        size = limit_size(reference.shape[1], reference.shape[0])
+        body["referenceImageData"] = encode_image(downscale(reference, size))
+
+    def _render(tile, tile_image) -> str:
+        top, bottom, left, right = tile[:4]
+        tile_body = dict(
+            body,
+            width=right - left,
+            height=bottom - top,
+            imageData=encode_image(tile_image),
+            maskData=encode_image(mask[top:bottom, left:right]),
         )
-        cv_mask = cv2.resize(cv_mask, (cv_image.shape[1], cv_image.shape[0]))
-        _, cv_mask = cv2.threshold(cv_mask, 127, 255, cv2.THRESH_BINARY)
+        if edge is not None:
+            # the edge map may come at another resolution than the image
+            edge_height, edge_width = edge.shape[:2]
+            cropped = edge[
+                top * edge_height // height : bottom * edge_height // height,
+                left * edge_width // width : right * edge_width // width,
+            ]
+            tile_body["edgeData"] = encode_image(
+                resize(cropped, (right - left, bottom - top))
+            )
+        out_image = request_img2img(build_img2img_payload(tile_body), deadline=deadline)
+        return apply_anti_glare_filter(out_image, tile_body)
 
-        # masking
-        masked_image_f = cv2.bitwise_and(cv_image_f, cv_image_f, mask=cv_mask)
-        masked_image = cv2.bitwise_and(
-            cv_image, cv_image, mask=cv2.bitwise_not(cv_mask)
+    def _blend(i: int, out_image: str):
+        top, bottom, left, right = tiles[i][:4]
+        generated = resize(decode_image(out_image), (right - left, bottom - top))
+        blend_tile(
+            image[top:bottom, left:right],
+            generated,
+            mask[top:bottom, left:right],
+            tiles[i],
+            tiles[:i],
+            body["maskBlur"],
         )
-        cv_image_f_masked = cv2.add(masked_image, masked_image_f)
 
-        converted_pil_image = Image.fromarray(cv_image_f_masked)
-        buffered = BytesIO()
-        converted_pil_image.save(buffered, format="PNG")
-        out_image = base64.b64encode(buffered.getvalue()).decode()
+    # Every tile is rendered from the original pixels, copied before anything
+    # is blended into their overlaps (at most MAX_TILES tiles). They are then
+    # blended in order, with at most TILE_CONCURRENCY tiles rendering at once.
+    inputs = deque(image[t.top : t.bottom, t.left : t.right].copy() for t in tiles)
+    with ThreadPoolExecutor(max_workers=TILE_CONCURRENCY) as executor:
+        in_flight = deque()
+        for i, tile in enumerate(tiles):
+            in_flight.append((i, executor.submit(_render, tile, inputs.popleft())))
+            if len(in_flight) >= TILE_CONCURRENCY:
+                i, future = in_flight.popleft()
+                _blend(i, future.result())
+        while in_flight:
+            i, future = in_flight.popleft()
+            _blend(i, future.result())
+    return encode_image(image)
+
+
+def expand_sweep(body: dict) -> List[dict]:
+    # "sweep": {"seeds": [...]} or {"count": n} for n random seeds, and
+    # optionally lists of denosing and cfgScale values; one variant per
+    # combination of seed and grid point
+    sweep = body["sweep"]
+    seeds = sweep.get("seeds")
+    if seeds is None:
+        n_seeds = int(sweep.get("count", 0))
+        # consecutive, so that they fit into one batch
+        start = random.randrange(MAX_SEED - n_seeds)
+        seeds = list(range(start, start + n_seeds))
+    if not all(isinstance(seed, int) and 0 <= seed <= MAX_SEED for seed in seeds):
+        raise ValueError("sweep seeds must be integers from 0 to 2^32-1")
+    grid = [sweep.get(name) or [body[name]] for name in SWEEP_GRID_FIELDS]
+    variants = [
+        {"seed": seed, "denosing": denosing, "cfgScale": cfg_scale}
+        for denosing, cfg_scale in product(*grid)
+        for seed in seeds
+    ]
+    if not 0 < len(variants) <= MAX_SWEEP_VARIANTS:
+        raise ValueError(f"a sweep has 1 to {MAX_SWEEP_VARIANTS} variants")
+    return variants
+
 
-    if credit_consumption != 0:
-        remaining_credit -= credit_consumption
-        user_usage.update_user_credit(remaining_credit)
+def plan_sweep_calls(variants: List[dict]) -> List[Tuple[dict, List[List[int]]]]:
+    # Groups the variants into img2img calls as (payload overrides, variant
+    # indices per output image). Everything but the seed is batch-wide, and
+    # SD renders batch item i of iteration j with seed + j * batch_size + i,
+    # so a run of consecutive seeds at one grid point is one call.
+    by_point = {}
+    for i, variant in enumerate(variants):
+        point = (variant["denosing"], variant["cfgScale"])
+        by_point.setdefault(point, {}).setdefault(variant["seed"], []).append(i)
 
+    calls = []
+    for (denosing, cfg_scale), by_seed in by_point.items():
+        seeds = sorted(by_seed)
+        runs = [[seeds[0]]]
+        for seed in seeds[1:]:
+            if seed == runs[-1][-1] + 1:
+                runs[-1].append(seed)
+            else:
+                runs.append([seed])
+        for run in runs:
+            while run:
+                batch_size = min(len(run), MAX_SWEEP_BATCH)
+                n_iter = len(run) // batch_size
+                taken, run = run[: batch_size * n_iter], run[batch_size * n_iter :]
+                overrides = {
+                    "seed": taken[0],
+                    "batch_size": batch_size,
+                    "n_iter": n_iter,
+                    "denoising_strength": denosing,
+                    "cfg_scale": cfg_scale,
+                }
+                calls.append((overrides, [by_seed[seed] for seed in taken]))
+    return calls
+
+
+def generate_sweep(
+    body: dict, variants: List[dict], deadline: Optional[float] = None
+) -> Tuple[list, dict]:
+    # (image or None per variant, errors by call). The inputs are
+    # preprocessed once for all the variants.
+    body, paste_back_context = preprocess_inputs(body)
+    data = build_img2img_payload(body)
+    calls = plan_sweep_calls(variants)
+    print(f"sweep of {len(variants)} variants in {len(calls)} img2img calls")
+
+    def _render(call: tuple) -> List[str]:
+        overrides, indices = call
+        # ControlNet may append its detected maps after the generated images
+        return post_img2img({**data, **overrides}, deadline=deadline)[: len(indices)]
+
+    images = [None] * len(variants)
+    errors = {}
+    unavailable = None
+    with ThreadPoolExecutor(max_workers=min(len(calls), 4)) as executor:
+        futures = [executor.submit(_render, call) for call in calls]
+        rendered = []  # (variant indices, image)
+        for (overrides, indices), future in zip(calls, futures):
+            try:
+                out_images = future.result()
+                if len(out_images) < len(indices):
+                    raise RuntimeError(
+                        f"expected {len(indices)} images, got {len(out_images)}"
+                    )
+            except Exception as error:
+                print(f"sweep call {overrides} failed: {error}")
+                errors[str(overrides["seed"])] = str(error)
+                if isinstance(error, ServerUnavailableError):
+                    unavailable = error
+                continue
+            rendered.extend(zip(indices, out_images))
+    if not rendered and unavailable is not None:
+        # nothing rendered because the server is down, not a failed sweep
+        raise unavailable
+
+    out_images = apply_anti_glare_filters([image for _, image in rendered], body)
+    for (indices, _), out_image in zip(rendered, out_images):
+        if paste_back_context is not None:
+            # paste_back() draws into the original, so each gets its own copy
+            context = dict(paste_back_context, image=paste_back_context["image"].copy())
+            out_image = paste_back(out_image, context)
+        for i in indices:
+            images[i] = out_image
+    return images, errors
+
+
+def handle_sweep(
+    body: dict,
+    user_usage: UserUsage,
+    usage_ledger: UsageLedger,
+    credit_consumption: int,
+    deadline: float,
+) -> dict:
+    try:
+        variants = expand_sweep(body)
+    except (KeyError, TypeError, ValueError) as error:
+        return {"statusCode": 400, "body": json.dumps(f"invalid sweep: {error}")}
+    # the whole set is paid for at once, or not at all
+    total_consumption = credit_consumption * len(variants)
+    if body.get("asyncMode"):
+        # generate_worker refunds the variants that fail
+        return submit_job(user_usage, body, total_consumption)
+    if len(variants) > MAX_SYNC_SWEEP_VARIANTS:
+        return {
+            "statusCode": 400,
+            "body": json.dumps(
+                f"a sweep of {len(variants)} variants; more than"
+                f" {MAX_SYNC_SWEEP_VARIANTS} need asyncMode"
+            ),
+        }
+
+    try:
+        get_backend_pool().check_available()
+    except ServerUnavailableError as error:
+        return unavailable_response(error)
+
+    try:
+        remaining_credit = user_usage.reserve_credit(total_consumption)
+    except InsufficientCreditError:
+        count("credit.insufficient")
+        return {
+            "statusCode": 400,
+            "body": json.dumps("no sufficient credits remain"),
+        }
+    started = None
+    try:
+        admission = create_admission_controller()
+        with admission.admitted(
+            user_usage.username,
+            user_usage.plan,
+            "generate",
+            max_wait=min(MAX_WAIT, deadline - time.monotonic()),
+            units=len(variants),
+        ) as queue_wait:
+            started = time.perf_counter()
+            images, errors = generate_sweep(body, variants, deadline)
+            sd_time = time.perf_counter() - started
+    except AdmissionRejectedError as error:
+        remaining_credit = user_usage.refund_credit(total_consumption)
+        return rejected_response(error, remainingCredit=remaining_credit)
+    except ServerUnavailableError as error:
+        # the server went down while this request waited for its slot
+        remaining_credit = user_usage.refund_credit(total_consumption)
+        return unavailable_response(error, remainingCredit=remaining_credit)
+    except Exception:
+        user_usage.refund_credit(total_consumption)
+        usage_ledger.record(
+            user_usage.username,
+            "sweep",
+            user_usage.plan,
+            gpu_seconds=time.perf_counter() - started if started else 0.0,
+            status=STATUS_FAILED,
+        )
+        raise
+
+    n_failed = sum(image is None for image in images)
+    count("sweep.variants", len(variants))
+    if n_failed:
+        remaining_credit = user_usage.refund_credit(credit_consumption * n_failed)
+    usage_ledger.record(
+        user_usage.username,
+        "sweep",
+        user_usage.plan,
+        credit=credit_consumption * (len(variants) - n_failed),
+        gpu_seconds=sd_time,
+        status=STATUS_FAILED if n_failed == len(variants) else STATUS_OK,
+    )
+    if n_failed == len(variants):
+        return {"statusCode": 502, "body": json.dumps("generation failed")}
     return {
         "statusCode": 200,
-        "body": json.dumps({"image": out_image, "remainingCredit": remaining_credit}),
+        "body": json.dumps(
+            {
+                "variants": [
+                    {**variant, "image": image}
+                    for variant, image in zip(variants, images)
+                ],
+                "remainingCredit": remaining_credit,
+                "queueWait": round(queue_wait, 3),
+                **({"errors": errors} if errors else {}),
+            }
+        ),
     }
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    # the queue wait and the SD calls of a sync request share this
+    deadline = request_deadline(context)
+    user_usage = UserUsage(event)
+    user_usage.update_last_called()
+    user_usage.record_arrival()
+    usage_ledger = UsageLedger()
+    credit_consumption = int(os.environ["CREDIT_CONSUMPTION"])
+    no_credit_response = {
+        "statusCode": 400,
+        "body": json.dumps("no sufficient credits remain"),
+    }
+
+    try:
+        body = load_request_body(event)
+    except MultipartError as error:
+        return {"statusCode": 400, "body": json.dumps(f"invalid body: {error}")}
+    try:
+        # images uploaded before, e.g. the edge map, come as "handle:<sha256>"
+        body = image_store.resolve(body, IMAGE_FIELDS)
+    except ImageNotFoundError as error:
+        return {
+            "statusCode": 404,
+            "body": json.dumps(
+                {"message": "image not found", "missingHandles": error.handles}
+            ),
+        }
+
+    if isinstance(body.get("maskData"), dict):
+        # a compact mask (logic_mask.py), the only masks sent as JSON objects
+        from logic_mask import MaskFormatError, validate_compact_mask
+
+        try:
+            validate_compact_mask(body["maskData"])
+        except MaskFormatError as error:
+            return {"statusCode": 400, "body": json.dumps(f"invalid maskData: {error}")}
+
+    units = 1
+    if body.get("tiled"):
+        if body.get("sweep"):
+            return {"statusCode": 400, "body": json.dumps("sweep is not tiled")}
+        try:
+            n_tiles = count_tiles(body)
+        except (KeyError, TypeError, ValueError) as error:
+            return {"statusCode": 400, "body": json.dumps(f"invalid tiled: {error}")}
+        if n_tiles == 0:
+            return {"statusCode": 400, "body": json.dumps("the mask is empty")}
+        if n_tiles > MAX_SYNC_TILES and not body.get("asyncMode"):
+            return {
+                "statusCode": 400,
+                "body": json.dumps(
+                    f"the mask needs {n_tiles} tiles; more than {MAX_SYNC_TILES}"
+                    " need asyncMode"
+                ),
+            }
+        # the SD slots the request holds at once
+        units = min(n_tiles, TILE_CONCURRENCY)
+        # every tile is an img2img call of its own, and charged as one
+        credit_consumption *= n_tiles
+
+    if body.get("sweep"):
+        return handle_sweep(
+            body, user_usage, usage_ledger, credit_consumption, deadline
+        )
+
+    key = generate_cache_key(body)
+    with span("cache.get"):
+        cached = result_cache.get(key) if key else None
+    print(f"result cache {result_cache.stats()}")
+    count("cache.hit" if cached is not None else "cache.miss")
+    kind = "tiled" if body.get("tiled") else "generate"
+    if cached is not None:
+        # served without the SD server, so no credit is consumed
+        user_info = user_usage.get_user_usage()
+        remaining_credit = int(user_info["credit"])
+        if remaining_credit < credit_consumption:
+            count("credit.insufficient")
+            return no_credit_response
+        usage_ledger.record(
+            user_usage.username, kind, user_info.get("plan"), cached=True
+        )
+        if body.get("asyncMode"):
+            # async clients get a job to poll either way, already SUCCEEDED
+            job_queue = SqsJobQueue()
+            job = job_queue.submit_completed(
+                user_usage.username,
+                body,
+                {"image": cached["image"], "remainingCredit": remaining_credit},
+            )
+            return make_job_response(job_queue, job, remaining_credit)
+        return make_response(event, cached["image"], remaining_credit, cached=True)
+
+    if body.get("asyncMode"):
+        return submit_job(user_usage, body, credit_consumption)
+
+    try:
+        # fails fast while the server is known to be stopped or booting
+        get_backend_pool().check_available()
+    except ServerUnavailableError as error:
+        return unavailable_response(error)
+
+    try:
+        remaining_credit = user_usage.reserve_credit(credit_consumption)
+    except InsufficientCreditError:
+        count("credit.insufficient")
+        return no_credit_response
+    started = None
+    try:
+        admission = create_admission_controller()
+        with admission.admitted(
+            user_usage.username,
+            user_usage.plan,
+            "generate",
+            max_wait=min(MAX_WAIT, deadline - time.monotonic()),
+            units=units,
+        ) as queue_wait:
+            started = time.perf_counter()
+            out_image = generate_image(body, deadline=deadline)
+            sd_time = time.perf_counter() - started
+    except AdmissionRejectedError as error:
+        # rejected before any SD work, so the client can simply retry later
+        remaining_credit = user_usage.refund_credit(credit_consumption)
+        return rejected_response(error, remainingCredit=remaining_credit)
+    except ServerUnavailableError as error:
+        # the server went down while this request waited for its slot
+        remaining_credit = user_usage.refund_credit(credit_consumption)
+        return unavailable_response(error, remainingCredit=remaining_credit)
+    except Exception:
+        user_usage.refund_credit(credit_consumption)
+        usage_ledger.record(
+            user_usage.username,
+            kind,
+            user_usage.plan,
+            gpu_seconds=time.perf_counter() - started if started else 0.0,
+            status=STATUS_FAILED,
+        )
+        raise
+    print(f"sd backends {json.dumps(get_backend_pool().stats())}")
+    usage_ledger.record(
+        user_usage.username,
+        kind,
+        user_usage.plan,
+        credit=credit_consumption,
+        gpu_seconds=sd_time,
+    )
+    if key:
+        with span("cache.put"):
+            result_cache.put(key, {"image": out_image})
+
+    return make_response(
+        event, out_image, remaining_credit, queueWait=round(queue_wait, 3)
+    )
@@ -0,0 +1,175 @@
+# Runs on Python3.8 together with generate.py (OpenCV layer)
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from generate import generate_image, generate_cache_key, post_img2img, result_cache
+from generate import TILE_CONCURRENCY, count_tiles, expand_sweep, generate_sweep
+from logic_batching import BatchingDispatcher
+from logic_user_usage import UserUsage
+from logic_usage_ledger import STATUS_FAILED, UsageLedger
+from logic_job_queue import JOB_RUNNING, SqsJobQueue, is_claimable, job_latency
+from logic_metrics import instrument_handler
+from logic_admission import create_admission_controller
+from logic_sd_client import deadline_from_context
+
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "4"))
+# jobs are already queued, so they wait for a slot longer than API calls
+ADMISSION_MAX_WAIT = float(os.environ.get("ADMISSION_WORKER_MAX_WAIT", "240"))  # in sec
+# the maxReceiveCount of the queue's DLQ; a job still unfinished on its last
+# delivery has had its worker killed on each one before
+JOB_MAX_RECEIVES = int(os.environ.get("JOB_MAX_RECEIVES", "3"))
+
+# kept across warm invocations so that jobs of one SQS batch share img2img calls.
+# Jobs of different users differ in mask, prompt and reference image, so they
+# hardly ever can and a batch window only delays them (tools/bench_batching.py);
+# without one, only identical jobs running at the same moment share a call.
+dispatcher = BatchingDispatcher(
+    post_img2img,
+    window=float(os.environ.get("BATCH_WINDOW", "0")),
+    max_batch_size=MAX_BATCH_SIZE,
+)
+
+
+def job_credit(job: dict) -> int:
+    # reserved when the job was submitted, per tile or variant for tiled jobs
+    # and sweeps; jobs queued before that was recorded paid one
+    return job.get("credit", int(os.environ["CREDIT_CONSUMPTION"]))
+
+
+def fail_job(job_queue, job: dict, error: str) -> bool:
+    # False when another delivery of the message took the job over
+    if not job_queue.mark_failed(job, error):
+        return False
+    user_usage = UserUsage()
+    user_usage.username = job["username"]
+    user_usage.refund_credit(job_credit(job))
+    return True
+
+
+def run_job(job_queue, job: dict, deadline: Optional[float] = None) -> dict:
+    # deadline: time.monotonic() by which the job is done or failed, so that
+    # its credit is refunded before the Lambda is killed
+    user_usage = UserUsage()
+    user_usage.username = job["username"]
+    usage_ledger = UsageLedger()
+    credit_consumption = job_credit(job)
+
+    plan, kind, started, variants, units = None, "generate", None, None, 1
+    try:
+        plan = user_usage.get_user_usage().get("plan")
+        body = job_queue.get_request_body(job)
+        if body.get("sweep"):
+            variants = expand_sweep(body)
+            kind, units = "sweep", len(variants)
+        elif body.get("tiled"):
+            kind, units = "tiled", min(count_tiles(body), TILE_CONCURRENCY)
+        max_wait = ADMISSION_MAX_WAIT
+        if deadline is not None:
+            max_wait = min(max_wait, deadline - time.monotonic())
+        with create_admission_controller().admitted(
+            job["username"], plan, "generate", max_wait=max_wait, units=units
+        ):
+            if not job_queue.claim(job):
+                print(f"job {job['jobId']} is {job['status'].lower()}, skipped")
+                return job
+            started = time.perf_counter()
+            if variants:
+                images, errors = generate_sweep(body, variants, deadline)
+                if all(image is None for image in images):
+                    raise RuntimeError(f"every variant failed: {errors}")
+            else:
+                out_image = generate_image(
+                    body,
+                    dispatcher,
+                    on_progress=lambda progress: job_queue.update_progress(
+                        job, progress
+                    ),
+                    deadline=deadline,
+                )
+            sd_time = time.perf_counter() - started
+    except Exception as error:
+        print(f"job {job['jobId']} failed: {error}")
+        if not fail_job(job_queue, job, str(error)):
+            return job
+        if started is not None:
+            usage_ledger.record(
+                job["username"],
+                kind,
+                plan,
+                gpu_seconds=time.perf_counter() - started,
+                status=STATUS_FAILED,
+            )
+        return job
+
+    if variants:
+        # the variants whose img2img call failed are not charged
+        n_failed = sum(image is None for image in images)
+        refund = credit_consumption * n_failed // len(variants)
+        if refund:
+            user_usage.refund_credit(refund)
+        credit_consumption -= refund
+        result = {
+            "variants": [
+                {**variant, "image": image} for variant, image in zip(variants, images)
+            ],
+            **({"errors": errors} if errors else {}),
+        }
+    else:
+        key = generate_cache_key(body)
+        if key:
+            result_cache.put(key, {"image": out_image})
+        result = {"image": out_image}
+    usage_ledger.record(
+        job["username"], kind, plan, credit=credit_consumption, gpu_seconds=sd_time
+    )
+
+    remaining_credit = int(user_usage.get_user_usage()["credit"])
+
+    job_queue.mark_succeeded(job, {**result, "remainingCredit": remaining_credit})
+    latency = job_latency(job)
+    print(
+        f"job {job['jobId']} done: wait {latency['waitTime']:.2f}s,"
+        f" run {latency['runTime']:.2f}s, queue depth {job_queue.depth()}"
+    )
+    return job
+
+
+def drain(job_queue, max_jobs: Optional[int] = None, timeout: float = 0.0) -> int:
+    # used with InMemoryJobQueue to process jobs in-process
+    n_processed = 0
+    while max_jobs is None or n_processed < max_jobs:
+        job = job_queue.receive(timeout=timeout)
+        if job is None:
+            break
+        run_job(job_queue, job)
+        n_processed += 1
+    return n_processed
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    deadline = deadline_from_context(context)
+    job_queue = SqsJobQueue()
+    jobs = []
+    for record in event["Records"]:
+        job = job_queue.from_message(record["body"])
+        if job is None:
+            print("job record not found")
+            continue
+        if not is_claimable(job):
+            # delivered again, e.g. after a timeout; the message is deleted
+            print(f"job {job['jobId']} is {job['status'].lower()}, skipped")
+            continue
+        receives = int(record.get("attributes", {}).get("ApproximateReceiveCount", 1))
+        if job["status"] == JOB_RUNNING and receives >= JOB_MAX_RECEIVES:
+            # failed and refunded now, as a run killed once more would send
+            # the message to the DLQ with the credit still held
+            print(f"job {job['jobId']} lost its worker {receives - 1} times")
+            fail_job(job_queue, job, "the job did not finish in time")
+            continue
+        jobs.append(job)
+
+    # run concurrently so that the dispatcher can group compatible jobs
+    with ThreadPoolExecutor(max_workers=MAX_BATCH_SIZE) as executor:
+        list(executor.map(lambda job: run_job(job_queue, job, deadline), jobs))
@@ -1,6 +1,9 @@
+from logic_metrics import instrument_handler
+
 N = 1893
 
 
+@instrument_handler
 def lambda_handler(event, context):
     try:
         invitation_code = int(event["request"]["userAttributes"]["custom:invitation"])
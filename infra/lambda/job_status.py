@@ -0,0 +1,44 @@
+import json
+from logic_user_usage import UserUsage
+from logic_job_queue import JOB_RUNNING, PROGRESS_FIELDS, SqsJobQueue, job_latency
+from logic_metrics import instrument_handler
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    user_usage = UserUsage(event)
+    params = event.get("queryStringParameters") or {}
+    job_id = params.get("jobId")
+    if not job_id:
+        return {"statusCode": 400, "body": json.dumps("jobId is required")}
+
+    job_queue = SqsJobQueue()
+    job = job_queue.get(user_usage.username, job_id)
+    if job is None:
+        return {"statusCode": 404, "body": json.dumps("job not found")}
+
+    response = {
+        "jobId": job["jobId"],
+        "status": job["status"],
+        "queueDepth": job_queue.depth(),
+        **job_latency(job),
+    }
+    if job["status"] == JOB_RUNNING:
+        for name in PROGRESS_FIELDS:
+            if name in job:
+                response[name] = job[name]
+        # the latest preview, unless the client already has it
+        if str(job.get("previewStep")) != params.get("previewStep"):
+            preview = job_queue.get_preview(job)
+            if preview is not None:
+                response["preview"] = preview["image"]
+    if "error" in job:
+        response["error"] = job["error"]
+    result = job_queue.get_result(job)
+    if result is not None:
+        response.update(result)
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps(response),
+    }
@@ -0,0 +1,523 @@
+import heapq
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from decimal import Decimal
+from typing import Callable, Optional, Tuple
+from boto3.dynamodb.types import TypeDeserializer
+from logic_aws import get_resource
+from logic_backend_pool import get_backend_pool
+from logic_metrics import count, span
+
+ADMISSION_ENABLED = os.environ.get("ADMISSION_ENABLED", "1") != "0"
+SLOTS_PER_BACKEND = int(os.environ.get("ADMISSION_SLOTS_PER_BACKEND", "2"))
+MAX_WAIT = float(os.environ.get("ADMISSION_MAX_WAIT", "8"))  # in sec
+# a held lease is renewed every third of this, so only a crashed or killed
+# invocation's lease runs out
+LEASE_TTL = float(os.environ.get("ADMISSION_LEASE_TTL", "60"))  # in sec
+TICKET_TTL = 5  # in sec, a waiter that stops polling drops out of the queue
+# waiters poll every half of their expected wait, within these bounds
+POLL_INTERVAL = 0.5  # in sec
+MAX_POLL_INTERVAL = 2.0  # in sec, below TICKET_TTL / 2
+# how long an update of the shared state may keep losing the race, in sec
+CAS_TIMEOUT = float(os.environ.get("ADMISSION_CAS_TIMEOUT", "5"))
+COST_EWMA_ALPHA = 0.2
+
+# expected sec a request holds its slot, until the measured ones take over.
+# Used as its cost in the fair queue and for the wait estimates.
+COSTS = {
+    "generate": float(os.environ.get("ADMISSION_COST_GENERATE", "8")),
+    "edge": float(os.environ.get("ADMISSION_COST_EDGE", "2")),
+}
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"SD backend saturated, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class AdmissionContentionError(AdmissionRejectedError):
+    # the shared state stayed too contended to update; as busy as saturated
+    pass
+
+
+def plan_policy(plan: Optional[str]) -> Tuple[float, int]:
+    # (fair queue weight, max requests in flight per user), unknown plans as free
+    if plan is not None and plan == os.environ.get("PLAN_NAME_STANDARD"):
+        return (
+            float(os.environ.get("PLAN_WEIGHT_STANDARD", "3")),
+            int(os.environ.get("USER_MAX_IN_FLIGHT_STANDARD", "2")),
+        )
+    return (
+        float(os.environ.get("PLAN_WEIGHT_FREE", "1")),
+        int(os.environ.get("USER_MAX_IN_FLIGHT_FREE", "1")),
+    )
+
+
+class FairShareScheduler:
+    # Weighted fair queuing over a JSON state shared by all the Lambdas, as
+    # two levels of stride scheduling: the plans share the slots by their
+    # weights, and the users of a plan share its part equally. Every grant
+    # advances the pass of its plan by cost / weight and the pass of its user
+    # by cost, and a free slot goes to the oldest waiting request of the
+    # lowest-pass user of the lowest-pass plan, skipping users at their
+    # in-flight limit. A plan or user coming back after a pause starts from
+    # the current virtual time, so nobody banks credit while idle, and nobody
+    # waits while a slot is free and no one else wants it. A request of
+    # several units, e.g. a sweep, holds that many slots, at most all of them.
+    def __init__(
+        self,
+        capacity: int,
+        lease_ttl: float = LEASE_TTL,
+        ticket_ttl: float = TICKET_TTL,
+        policy: Callable[[Optional[str]], Tuple[float, int]] = plan_policy,
+    ):
+        self.capacity = capacity
+        self.lease_ttl = lease_ttl
+        self.ticket_ttl = ticket_ttl
+        self.policy = policy
+
+    @staticmethod
+    def new_state() -> dict:
+        # leases: in flight, waiting: tickets, pass: "plan:.."/"user:plan:.." ->
+        # virtual time used, vtime: "" for the plans, plan name for its users,
+        # cost: kind -> measured sec a slot is held
+        return {"leases": {}, "waiting": {}, "pass": {}, "vtime": {}, "cost": {}}
+
+    def _prune(self, state: dict, now: float):
+        # leases of crashed or timed-out invocations expire on their own
+        for name in ("leases", "waiting"):
+            state[name] = {k: v for k, v in state[name].items() if v["exp"] > now}
+        if not state["leases"] and not state["waiting"]:
+            # idle, past usage no longer counts against anyone
+            state["pass"] = {}
+            state["vtime"] = {}
+
+        def level(key: str) -> str:
+            # the virtual time a pass is compared with
+            return "" if key.startswith("plan:") else key.split(":", 2)[1]
+
+        # a pass behind its virtual time is as good as none
+        state["pass"] = {
+            k: v
+            for k, v in state["pass"].items()
+            if v > state["vtime"].get(level(k), 0.0)
+        }
+
+    @staticmethod
+    def _slots(entry: dict) -> int:
+        return entry.get("slots", 1)
+
+    def _used(self, state: dict) -> int:
+        return sum(self._slots(lease) for lease in state["leases"].values())
+
+    def _in_flight(self, state: dict, user: str) -> int:
+        return sum(lease["user"] == user for lease in state["leases"].values())
+
+    def _blocked(self, state: dict, ticket: dict) -> bool:
+        _, user_limit = self.policy(ticket["plan"])
+        return self._in_flight(state, ticket["user"]) >= user_limit
+
+    @staticmethod
+    def _passes(passes: dict, vtime: dict, ticket: dict) -> Tuple[float, float]:
+        plan = ticket["plan"] or ""
+        return (
+            max(passes.get("plan:" + plan, 0.0), vtime.get("", 0.0)),
+            max(passes.get(f"user:{plan}:{ticket['user']}", 0.0), vtime.get(plan, 0.0)),
+        )
+
+    def _next(self, passes: dict, vtime: dict, tickets: dict) -> str:
+        # the ticket id served next among tickets
+        return min(
+            tickets,
+            key=lambda k: (
+                *self._passes(passes, vtime, tickets[k]),
+                tickets[k]["since"],
+            ),
+        )
+
+    def _charge(self, passes: dict, vtime: dict, ticket: dict):
+        plan_pass, user_pass = self._passes(passes, vtime, ticket)
+        weight, _ = self.policy(ticket["plan"])
+        plan = ticket["plan"] or ""
+        passes["plan:" + plan] = plan_pass + ticket["cost"] / weight
+        passes[f"user:{plan}:{ticket['user']}"] = user_pass + ticket["cost"]
+        vtime[""] = plan_pass
+        vtime[plan] = user_pass
+
+    def _queue(self, state: dict) -> list:
+        # waiting ticket ids in service order, if none were held back
+        passes, vtime = dict(state["pass"]), dict(state["vtime"])
+        tickets = dict(state["waiting"])
+        order = []
+        while tickets:
+            ticket_id = self._next(passes, vtime, tickets)
+            self._charge(passes, vtime, tickets.pop(ticket_id))
+            order.append(ticket_id)
+        return order
+
+    def try_acquire(
+        self,
+        state: dict,
+        ticket_id: str,
+        user: str,
+        plan: Optional[str],
+        kind: str,
+        now: float,
+        units: int = 1,
+    ) -> Tuple[bool, float]:
+        # (granted, estimated wait in sec when not); units: requests of the
+        # kind done in one go, e.g. the variants of a sweep, each taking a slot
+        self._prune(state, now)
+        ticket = state["waiting"].get(ticket_id)
+        if ticket is None:
+            cost = state["cost"].get(kind, COSTS[kind]) * units
+            ticket = {"user": user, "plan": plan, "kind": kind, "cost": cost}
+            # more than all the slots would never be granted
+            ticket.update(units=units, slots=min(units, self.capacity), since=now)
+            state["waiting"][ticket_id] = ticket
+        ticket["exp"] = now + self.ticket_ttl
+
+        if self._grantable(state, ticket_id):
+            self._charge(state["pass"], state["vtime"], ticket)
+            del state["waiting"][ticket_id]
+            state["leases"][ticket_id] = {
+                "user": user,
+                "plan": plan,
+                "kind": kind,
+                "units": units,
+                "slots": ticket["slots"],
+                "cost": ticket["cost"],
+                "start": now,
+                "exp": now + self.lease_ttl,
+            }
+            return True, 0.0
+        return False, self.estimate_wait(state, ticket_id, now)
+
+    def _grantable(self, state: dict, ticket_id: str) -> bool:
+        ticket = state["waiting"][ticket_id]
+        if self._used(state) + self._slots(ticket) > self.capacity:
+            return False
+        if self._blocked(state, ticket):
+            return False
+        eligible = {
+            k: v for k, v in state["waiting"].items() if not self._blocked(state, v)
+        }
+        return self._next(state["pass"], state["vtime"], eligible) == ticket_id
+
+    def peek(self, state: dict, ticket_id: str, now: float) -> Tuple[bool, float]:
+        # try_acquire without writing: (whether it would grant the ticket now,
+        # estimated wait when not). A ticket no longer waiting is worth a try,
+        # which queues it again.
+        self._prune(state, now)
+        if ticket_id not in state["waiting"]:
+            return True, 0.0
+        if self._grantable(state, ticket_id):
+            return True, 0.0
+        return False, self.estimate_wait(state, ticket_id, now)
+
+    def _remaining(self, lease: dict, now: float) -> float:
+        # its units run side by side on its slots
+        duration = lease["cost"] / self._slots(lease)
+        return max(duration - (now - lease["start"]), 0.1 * duration)
+
+    def _slot_wait(self, state: dict, ahead: list, now: float, slots: int = 1):
+        # -> float, when the slots free up for whoever comes after the tickets
+        # ahead: the slots free as the leases end, and each ticket ahead takes
+        # as many as it needs once they all are free
+        free_at = []
+        for lease in state["leases"].values():
+            free_at += [self._remaining(lease, now)] * self._slots(lease)
+        free_at += [0.0] * max(self.capacity - len(free_at), 0)
+        heapq.heapify(free_at)
+        for ticket in ahead:
+            n = min(self._slots(ticket), len(free_at))
+            start = max(heapq.heappop(free_at) for _ in range(n))
+            for _ in range(n):
+                heapq.heappush(free_at, start + ticket["cost"] / n)
+        return max(heapq.nsmallest(min(slots, len(free_at)), free_at), default=0.0)
+
+    def estimate_wait(self, state: dict, ticket_id: str, now: float) -> float:
+        # until its turn comes, or until a lease of its own user ends when that
+        # is what holds it back
+        ticket = state["waiting"][ticket_id]
+        ahead = []
+        for k in self._queue(state):
+            if k == ticket_id:
+                break
+            if not self._blocked(state, state["waiting"][k]):
+                ahead.append(state["waiting"][k])
+        wait = self._slot_wait(state, ahead, now, self._slots(ticket))
+        if self._blocked(state, ticket):
+            own = [
+                self._remaining(lease, now)
+                for lease in state["leases"].values()
+                if lease["user"] == ticket["user"]
+            ]
+            wait = max(wait, min(own))
+        return wait
+
+    def renew(self, state: dict, ticket_id: str, now: float) -> bool:
+        # False when the lease already ran out and its slot may be taken
+        lease = state["leases"].get(ticket_id)
+        if lease is None or lease["exp"] <= now:
+            return False
+        lease["exp"] = now + self.lease_ttl
+        return True
+
+    def withdraw(self, state: dict, ticket_id: str):
+        state["waiting"].pop(ticket_id, None)
+
+    def release(self, state: dict, ticket_id: str, now: float):
+        lease = state["leases"].pop(ticket_id, None)
+        if lease is None:
+            return
+        units = lease.get("units", 1)
+        cost = state["cost"].get(lease["kind"], lease["cost"] / units)
+        # slot sec per unit
+        held = (now - lease["start"]) * self._slots(lease) / units
+        state["cost"][lease["kind"]] = cost + COST_EWMA_ALPHA * (held - cost)
+
+    def snapshot(self, state: dict, now: float) -> dict:
+        # in flight and waiting per plan, and the wait a new request would see
+        self._prune(state, now)
+        ahead = [state["waiting"][k] for k in self._queue(state)]
+        plans = {}
+        for name in ("leases", "waiting"):
+            for entry in state[name].values():
+                stats = plans.setdefault(
+                    entry["plan"] or "unknown", {"inFlight": 0, "waiting": 0}
+                )
+                stats["inFlight" if name == "leases" else "waiting"] += 1
+        return {
+            "capacity": self.capacity,
+            "inFlight": len(state["leases"]),
+            "slotsUsed": self._used(state),
+            "waiting": len(state["waiting"]),
+            "estimatedWait": self._slot_wait(state, ahead, now),
+            "plans": plans,
+        }
+
+
+# in-process state, for local runs and simulations
+class InMemoryAdmissionStore:
+    def __init__(self):
+        self._state = FairShareScheduler.new_state()
+        self._lock = threading.Lock()
+
+    def update(self, func: Callable[[dict], object]):
+        with self._lock:
+            return func(self._state)
+
+    def read(self, func: Callable[[dict], object]):
+        with self._lock:
+            return func(json.loads(json.dumps(self._state)))
+
+
+# The state is one item in the user table, written with optimistic locking.
+# Every update is a conditional put of the state last seen; a lost race
+# returns the current item, so an update takes a single round trip when
+# uncontended and one more per writer it raced with.
+class DynamoAdmissionStore:
+    def __init__(self):
+        dynamodb = get_resource("dynamodb")
+        self._table = dynamodb.Table(os.environ["DYNAMO_TABLE_NAME"])
+        self._key = {"pk": "GLOBAL", "sk": "admission"}
+        self._deserializer = TypeDeserializer()
+        # (state JSON, version) as last read or written, None before that
+        self._seen = None
+        self._lock = threading.Lock()
+
+    def _get(self) -> Tuple[str, int]:
+        item = self._table.get_item(Key=self._key, ConsistentRead=True).get("Item")
+        return self._parse(item)
+
+    @staticmethod
+    def _parse(item: Optional[dict]) -> Tuple[str, int]:
+        if item is None:
+            return json.dumps(FairShareScheduler.new_state()), 0
+        return item["state"], int(item["version"])
+
+    def read(self, func: Callable[[dict], object]):
+        with self._lock:
+            self._seen = self._get()
+            return func(json.loads(self._seen[0]))
+
+    def update(self, func: Callable[[dict], object]):
+        conditional_check_failed = (
+            self._table.meta.client.exceptions.ConditionalCheckFailedException
+        )
+        with self._lock:
+            seen = self._seen or self._get()
+            deadline = time.monotonic() + CAS_TIMEOUT
+            backoff = 0.02  # in sec
+            while True:
+                state = json.loads(seen[0])
+                result = func(state)
+                written = json.dumps(state, separators=(",", ":"))
+                try:
+                    self._table.put_item(
+                        Item={
+                            **self._key,
+                            "state": written,
+                            "version": Decimal(seen[1] + 1),
+                        },
+                        ConditionExpression="attribute_not_exists(pk) OR #version = :version",
+                        ExpressionAttributeNames={"#version": "version"},
+                        ExpressionAttributeValues={":version": Decimal(seen[1])},
+                        ReturnValuesOnConditionCheckFailure="ALL_OLD",
+                    )
+                    self._seen = (written, seen[1] + 1)
+                    return result
+                except conditional_check_failed as error:
+                    # somebody else updated it in between, retry on the new state
+                    item = error.response.get("Item")
+                    if item is None:
+                        seen = self._get()
+                    else:
+                        seen = self._parse(
+                            {
+                                k: self._deserializer.deserialize(v)
+                                for k, v in item.items()
+                            }
+                        )
+                    self._seen = seen
+                if time.monotonic() + backoff > deadline:
+                    count("admission.contended")
+                    raise AdmissionContentionError(POLL_INTERVAL)
+                time.sleep(random.uniform(0, backoff))
+                backoff = min(2 * backoff, 0.5)
+
+
+class AdmissionController:
+    def __init__(self, store, scheduler: FairShareScheduler):
+        self._store = store
+        self._scheduler = scheduler
+
+    def acquire(
+        self,
+        user: str,
+        plan: Optional[str],
+        kind: str,
+        max_wait: float = MAX_WAIT,
+        units: int = 1,
+    ) -> Tuple[str, float]:
+        # (lease id, sec waited). Waits for a slot as long as the expected
+        # wait fits in max_wait, raises AdmissionRejectedError otherwise.
+        ticket_id = uuid.uuid4().hex
+        start = time.time()
+        deadline = start + max_wait
+        written = None  # when the ticket was last written
+        while True:
+            now = time.time()
+            # the state is shared by every invocation, so a waiter only writes
+            # when its turn may have come or its ticket is about to expire
+            fresh = (
+                written is not None and now - written < self._scheduler.ticket_ttl / 2
+            )
+            if fresh:
+                granted, wait = self._store.read(
+                    lambda state: self._scheduler.peek(state, ticket_id, now)
+                )
+            if not fresh or granted:
+                granted, wait = self._store.update(
+                    lambda state: self._scheduler.try_acquire(
+                        state, ticket_id, user, plan, kind, now, units
+                    )
+                )
+                written = now
+                if granted:
+                    return ticket_id, now - start
+            if now + wait > deadline or now + POLL_INTERVAL > deadline:
+                self._store.update(
+                    lambda state: self._scheduler.withdraw(state, ticket_id)
+                )
+                raise AdmissionRejectedError(max(wait, POLL_INTERVAL))
+            interval = min(max(wait / 2, POLL_INTERVAL), MAX_POLL_INTERVAL)
+            time.sleep(min(interval * random.uniform(0.8, 1.2), deadline - now))
+
+    def renew(self, lease_id: str) -> bool:
+        now = time.time()
+        return self._store.update(
+            lambda state: self._scheduler.renew(state, lease_id, now)
+        )
+
+    def _keep_renewed(self, lease_id: str, done: threading.Event):
+        # runs beside the admitted work, which may hold its slot longer than
+        # one LEASE_TTL, e.g. a tiled or queued generation
+        while not done.wait(self._scheduler.lease_ttl / 3):
+            try:
+                if not self.renew(lease_id):
+                    print(f"admission lease {lease_id} expired before its renewal")
+                    return
+            except Exception as error:
+                # the lease holds until its expiry, the next renewal may succeed
+                print(f"admission lease renewal failed: {error}")
+
+    def release(self, lease_id: str):
+        now = time.time()
+        try:
+            self._store.update(
+                lambda state: self._scheduler.release(state, lease_id, now)
+            )
+        except AdmissionContentionError as error:
+            # the work is done, its lease expires on its own
+            print(f"admission lease {lease_id} not released: {error}")
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        return self._store.read(lambda state: self._scheduler.snapshot(state, now))
+
+    @contextmanager
+    def admitted(
+        self,
+        user: str,
+        plan: Optional[str],
+        kind: str,
+        max_wait: float = MAX_WAIT,
+        units: int = 1,
+    ):
+        # yields the sec spent waiting for the slot
+        if not ADMISSION_ENABLED:
+            yield 0.0
+            return
+        with span("admission.wait"):
+            try:
+                lease_id, waited = self.acquire(user, plan, kind, max_wait, units)
+            except AdmissionRejectedError:
+                count("admission.rejected")
+                raise
+        done = threading.Event()
+        renewer = threading.Thread(
+            target=self._keep_renewed, args=(lease_id, done), daemon=True
+        )
+        renewer.start()
+        try:
+            yield waited
+        finally:
+            done.set()
+            renewer.join()
+            self.release(lease_id)
+
+
+def create_admission_controller() -> AdmissionController:
+    # capacity follows the healthy backends of the pool
+    n_backends = sum(backend.healthy for backend in get_backend_pool().backends)
+    scheduler = FairShareScheduler(SLOTS_PER_BACKEND * max(n_backends, 1))
+    return AdmissionController(DynamoAdmissionStore(), scheduler)
+
+
+def rejected_response(error: AdmissionRejectedError, **extra) -> dict:
+    retry_after = int(error.retry_after + 0.999)
+    return {
+        "statusCode": 429,
+        "headers": {"Retry-After": str(retry_after)},
+        "body": json.dumps(
+            {"message": "server busy", "retryAfter": retry_after, **extra}
+        ),
+    }
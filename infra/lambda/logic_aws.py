@@ -0,0 +1,24 @@
+import boto3
+import threading
+
+# Clients and resources are created once per container and reused by warm
+# invocations. Creating them is not thread-safe, hence the lock.
+_lock = threading.Lock()
+_clients = {}
+_resources = {}
+
+
+def get_client(service_name: str):
+    with _lock:
+        client = _clients.get(service_name)
+        if client is None:
+            client = _clients[service_name] = boto3.client(service_name)
+    return client
+
+
+def get_resource(service_name: str):
+    with _lock:
+        resource = _resources.get(service_name)
+        if resource is None:
+            resource = _resources[service_name] = boto3.resource(service_name)
+    return resource
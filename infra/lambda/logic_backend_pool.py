@@ -0,0 +1,281 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Callable, List, Optional
+from urllib.parse import urlsplit
+from logic_sd_client import (
+    TRANSPORT_ERRORS,
+    SDServerError,
+    get_sd_client,
+    probe_sd_server,
+)
+from logic_progress import ProgressPoller
+from logic_circuit_breaker import CircuitBreaker, create_circuit_breaker
+
+REFRESH_INTERVAL = float(os.environ.get("BACKEND_REFRESH_INTERVAL", "60"))  # in sec
+HEALTH_CHECK_INTERVAL = float(os.environ.get("BACKEND_HEALTH_INTERVAL", "10"))
+HEALTH_CHECK_TIMEOUT = 2  # in sec
+EWMA_ALPHA = 0.3
+
+
+def _is_failover_error(error: Exception) -> bool:
+    # Connection failures and 5xx mean the request never ran or the server is
+    # broken, so another backend can take it. A timeout means the server is
+    # busy with it, sending it elsewhere would only double the work.
+    if isinstance(error, SDServerError):
+        return error.status >= 500
+    return isinstance(error, OSError) and not isinstance(error, socket.timeout)
+
+
+def discover_backend_urls() -> List[str]:
+    # SD_SERVER_URLS lists the backends explicitly. With SD_BACKEND_DISCOVERY=ec2
+    # every running tagged instance is used, on the scheme/port of SD_SERVER_URL.
+    urls = os.environ.get("SD_SERVER_URLS")
+    if urls:
+        return [url.strip() for url in urls.split(",") if url.strip()]
+
+    base_url = os.environ["SD_SERVER_URL"]
+    if os.environ.get("SD_BACKEND_DISCOVERY") != "ec2":
+        return [base_url]
+
+    from logic_server_controller import ServerController
+
+    parts = urlsplit(base_url)
+    port = f":{parts.port}" if parts.port else ""
+    urls = [
+        f"{parts.scheme}://{instance.private_ip_address}{port}{parts.path}"
+        for instance in ServerController().target_instances
+        if instance.state["Name"] == "running" and instance.private_ip_address
+    ]
+    # keep the configured server while nothing is running, e.g. during start up
+    return urls or [base_url]
+
+
+class Backend:
+    def __init__(self, url: str):
+        self.url = url
+        self.client = get_sd_client(url)
+        self.in_flight = 0
+        self.queued = 0  # jobs on the server, from /sdapi/v1/progress
+        self.latency = None  # EWMA of request latency, in sec
+        self.healthy = True
+        self.n_requests = 0
+        self.n_failures = 0
+
+    def load(self) -> tuple:
+        # fewest outstanding jobs first, faster backend on ties
+        return (max(self.in_flight, self.queued), self.latency or 0.0)
+
+    def to_dict(self) -> dict:
+        return {
+            "healthy": self.healthy,
+            "inFlight": self.in_flight,
+            "queued": self.queued,
+            "latency": self.latency,
+            "requests": self.n_requests,
+            "failures": self.n_failures,
+        }
+
+
+class BackendPool:
+    # Routes each SD request to the least loaded healthy backend and fails over
+    # to the next one. Shared by threads of a warm container. With a breaker,
+    # calls fail fast with ServerUnavailableError while every backend is down.
+    def __init__(
+        self,
+        discover=discover_backend_urls,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self._discover = discover
+        self.breaker = breaker
+        self._backends = {}
+        self._lock = threading.Lock()
+        self._refreshed_at = None
+        self._checked_at = None
+
+    @property
+    def backends(self) -> List[Backend]:
+        self._maybe_refresh()
+        return list(self._backends.values())
+
+    def _maybe_refresh(self):
+        now = time.monotonic()
+        with self._lock:
+            refresh = (
+                self._refreshed_at is None
+                or now - self._refreshed_at >= REFRESH_INTERVAL
+            )
+            check = (
+                not refresh
+                and self._checked_at is not None
+                and now - self._checked_at >= HEALTH_CHECK_INTERVAL
+            )
+            if refresh:
+                self._refreshed_at = now
+            if refresh or check:
+                self._checked_at = now
+        if refresh:
+            self.refresh()
+        elif check:
+            self.check_health()
+
+    def refresh(self):
+        try:
+            urls = self._discover()
+        except Exception as error:
+            # keep routing to the known backends
+            print(f"backend discovery failed: {error}")
+            return
+        with self._lock:
+            self._backends = {
+                url: self._backends.get(url) or Backend(url) for url in urls
+            }
+        print(f"sd backends: {', '.join(urls)}")
+
+    def check_health(self):
+        backends = list(self._backends.values())
+        if len(backends) < 2:
+            return  # nothing to choose from, failures show up on the request
+        with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+            list(executor.map(self._check_backend, backends))
+
+    def _check_backend(self, backend: Backend):
+        if not backend.healthy:
+            backend.healthy = probe_sd_server(backend.url, timeout=HEALTH_CHECK_TIMEOUT)
+            return
+        try:
+            progress = backend.client.get(
+                "/sdapi/v1/progress?skip_current_image=true",
+                timeout=HEALTH_CHECK_TIMEOUT,
+                retries=0,
+            )
+        except SDServerError as error:
+            backend.healthy = error.status < 500
+            return
+        except TRANSPORT_ERRORS:
+            backend.healthy = False
+            return
+        state = progress.get("state") or {}
+        backend.queued = max(int(state.get("job_count") or 0), 0)
+
+    def _pick(self, exclude: set) -> Optional[Backend]:
+        candidates = [b for b in self.backends if b.url not in exclude]
+        healthy = [b for b in candidates if b.healthy]
+        # if every backend looks down, try them anyway rather than fail up front
+        candidates = healthy or candidates
+        if not candidates:
+            return None
+        with self._lock:
+            backend = min(candidates, key=Backend.load)
+            backend.in_flight += 1
+        return backend
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        data: Optional[dict] = None,
+        on_progress: Optional[Callable[[dict], None]] = None,
+        **kwargs,
+    ):
+        # on_progress gets the progress of this call while it runs, data must
+        # then be an img2img payload
+        if self.breaker is not None:
+            self.breaker.check(self.probe)
+        if on_progress is not None:
+            # the task id the server reports the progress of this call under
+            task_id = uuid.uuid4().hex
+            data = dict(data, force_task_id=task_id)
+        tried = set()
+        last_error = None
+        while True:
+            backend = self._pick(tried)
+            if backend is None:
+                if last_error is not None and self.breaker is not None:
+                    # none of the backends could take it
+                    self.breaker.record_failure()
+                raise last_error or RuntimeError("no SD backend configured")
+            tried.add(backend.url)
+            start = time.perf_counter()
+            poller = nullcontext()
+            if on_progress is not None:
+                poller = ProgressPoller(
+                    backend.client, task_id, int(data.get("steps") or 0), on_progress
+                )
+            try:
+                with poller:
+                    result = backend.client.request(method, path, data, **kwargs)
+            except Exception as error:
+                with self._lock:
+                    backend.in_flight -= 1
+                    backend.n_failures += 1
+                if not _is_failover_error(error):
+                    raise
+                backend.healthy = False
+                print(f"sd backend {backend.url} failed, failing over: {error}")
+                last_error = error
+                continue
+
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                backend.in_flight -= 1
+                backend.n_requests += 1
+                backend.queued = max(backend.queued - 1, 0)
+                backend.healthy = True
+                if backend.latency is None:
+                    backend.latency = elapsed
+                else:
+                    backend.latency += EWMA_ALPHA * (elapsed - backend.latency)
+            if self.breaker is not None:
+                self.breaker.record_success()
+            return result
+
+    def get(self, path: str, **kwargs):
+        kwargs.setdefault("retries", 2)
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, data: dict, **kwargs):
+        return self.request("POST", path, data, **kwargs)
+
+    def probe(self) -> bool:
+        # asks every backend, marking the ones that do not answer unhealthy
+        backends = self.backends
+        with ThreadPoolExecutor(max_workers=max(len(backends), 1)) as executor:
+            results = list(executor.map(lambda b: probe_sd_server(b.url), backends))
+        for backend, healthy in zip(backends, results):
+            backend.healthy = healthy
+        return any(results)
+
+    def is_available(self) -> bool:
+        # from the breaker's cached state while it is recent enough
+        if self.breaker is None:
+            return self.probe()
+        return self.breaker.is_available(self.probe)
+
+    def check_available(self):
+        # raises ServerUnavailableError up front, before credit is reserved
+        if self.breaker is not None:
+            self.breaker.check(self.probe)
+
+    def stats(self) -> dict:
+        return {
+            backend.url: {**backend.to_dict(), **backend.client.stats()}
+            for backend in self._backends.values()
+        }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_backend_pool() -> BackendPool:
+    # one pool per container, reused across warm invocations
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BackendPool(breaker=create_circuit_breaker())
+    return _pool
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+RANDOM_SEED = -1
+
+
+def _digest(data: dict) -> str:
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def coalesce_key(data: dict) -> Optional[str]:
+    # identical requests with a fixed seed render the identical image
+    if data.get("seed", RANDOM_SEED) == RANDOM_SEED:
+        return None
+    return _digest(data)
+
+
+def batch_key(data: dict) -> Optional[str]:
+    # The SD API applies everything except init_images batch-wide (prompt, mask,
+    # ControlNet inputs, sampler, size...), and gives batch item i the seed
+    # seed + i. So only random-seed requests differing in init_images can share
+    # a call.
+    if data.get("seed", RANDOM_SEED) != RANDOM_SEED:
+        return None
+    if len(data.get("init_images", [])) != 1:
+        return None
+    if data.get("batch_size", 1) != 1 or data.get("n_iter", 1) != 1:
+        return None
+    rest = {k: v for k, v in data.items() if k != "init_images"}
+    return _digest(rest)
+
+
+class _PendingGroup:
+    def __init__(self, data: dict, created_at: float):
+        self.data = data
+        self.created_at = created_at
+        # one entry per distinct image; several futures when coalesced
+        self.init_images = []
+        self.futures = []  # type: List[List[Future]]
+        self.coalesced = {}
+        self.progress_callbacks = []
+        self.deadline = None  # the earliest of its requests'
+
+
+class BatchingDispatcher:
+    def __init__(
+        self,
+        send: Callable[[dict], List[str]],
+        window: float = 0.05,  # in sec
+        max_batch_size: int = 4,
+    ):
+        self._send = send
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._groups = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self.n_requests = 0
+        self.n_calls = 0
+
+    def submit(
+        self,
+        data: dict,
+        on_progress: Optional[Callable[[dict], None]] = None,
+        deadline: Optional[float] = None,
+    ) -> Future:
+        # on_progress is passed on to send(), once for the whole batch, and so
+        # is the earliest deadline (a time.monotonic()) of the batch
+        future = Future()
+        key = batch_key(data) or coalesce_key(data)
+        if key is None:
+            # nothing to share the call with, so do not wait for the window
+            with self._condition:
+                self.n_requests += 1
+            group = _PendingGroup(data, time.monotonic())
+            group.init_images.extend(data.get("init_images", []))
+            group.futures.append([future])
+            if on_progress is not None:
+                group.progress_callbacks.append(on_progress)
+            group.deadline = deadline
+            self._dispatch_later(group)
+            return future
+
+        with self._condition:
+            self.n_requests += 1
+            group = self._groups.get(key)
+            if group is None:
+                group = _PendingGroup(data, time.monotonic())
+                self._groups[key] = group
+
+            image_key = _digest({"image": data.get("init_images")})
+            index = group.coalesced.get(image_key)
+            if index is not None and coalesce_key(data) is not None:
+                group.futures[index].append(future)
+            else:
+                group.coalesced[image_key] = len(group.futures)
+                group.init_images.extend(data.get("init_images", []))
+                group.futures.append([future])
+            if on_progress is not None:
+                group.progress_callbacks.append(on_progress)
+            if deadline is not None:
+                group.deadline = min(deadline, group.deadline or deadline)
+
+            if len(group.futures) >= self._max_batch_size:
+                del self._groups[key]
+                self._dispatch_later(group)
+            else:
+                self._ensure_thread()
+            self._condition.notify()
+        return future
+
+    def request(
+        self,
+        data: dict,
+        timeout: Optional[float] = None,
+        on_progress: Optional[Callable[[dict], None]] = None,
+        deadline: Optional[float] = None,
+    ) -> str:
+        return self.submit(data, on_progress, deadline).result(timeout=timeout)
+
+    def _ensure_thread(self):
+        # called with the condition held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self._condition:
+            while self._groups:
+                now = time.monotonic()
+                expired = [
+                    key
+                    for key, group in self._groups.items()
+                    if now - group.created_at >= self._window
+                ]
+                for key in expired:
+                    self._dispatch_later(self._groups.pop(key))
+                if self._groups:
+                    oldest = min(g.created_at for g in self._groups.values())
+                    self._condition.wait(max(0.0, oldest + self._window - now))
+            self._thread = None
+
+    def _dispatch_later(self, group: _PendingGroup):
+        threading.Thread(target=self._dispatch, args=(group,), daemon=True).start()
+
+    def _dispatch(self, group: _PendingGroup):
+        data = dict(group.data)
+        batch_size = len(group.futures)
+        if batch_size > 1:
+            data["init_images"] = group.init_images
+            data["batch_size"] = batch_size
+        kwargs = {}
+        if group.progress_callbacks:
+            callbacks = group.progress_callbacks
+
+            def on_progress(progress: dict):
+                if batch_size > 1:
+                    # the preview of a batch shows the other requests' images
+                    progress = dict(progress, preview=None)
+                for callback in callbacks:
+                    callback(progress)
+
+            kwargs["on_progress"] = on_progress
+        if group.deadline is not None:
+            kwargs["deadline"] = group.deadline
+        self.n_calls += 1
+        try:
+            # ControlNet may append its detected maps after the generated images
+            images = self._send(data, **kwargs)[:batch_size]
+            if len(images) < batch_size:
+                raise RuntimeError(f"expected {batch_size} images, got {len(images)}")
+        except Exception as error:
+            for futures in group.futures:
+                for future in futures:
+                    future.set_exception(error)
+            return
+
+        print(f"dispatched batch of {batch_size} ({self.n_requests} requests so far)")
+        for image, futures in zip(images, group.futures):
+            for future in futures:
+                future.set_result(image)
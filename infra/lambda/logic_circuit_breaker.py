@@ -0,0 +1,256 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+from logic_aws import get_resource
+from logic_metrics import count
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# what the client is told while the circuit is open
+STARTING = "STARTING"
+UNAVAILABLE = "UNAVAILABLE"
+
+FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "2"))
+OPEN_INTERVAL = float(os.environ.get("CIRCUIT_OPEN_INTERVAL", "10"))  # in sec
+HEALTHY_MAX_AGE = float(os.environ.get("CIRCUIT_HEALTHY_MAX_AGE", "30"))  # in sec
+SHARED_REFRESH_INTERVAL = 5  # in sec
+AUTO_START = os.environ.get("CIRCUIT_AUTO_START", "0") == "1"
+
+
+class ServerUnavailableError(Exception):
+    def __init__(self, status: str, retry_after: float):
+        super().__init__(f"SD server {status.lower()}, retry in {retry_after:.0f}s")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    # Fails SD calls fast while the server is known to be down instead of
+    # letting each one wait for its connect timeout. Opens after
+    # failure_threshold failed calls in a row. After open_interval one caller
+    # probes the server (half-open) and closes the circuit if it answers;
+    # everyone else keeps failing fast meanwhile. Shared by the threads of a
+    # warm container and, with a store, by all the containers.
+    def __init__(
+        self,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        open_interval: float = OPEN_INTERVAL,
+        store=None,
+        on_open: Optional[Callable[[], str]] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.failure_threshold = failure_threshold
+        self.open_interval = open_interval
+        self._store = store
+        self._on_open = on_open  # -> STARTING or UNAVAILABLE
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.status = UNAVAILABLE
+        self.failures = 0
+        self.opened_at = None
+        self.checked_at = None  # last time the server answered
+        self.changed_at = 0.0
+        self._synced_at = None
+
+    def _retry_after(self, now: float) -> float:
+        return max(self.opened_at + self.open_interval - now, 1.0)
+
+    def _set(self, state: str, now: float, status: str = UNAVAILABLE):
+        self.state = state
+        self.status = status
+        self.changed_at = now
+        self.opened_at = now if state == OPEN else None
+        if state == CLOSED:
+            self.failures = 0
+
+    def _open(self, now: float):
+        status = UNAVAILABLE
+        if self._on_open is not None:
+            try:
+                status = self._on_open()
+            except Exception as error:
+                print(f"circuit open hook failed: {error}")
+        with self._lock:
+            self._set(OPEN, now, status)
+        print(f"sd circuit open, server {status.lower()}")
+        count("circuit.open")
+        self._publish()
+
+    def _close(self, now: float):
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            self._set(CLOSED, now)
+        print("sd circuit closed")
+        self._publish()
+
+    def _publish(self):
+        if self._store is None:
+            return
+        try:
+            self._store.put(
+                {
+                    "state": self.state,
+                    "status": self.status,
+                    "openedAt": self.opened_at,
+                    "changedAt": self.changed_at,
+                }
+            )
+        except Exception as error:
+            print(f"circuit state not shared: {error}")
+
+    def _sync(self, now: float):
+        # adopts what another container saw since our own last change
+        if self._store is None:
+            return
+        with self._lock:
+            if (
+                self._synced_at is not None
+                and now - self._synced_at < SHARED_REFRESH_INTERVAL
+            ):
+                return
+            self._synced_at = now
+        try:
+            shared = self._store.get()
+        except Exception as error:
+            print(f"shared circuit state not read: {error}")
+            return
+        if shared is None:
+            return
+        with self._lock:
+            if shared["changedAt"] <= self.changed_at or self.state == HALF_OPEN:
+                return
+            self.state = shared["state"]
+            self.status = shared["status"]
+            self.opened_at = shared["openedAt"]
+            self.changed_at = shared["changedAt"]
+            self.failures = 0
+
+    def check(self, probe: Callable[[], bool]):
+        # raises ServerUnavailableError while open. Once open_interval has
+        # passed, the first caller probes and goes ahead if that succeeds.
+        now = self._clock()
+        self._sync(now)
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN or now < self.opened_at + self.open_interval:
+                count("circuit.rejected")
+                raise ServerUnavailableError(self.status, self._retry_after(now))
+            self.state = HALF_OPEN
+        try:
+            available = probe()
+        except Exception as error:
+            print(f"sd probe failed: {error}")
+            available = False
+        now = self._clock()
+        if available:
+            self.checked_at = now
+            self._close(now)
+            return
+        self._open(now)
+        raise ServerUnavailableError(self.status, self._retry_after(now))
+
+    def record_success(self):
+        now = self._clock()
+        self.checked_at = now
+        with self._lock:
+            self.failures = 0
+        if self.state != CLOSED:
+            self._close(now)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            trip = self.state == CLOSED and self.failures >= self.failure_threshold
+        if trip:
+            self._open(self._clock())
+
+    def is_available(
+        self, probe: Callable[[], bool], max_age: float = HEALTHY_MAX_AGE
+    ) -> bool:
+        # without probing while the last answer is recent or the circuit open
+        try:
+            self.check(probe)
+        except ServerUnavailableError:
+            return False
+        now = self._clock()
+        if self.checked_at is not None and now - self.checked_at <= max_age:
+            return True
+        if probe():
+            self.record_success()
+            return True
+        self.record_failure()
+        return False
+
+    def snapshot(self) -> dict:
+        now = self._clock()
+        return {
+            "state": self.state,
+            "status": self.status if self.state != CLOSED else None,
+            "failures": self.failures,
+            "retryAfter": self._retry_after(now) if self.state == OPEN else None,
+            "checkedAgo": None if self.checked_at is None else now - self.checked_at,
+        }
+
+
+# the state is one item in the user table; last writer wins, which is fine
+# since every container converges on the next probe anyway
+class DynamoCircuitStore:
+    def __init__(self):
+        dynamodb = get_resource("dynamodb")
+        self._table = dynamodb.Table(os.environ["DYNAMO_TABLE_NAME"])
+        self._key = {"pk": "GLOBAL", "sk": "sdCircuit"}
+
+    def get(self) -> Optional[dict]:
+        item = self._table.get_item(Key=self._key).get("Item")
+        return None if item is None else json.loads(item["state"])
+
+    def put(self, state: dict):
+        self._table.put_item(Item={**self._key, "state": json.dumps(state)})
+
+
+def start_server_if_stopped() -> str:
+    # A stopped server is started (with CIRCUIT_AUTO_START=1). One that is
+    # pending or running but not answering yet is still booting.
+    from logic_server_controller import ServerController
+
+    server_controller = ServerController()
+    statuses = set(server_controller.get_instance_statuses().values())
+    if "STOPPED" in statuses and AUTO_START and not statuses & {"PENDING", "RUNNING"}:
+        server_controller.start()
+        print("instance started by the sd circuit breaker")
+        return STARTING
+    if statuses & {"PENDING", "RUNNING"}:
+        return STARTING
+    return UNAVAILABLE
+
+
+def create_circuit_breaker() -> CircuitBreaker:
+    store = DynamoCircuitStore() if os.environ.get("DYNAMO_TABLE_NAME") else None
+    on_open = None
+    if os.environ.get("SD_BACKEND_DISCOVERY") == "ec2":
+        on_open = start_server_if_stopped
+    return CircuitBreaker(store=store, on_open=on_open)
+
+
+def unavailable_response(error: ServerUnavailableError, **extra) -> dict:
+    retry_after = int(error.retry_after + 0.999)
+    message = "server starting" if error.status == STARTING else "server unavailable"
+    return {
+        "statusCode": 503,
+        "headers": {"Retry-After": str(retry_after)},
+        "body": json.dumps(
+            {
+                "message": message,
+                "status": error.status,
+                "retryAfter": retry_after,
+                **extra,
+            }
+        ),
+    }
@@ -0,0 +1,240 @@
+import base64
+import math
+import threading
+from typing import List, NamedTuple, Optional, Tuple
+import cv2
+import numpy as np
+from logic_image_store import strip_data_url
+from logic_mask import decode_compact_mask, is_compact_mask
+
+# scratch buffers reused across warm invocations, one per name that grows to
+# the largest size asked for, so that bboxes of varying shapes share it.
+# Per thread, since generate_worker filters several jobs at once.
+_local = threading.local()
+
+
+def _buffer(name: str, shape: tuple, dtype) -> np.ndarray:
+    buffers = getattr(_local, "buffers", None)
+    if buffers is None:
+        buffers = _local.buffers = {}
+    dtype = np.dtype(dtype)
+    n_bytes = int(np.prod(shape)) * dtype.itemsize
+    buffer = buffers.get(name)
+    if buffer is None or buffer.size < n_bytes:
+        buffer = buffers[name] = np.empty(n_bytes, dtype=np.uint8)
+    return buffer[:n_bytes].view(dtype).reshape(shape)
+
+
+def decode_image(data: str) -> np.ndarray:
+    # BGR as OpenCV decodes it; the filters here are channel-order agnostic
+    buf = np.frombuffer(base64.b64decode(strip_data_url(data)), dtype=np.uint8)
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+
+def encode_image(image: np.ndarray) -> str:
+    _, buf = cv2.imencode(".png", image)
+    return base64.b64encode(buf).decode()
+
+
+def decode_mask(data, size: Tuple[int, int]) -> np.ndarray:
+    # binary uint8 mask (0/255) resized to size=(width, height), from a PNG
+    # or a compact mask (logic_mask.py)
+    if is_compact_mask(data):
+        return decode_compact_mask(data, size)
+    buf = np.frombuffer(base64.b64decode(strip_data_url(data)), dtype=np.uint8)
+    mask = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+    if (mask.shape[1], mask.shape[0]) != size:
+        mask = cv2.resize(mask, size)
+    _, mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+    return mask
+
+
+def mask_bbox(mask: np.ndarray, margin: int = 0) -> Optional[Tuple[int, int, int, int]]:
+    # (top, bottom, left, right) of the nonzero region plus margin, clipped
+    rows = np.flatnonzero(mask.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    height, width = mask.shape[:2]
+    return (
+        max(int(rows[0]) - margin, 0),
+        min(int(rows[-1]) + 1 + margin, height),
+        max(int(cols[0]) - margin, 0),
+        min(int(cols[-1]) + 1 + margin, width),
+    )
+
+
+def anti_glare_filter(
+    image: np.ndarray,
+    mask: np.ndarray,
+    flags: int,
+    sigma_s: float,
+    sigma_r: float,
+    mask_blur: int = 0,
+) -> np.ndarray:
+    # Filters image in place where mask is set. Only the mask's bounding box
+    # plus the filter's reach is processed, since the edge preserving filter
+    # does not propagate much further than ~3 * sigma_s pixels.
+    margin = int(math.ceil(3 * sigma_s)) + mask_blur
+    bbox = mask_bbox(mask, margin)
+    if bbox is None:
+        return image
+    top, bottom, left, right = bbox
+
+    roi = image[top:bottom, left:right]
+    mask_roi = mask[top:bottom, left:right]
+    filtered = cv2.edgePreservingFilter(
+        roi,
+        dst=_buffer("filtered", roi.shape, np.uint8),
+        flags=flags,
+        sigma_s=sigma_s,
+        sigma_r=sigma_r,
+    )
+
+    blend_masked(roi, filtered, mask_roi, mask_blur)
+    return image
+
+
+def blend_masked(dst: np.ndarray, src: np.ndarray, mask: np.ndarray, blur: int = 0):
+    # dst = src where mask is set, feathered over blur pixels when blur > 0
+    if blur <= 0:
+        np.copyto(dst, src, where=mask[..., None] > 0)
+        return
+
+    ksize = 2 * blur + 1
+    alpha = _buffer("alpha", mask.shape, np.float32)
+    np.multiply(mask, 1.0 / 255, out=alpha, casting="unsafe")
+    cv2.GaussianBlur(alpha, (ksize, ksize), 0, dst=alpha)
+    inverse = _buffer("inverse", mask.shape, np.float32)
+    np.subtract(1.0, alpha, out=inverse)
+    dst[...] = cv2.blendLinear(src, dst, alpha, inverse)
+
+
+def downscale(image: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    # resize to size=(width, height); never upscales, the SD server does that
+    height, width = image.shape[:2]
+    if size[0] >= width and size[1] >= height:
+        return image
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def resize(image: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    height, width = image.shape[:2]
+    if (width, height) == size:
+        return image
+    shrink = size[0] * size[1] < width * height
+    interpolation = cv2.INTER_AREA if shrink else cv2.INTER_CUBIC
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+class Tile(NamedTuple):
+    # pixel rect in the image, and by how many pixels it overlaps the
+    # neighbouring tiles of the grid on each side (0 at the image border)
+    top: int
+    bottom: int
+    left: int
+    right: int
+    overlap_top: int
+    overlap_bottom: int
+    overlap_left: int
+    overlap_right: int
+
+
+def _tile_starts(start: int, end: int, length: int, size: int, overlap: int) -> list:
+    # tiles of size covering [start, end) of [0, length), the last one flush
+    # with end. A range shorter than a tile is centred in one, for context.
+    if end - start <= size:
+        return [min(max(start - (size - (end - start)) // 2, 0), length - size)]
+    return list(range(start, end - size, size - overlap)) + [end - size]
+
+
+def plan_tiles(mask: np.ndarray, size: int, overlap: int) -> List[Tile]:
+    # Overlapping tiles of size x size (smaller if the image is) over the
+    # mask's bounding box, in raster order, keeping only those with mask
+    # pixels. A masked pixel is in every tile of the grid that covers it.
+    height, width = mask.shape[:2]
+    bbox = mask_bbox(mask, overlap)
+    if bbox is None:
+        return []
+    top, bottom, left, right = bbox
+    tile_height, tile_width = min(size, height), min(size, width)
+    ys = _tile_starts(top, bottom, height, tile_height, overlap)
+    xs = _tile_starts(left, right, width, tile_width, overlap)
+
+    def _overlaps(starts: list, i: int, tile_size: int) -> tuple:
+        before = starts[i - 1] + tile_size - starts[i] if i > 0 else 0
+        after = starts[i] + tile_size - starts[i + 1] if i + 1 < len(starts) else 0
+        return before, after
+
+    tiles = []
+    for row, y in enumerate(ys):
+        for col, x in enumerate(xs):
+            if mask[y : y + tile_height, x : x + tile_width].any():
+                tiles.append(
+                    Tile(
+                        y,
+                        y + tile_height,
+                        x,
+                        x + tile_width,
+                        *_overlaps(ys, row, tile_height),
+                        *_overlaps(xs, col, tile_width),
+                    )
+                )
+    return tiles
+
+
+def _ramp(length: int, before: int, after: int) -> np.ndarray:
+    # 1 in the middle, falling off linearly towards the overlapped ends
+    ramp = np.ones(length, dtype=np.float32)
+    if before:
+        ramp[:before] = (np.arange(before, dtype=np.float32) + 0.5) / before
+    if after:
+        ramp[length - after :] = np.minimum(
+            ramp[length - after :],
+            (np.arange(after, 0, -1, dtype=np.float32) - 0.5) / after,
+        )
+    return ramp
+
+
+def tile_weight(tile: Tile, top: int, bottom: int, left: int, right: int):
+    # the tile's blending weight over the rect, which must lie within it
+    ys = _ramp(tile.bottom - tile.top, tile.overlap_top, tile.overlap_bottom)
+    xs = _ramp(tile.right - tile.left, tile.overlap_left, tile.overlap_right)
+    return np.outer(
+        ys[top - tile.top : bottom - tile.top],
+        xs[left - tile.left : right - tile.left],
+    )
+
+
+def blend_tile(
+    dst: np.ndarray,
+    src: np.ndarray,
+    mask: np.ndarray,
+    tile: Tile,
+    before: List[Tile],
+    blur: int = 0,
+):
+    # Blends the rendered tile into dst (the tile's rect of the image) where
+    # mask is set. Overlaps get the weighted average of the tiles covering
+    # them, with weights fading out towards each tile's edges, accumulated
+    # one tile at a time given the tiles blended before this one.
+    weight = tile_weight(tile, *tile[:4])
+    total = _buffer("tile_total", mask.shape, np.float32)
+    total[...] = weight
+    for other in before:
+        top, bottom = max(tile.top, other.top), min(tile.bottom, other.bottom)
+        left, right = max(tile.left, other.left), min(tile.right, other.right)
+        if top < bottom and left < right:
+            total[
+                top - tile.top : bottom - tile.top, left - tile.left : right - tile.left
+            ] += tile_weight(other, top, bottom, left, right)
+    alpha = _buffer("tile_alpha", mask.shape, np.float32)
+    np.multiply(mask, 1.0 / 255, out=alpha, casting="unsafe")
+    if blur > 0:
+        ksize = 2 * blur + 1
+        cv2.GaussianBlur(alpha, (ksize, ksize), 0, dst=alpha)
+    alpha *= weight
+    alpha /= total
+    inverse = _buffer("tile_inverse", mask.shape, np.float32)
+    np.subtract(1.0, alpha, out=inverse)
+    dst[...] = cv2.blendLinear(src, dst, alpha, inverse)
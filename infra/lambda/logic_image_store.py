@@ -0,0 +1,95 @@
+import hashlib
+import os
+import string
+from typing import Iterable, List, Optional
+from logic_result_cache import LRUCacheBackend, S3CacheBackend
+from logic_metrics import timed
+
+# a request field holding "handle:<sha256>" refers to an uploaded image
+HANDLE_PREFIX = "handle:"
+DEFAULT_TTL = 60 * 60 * 24  # in sec
+DEFAULT_MAX_BYTES = 128 * 1024 * 1024
+
+
+class ImageNotFoundError(Exception):
+    # expired or never uploaded, the client uploads the image again
+    def __init__(self, handles: List[str]):
+        super().__init__(f"unknown image handles: {', '.join(handles)}")
+        self.handles = handles
+
+
+def strip_data_url(img_str: str) -> str:
+    # "data:image/png;base64,iVBOR..." -> "iVBOR...", the SD server takes both
+    if img_str.startswith("data:"):
+        return img_str.split(",", 1)[1]
+    return img_str
+
+
+def image_handle(img_str: str) -> str:
+    # the same pixels uploaded as a data URL or as a file get the same handle
+    return hashlib.sha256(strip_data_url(img_str).encode()).hexdigest()
+
+
+def is_handle_reference(value) -> bool:
+    return isinstance(value, str) and value.startswith(HANDLE_PREFIX)
+
+
+def _is_valid_handle(handle: str) -> bool:
+    return len(handle) == 64 and all(c in string.hexdigits for c in handle)
+
+
+class ImageStore:
+    # Content-addressed base64 images, looked up in the backends in order,
+    # e.g. warm-container memory first, then S3 shared by all the Lambdas.
+    def __init__(self, backends: List, ttl: float = DEFAULT_TTL):
+        self._backends = backends
+        self._ttl = ttl
+
+    @timed("image_store.put")
+    def put(self, img_str: str) -> str:
+        value = strip_data_url(img_str).encode()
+        handle = hashlib.sha256(value).hexdigest()
+        if self._backends and self._backends[0].get(handle) is not None:
+            return handle  # stored by this container already, S3 has it too
+        for backend in self._backends:
+            backend.put(handle, value, self._ttl)
+        return handle
+
+    @timed("image_store.get")
+    def get(self, handle: str) -> Optional[str]:
+        if not _is_valid_handle(handle):
+            return None
+        for i, backend in enumerate(self._backends):
+            value = backend.get(handle)
+            if value is not None:
+                for upper in self._backends[:i]:
+                    upper.put(handle, value, self._ttl)
+                return value.decode()
+        return None
+
+    def resolve(self, body: dict, fields: Iterable[str]) -> dict:
+        # replaces "handle:<sha256>" in the given fields with the image itself
+        resolved = {}
+        missing = []
+        for name in fields:
+            value = body.get(name)
+            if not is_handle_reference(value):
+                continue
+            handle = value[len(HANDLE_PREFIX) :]
+            img_str = self.get(handle)
+            if img_str is None:
+                missing.append(handle)
+            resolved[name] = img_str
+        if missing:
+            raise ImageNotFoundError(missing)
+        return {**body, **resolved} if resolved else body
+
+
+def create_image_store() -> ImageStore:
+    backends = [
+        LRUCacheBackend(int(os.environ.get("IMAGE_STORE_MAX_BYTES", DEFAULT_MAX_BYTES)))
+    ]
+    bucket_name = os.environ.get("WORK_BUCKET_NAME")
+    if bucket_name:
+        backends.append(S3CacheBackend(bucket_name, prefix="images/"))
+    return ImageStore(backends, float(os.environ.get("IMAGE_STORE_TTL", DEFAULT_TTL)))
@@ -0,0 +1,427 @@
+from decimal import Decimal
+import hashlib
+import json
+import os
+import queue
+import threading
+from typing import Optional, Tuple
+from datetime import datetime
+from boto3.dynamodb.types import TypeDeserializer
+from logic_storage import upload_file_to_s3, download_file_from_s3
+from logic_aws import get_client, get_resource
+
+JOB_QUEUED = "QUEUED"
+JOB_RUNNING = "RUNNING"
+JOB_SUCCEEDED = "SUCCEEDED"
+JOB_FAILED = "FAILED"
+
+JOB_RETENTION = 60 * 60 * 24  # in sec
+# A job RUNNING for longer than the worker's Lambda timeout lost its worker,
+# so a redelivery of its message may claim it again; in sec
+JOB_RUN_TIMEOUT = float(os.environ.get("JOB_RUN_TIMEOUT", "300"))
+
+# progress fields of a running job, see logic_progress.parse_progress
+PROGRESS_FIELDS = ("progress", "etaRelative", "step", "steps", "previewStep")
+
+
+def compute_request_hash(body: dict) -> str:
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def is_active_job(job: Optional[dict]) -> bool:
+    return job is not None and job["status"] in (JOB_QUEUED, JOB_RUNNING)
+
+
+def _now() -> float:
+    return datetime.utcnow().timestamp()
+
+
+def is_claimable(job: dict, now: Optional[float] = None) -> bool:
+    # SQS delivers at least once, so a message may come for a job that is
+    # running elsewhere or already done; only a queued job, or a running one
+    # whose worker died, is run
+    if job["status"] == JOB_QUEUED:
+        return True
+    if now is None:
+        now = _now()
+    return job["status"] == JOB_RUNNING and job["startedAt"] < now - JOB_RUN_TIMEOUT
+
+
+def job_latency(job: dict) -> dict:
+    # wait: queued -> picked up by a worker, run: picked up -> finished
+    enqueued_at = job.get("enqueuedAt")
+    started_at = job.get("startedAt")
+    finished_at = job.get("finishedAt")
+    wait_time = None
+    run_time = None
+    if enqueued_at is not None:
+        wait_time = float((started_at or _now()) - enqueued_at)
+    if started_at is not None:
+        run_time = float((finished_at or _now()) - started_at)
+    return {"waitTime": wait_time, "runTime": run_time}
+
+
+# in-process queue with the same interface as SqsJobQueue, for local runs
+class InMemoryJobQueue:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self, username: str, body: dict, credit: Optional[int] = None
+    ) -> Tuple[dict, bool]:
+        job_id = compute_request_hash(body)
+        with self._lock:
+            job = self._jobs.get((username, job_id))
+            if is_active_job(job):
+                return job, False
+            job = {
+                "jobId": job_id,
+                "username": username,
+                "status": JOB_QUEUED,
+                "enqueuedAt": _now(),
+                "body": body,
+            }
+            if credit is not None:
+                job["credit"] = credit
+            self._jobs[(username, job_id)] = job
+        self._queue.put((username, job_id))
+        return job, True
+
+    def submit_completed(self, username: str, body: dict, result: dict) -> dict:
+        job_id = compute_request_hash(body)
+        with self._lock:
+            job = self._jobs.get((username, job_id))
+            if is_active_job(job):
+                return job
+            now = _now()
+            job = {
+                "jobId": job_id,
+                "username": username,
+                "status": JOB_SUCCEEDED,
+                "enqueuedAt": now,
+                "startedAt": now,
+                "finishedAt": now,
+                "body": body,
+                "result": result,
+            }
+            self._jobs[(username, job_id)] = job
+        return job
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[dict]:
+        try:
+            username, job_id = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return self.get(username, job_id)
+
+    def get(self, username: str, job_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._jobs.get((username, job_id))
+
+    def get_request_body(self, job: dict) -> dict:
+        return job["body"]
+
+    def get_result(self, job: dict) -> Optional[dict]:
+        return job.get("result")
+
+    def claim(self, job: dict) -> bool:
+        with self._lock:
+            if not is_claimable(job):
+                return False
+            job.update(status=JOB_RUNNING, startedAt=_now())
+        return True
+
+    def update_progress(self, job: dict, progress: dict):
+        with self._lock:
+            job.update({k: v for k, v in progress.items() if k != "preview"})
+            if progress.get("preview"):
+                job.update(preview=progress["preview"], previewStep=progress["step"])
+
+    def get_preview(self, job: dict) -> Optional[dict]:
+        if "preview" not in job:
+            return None
+        return {"image": job["preview"], "step": job["previewStep"]}
+
+    def mark_succeeded(self, job: dict, result: dict):
+        with self._lock:
+            job.update(status=JOB_SUCCEEDED, finishedAt=_now(), result=result)
+
+    def mark_failed(self, job: dict, error: str) -> bool:
+        with self._lock:
+            if job["status"] not in (JOB_QUEUED, JOB_RUNNING):
+                return False
+            job.update(status=JOB_FAILED, finishedAt=_now(), error=error)
+        return True
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+
+# job records live in the user table, payloads in S3 and job ids in SQS
+class SqsJobQueue:
+    def __init__(self):
+        dynamodb = get_resource("dynamodb")
+        self._table = dynamodb.Table(os.environ["DYNAMO_TABLE_NAME"])
+        self._sqs = get_client("sqs")
+        self._queue_url = os.environ["JOB_QUEUE_URL"]
+        self._bucket_name = os.environ["WORK_BUCKET_NAME"]
+
+    @staticmethod
+    def _key(username: str, job_id: str) -> dict:
+        return {"pk": "JOB#" + username, "sk": job_id}
+
+    @staticmethod
+    def _object_key(username: str, job_id: str, name: str) -> str:
+        return f"jobs/{username}/{job_id}/{name}.json"
+
+    @staticmethod
+    def _from_item(item: dict) -> dict:
+        job = {
+            "jobId": item["sk"],
+            "username": item["pk"][len("JOB#") :],
+            "status": item["status"],
+        }
+        for name in (
+            "enqueuedAt",
+            "startedAt",
+            "finishedAt",
+            "progress",
+            "etaRelative",
+        ):
+            if name in item:
+                job[name] = float(item[name])
+        for name in ("step", "steps", "previewStep", "credit"):
+            if name in item:
+                job[name] = int(item[name])
+        if "error" in item:
+            job["error"] = item["error"]
+        return job
+
+    def submit(
+        self, username: str, body: dict, credit: Optional[int] = None
+    ) -> Tuple[dict, bool]:
+        # credit: what was reserved for the job, refunded if it fails.
+        # Returns the job and whether this call created it; False when the same
+        # request is still active, e.g. submitted twice by a double click
+        job_id = compute_request_hash(body)
+
+        # payloads carry base64 images and easily exceed the item/message limits
+        upload_file_to_s3(
+            json.dumps(body).encode(),
+            self._bucket_name,
+            self._object_key(username, job_id, "request"),
+        )
+        enqueued_at = _now()
+        item = {
+            **self._key(username, job_id),
+            "status": JOB_QUEUED,
+            "enqueuedAt": Decimal(str(enqueued_at)),
+            "expiresAt": Decimal(int(enqueued_at) + JOB_RETENTION),
+        }
+        if credit is not None:
+            item["credit"] = Decimal(credit)
+        try:
+            # conditional, as a get beforehand would let two identical submits
+            # both find no active job and both queue it
+            self._table.put_item(
+                Item=item,
+                ConditionExpression=(
+                    "attribute_not_exists(pk) OR NOT #status IN (:queued, :running)"
+                ),
+                ExpressionAttributeNames={"#status": "status"},
+                ExpressionAttributeValues={
+                    ":queued": JOB_QUEUED,
+                    ":running": JOB_RUNNING,
+                },
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+        except (
+            self._table.meta.client.exceptions.ConditionalCheckFailedException
+        ) as error:
+            item = error.response.get("Item")
+            if item is None:
+                return self.get(username, job_id), False
+            deserializer = TypeDeserializer()
+            return (
+                self._from_item(
+                    {k: deserializer.deserialize(v) for k, v in item.items()}
+                ),
+                False,
+            )
+        self._sqs.send_message(
+            QueueUrl=self._queue_url,
+            MessageBody=json.dumps({"username": username, "jobId": job_id}),
+        )
+        job = {
+            "jobId": job_id,
+            "username": username,
+            "status": JOB_QUEUED,
+            "enqueuedAt": enqueued_at,
+        }
+        if credit is not None:
+            job["credit"] = credit
+        return job, True
+
+    def submit_completed(self, username: str, body: dict, result: dict) -> dict:
+        # a job that is done as soon as it is submitted, e.g. served from the
+        # result cache, so that async clients poll for it as for any other
+        job_id = compute_request_hash(body)
+        job = self.get(username, job_id)
+        if is_active_job(job):
+            return job
+
+        upload_file_to_s3(
+            json.dumps(result).encode(),
+            self._bucket_name,
+            self._object_key(username, job_id, "result"),
+        )
+        now = _now()
+        self._table.put_item(
+            Item={
+                **self._key(username, job_id),
+                "status": JOB_SUCCEEDED,
+                "enqueuedAt": Decimal(str(now)),
+                "startedAt": Decimal(str(now)),
+                "finishedAt": Decimal(str(now)),
+                "expiresAt": Decimal(int(now) + JOB_RETENTION),
+            }
+        )
+        return {
+            "jobId": job_id,
+            "username": username,
+            "status": JOB_SUCCEEDED,
+            "enqueuedAt": now,
+            "startedAt": now,
+            "finishedAt": now,
+        }
+
+    def from_message(self, message_body: str) -> Optional[dict]:
+        message = json.loads(message_body)
+        return self.get(message["username"], message["jobId"])
+
+    def get(self, username: str, job_id: str) -> Optional[dict]:
+        response = self._table.get_item(Key=self._key(username, job_id))
+        item = response.get("Item")
+        if item is None:
+            return None
+        return self._from_item(item)
+
+    def get_request_body(self, job: dict) -> dict:
+        return json.loads(
+            download_file_from_s3(
+                self._bucket_name,
+                self._object_key(job["username"], job["jobId"], "request"),
+            )
+        )
+
+    def get_result(self, job: dict) -> Optional[dict]:
+        if job["status"] != JOB_SUCCEEDED:
+            return None
+        return json.loads(
+            download_file_from_s3(
+                self._bucket_name,
+                self._object_key(job["username"], job["jobId"], "result"),
+            )
+        )
+
+    def _update_status(self, job: dict, status: str, **attributes):
+        self._update(job, status=status, **attributes)
+
+    def _update(self, job: dict, **attributes):
+        updates = {}
+        for name, value in attributes.items():
+            if isinstance(value, float):
+                value = Decimal(str(value))
+            updates[name] = {"Value": value, "Action": "PUT"}
+        self._table.update_item(
+            Key=self._key(job["username"], job["jobId"]),
+            AttributeUpdates=updates,
+        )
+        job.update(**attributes)
+
+    def _update_if_unchanged(self, job: dict, status: str, **attributes) -> bool:
+        # moves the job to status unless its record changed since this worker
+        # read it, e.g. because another delivery of its message claimed it
+        condition = "#status = :status AND "
+        values = {":status": job["status"], ":new_status": status}
+        if "startedAt" in job:
+            condition += "startedAt = :started_at"
+            values[":started_at"] = Decimal(str(job["startedAt"]))
+        else:
+            condition += "attribute_not_exists(startedAt)"
+        names = {"#status": "status"}
+        sets = ["#status = :new_status"]
+        for i, (name, value) in enumerate(attributes.items()):
+            names[f"#a{i}"] = name
+            values[f":a{i}"] = (
+                Decimal(str(value)) if isinstance(value, float) else value
+            )
+            sets.append(f"#a{i} = :a{i}")
+        try:
+            self._table.update_item(
+                Key=self._key(job["username"], job["jobId"]),
+                UpdateExpression="SET " + ", ".join(sets),
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        job.update(status=status, **attributes)
+        return True
+
+    def claim(self, job: dict) -> bool:
+        # QUEUED (or RUNNING without a worker) -> RUNNING for one worker only
+        if not is_claimable(job):
+            return False
+        return self._update_if_unchanged(job, JOB_RUNNING, startedAt=_now())
+
+    def update_progress(self, job: dict, progress: dict):
+        # the preview image goes to S3, the small numbers to the job record
+        attributes = {k: v for k, v in progress.items() if k != "preview"}
+        if progress.get("preview"):
+            upload_file_to_s3(
+                json.dumps(
+                    {"image": progress["preview"], "step": progress["step"]}
+                ).encode(),
+                self._bucket_name,
+                self._object_key(job["username"], job["jobId"], "preview"),
+            )
+            attributes["previewStep"] = progress["step"]
+        self._update(job, **attributes)
+
+    def get_preview(self, job: dict) -> Optional[dict]:
+        if "previewStep" not in job:
+            return None
+        return json.loads(
+            download_file_from_s3(
+                self._bucket_name,
+                self._object_key(job["username"], job["jobId"], "preview"),
+            )
+        )
+
+    def mark_succeeded(self, job: dict, result: dict):
+        upload_file_to_s3(
+            json.dumps(result).encode(),
+            self._bucket_name,
+            self._object_key(job["username"], job["jobId"], "result"),
+        )
+        self._update_status(job, JOB_SUCCEEDED, finishedAt=_now())
+
+    def mark_failed(self, job: dict, error: str) -> bool:
+        # False when the job is no longer this worker's to fail
+        if job["status"] not in (JOB_QUEUED, JOB_RUNNING):
+            return False
+        return self._update_if_unchanged(
+            job, JOB_FAILED, finishedAt=_now(), error=error
+        )
+
+    def depth(self) -> int:
+        response = self._sqs.get_queue_attributes(
+            QueueUrl=self._queue_url,
+            AttributeNames=["ApproximateNumberOfMessages"],
+        )
+        return int(response["Attributes"]["ApproximateNumberOfMessages"])
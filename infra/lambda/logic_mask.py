@@ -0,0 +1,200 @@
+import base64
+import binascii
+import zlib
+from typing import Optional, Tuple
+import numpy as np
+
+# A binary mask sent as JSON instead of a full resolution RGBA PNG:
+#   {"format": "rle" | "bits", "width": W, "height": H,
+#    "bbox": [top, bottom, left, right], "data": "<base64>"}
+# The pixels outside bbox (default: the whole mask) are unset. Inside it,
+# row-major, "rle" holds the lengths of alternating unset/set runs, starting
+# with unset, as LEB128 varints, and "bits" one bit per pixel, MSB first.
+MASK_FORMATS = ("rle", "bits")
+MAX_SIZE = 8192
+MAX_VARINT_BYTES = 4  # runs up to 2**28 pixels
+
+
+class MaskFormatError(ValueError):
+    pass
+
+
+def is_compact_mask(value) -> bool:
+    return isinstance(value, dict) and "format" in value
+
+
+def _is_int(value) -> bool:
+    # JSON true/false arrive as bools, which are ints to isinstance()
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _header(mask: dict) -> Tuple[int, int, Tuple[int, int, int, int]]:
+    if mask.get("format") not in MASK_FORMATS:
+        raise MaskFormatError(f"unknown mask format {mask.get('format')!r}")
+    width, height = mask.get("width"), mask.get("height")
+    for value in (width, height):
+        if not _is_int(value) or not 0 < value <= MAX_SIZE:
+            raise MaskFormatError(f"invalid mask size {width}x{height}")
+    bbox = mask.get("bbox")
+    if bbox is None:
+        bbox = (0, height, 0, width)
+    if (
+        not isinstance(bbox, (list, tuple))
+        or len(bbox) != 4
+        or not all(_is_int(v) for v in bbox)
+    ):
+        raise MaskFormatError(f"invalid mask bbox {bbox!r}")
+    top, bottom, left, right = bbox
+    if not (0 <= top <= bottom <= height and 0 <= left <= right <= width):
+        raise MaskFormatError(f"mask bbox {bbox} outside {width}x{height}")
+    return width, height, (top, bottom, left, right)
+
+
+def _data(mask: dict) -> np.ndarray:
+    try:
+        raw = base64.b64decode(mask.get("data") or "", validate=True)
+    except (binascii.Error, TypeError) as error:
+        raise MaskFormatError(f"invalid mask data: {error}")
+    return np.frombuffer(raw, dtype=np.uint8)
+
+
+def _decode_varints(buf: np.ndarray) -> np.ndarray:
+    if buf.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    if buf[-1] & 0x80:
+        raise MaskFormatError("truncated run length")
+    ends = np.flatnonzero(buf < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    lengths = ends - starts + 1
+    if lengths.max() > MAX_VARINT_BYTES:
+        raise MaskFormatError("run length too long")
+    position = np.arange(buf.size) - np.repeat(starts, lengths)
+    values = (buf & 0x7F).astype(np.int64) << (7 * position)
+    return np.add.reduceat(values, starts)
+
+
+def _encode_varints(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    n_bytes = np.ones(values.size, dtype=np.int64)
+    for i in range(1, MAX_VARINT_BYTES):
+        n_bytes += values >= 1 << (7 * i)
+    groups = (values[:, None] >> (7 * np.arange(n_bytes.max(initial=1)))) & 0x7F
+    more = np.arange(groups.shape[1]) < (n_bytes - 1)[:, None]
+    groups |= more * 0x80
+    return groups[np.arange(groups.shape[1]) < n_bytes[:, None]].astype(np.uint8)
+
+
+def validate_compact_mask(mask: dict):
+    # raises MaskFormatError, cheap enough to run before any credit is spent
+    width, height, (top, bottom, left, right) = _header(mask)
+    area = (bottom - top) * (right - left)
+    buf = _data(mask)
+    if mask["format"] == "bits":
+        if buf.size < (area + 7) // 8:
+            raise MaskFormatError(f"{buf.size} bytes for {area} mask bits")
+    elif int(_decode_varints(buf).sum()) != area:
+        raise MaskFormatError(f"mask runs do not cover the {area} bbox pixels")
+
+
+def decode_compact_mask(mask: dict, size: Optional[Tuple[int, int]] = None):
+    # binary uint8 mask (0/255) sampled at size=(width, height), nearest
+    # neighbour, without expanding the full resolution mask first
+    width, height, (top, bottom, left, right) = _header(mask)
+    out_width, out_height = size or (width, height)
+    out = np.zeros((out_height, out_width), dtype=np.uint8)
+    # the source pixel at the centre of each output pixel
+    rows = (np.arange(out_height) * 2 + 1) * height // (2 * out_height)
+    cols = (np.arange(out_width) * 2 + 1) * width // (2 * out_width)
+    out_rows = np.flatnonzero((rows >= top) & (rows < bottom))
+    out_cols = np.flatnonzero((cols >= left) & (cols < right))
+    if out_rows.size == 0 or out_cols.size == 0:
+        return out
+    rows, cols = rows[out_rows] - top, cols[out_cols] - left
+    region_width = right - left
+    area = (bottom - top) * region_width
+    buf = _data(mask)
+
+    if mask["format"] == "bits":
+        if buf.size < (area + 7) // 8:
+            raise MaskFormatError(f"{buf.size} bytes for {area} mask bits")
+        bits = np.unpackbits(buf, count=area).reshape(-1, region_width)
+        out[np.ix_(out_rows, out_cols)] = bits[np.ix_(rows, cols)] * 255
+        return out
+
+    counts = _decode_varints(buf)
+    ends = np.cumsum(counts)
+    if ends.size == 0 or ends[-1] != area:
+        raise MaskFormatError(f"mask runs do not cover the {area} bbox pixels")
+    if (out_width, out_height) == (width, height):
+        # same resolution, expanding the runs is cheaper than a lookup each
+        values = np.zeros(counts.size, dtype=np.uint8)
+        values[1::2] = 255
+        region = np.repeat(values, counts).reshape(-1, region_width)
+    else:
+        index = rows[:, None] * region_width + cols[None, :]
+        # odd runs are set
+        region = (np.searchsorted(ends, index, side="right") & 1).astype(np.uint8)
+        region *= 255
+    out[np.ix_(out_rows, out_cols)] = region
+    return out
+
+
+def encode_compact_mask(mask: np.ndarray, fmt: str = "rle") -> dict:
+    # the inverse of decode_compact_mask() for a mask thresholded at 127,
+    # relative to the bounding box of its set pixels
+    if fmt not in MASK_FORMATS:
+        raise MaskFormatError(f"unknown mask format {fmt!r}")
+    binary = mask > 127
+    height, width = binary.shape[:2]
+    rows = np.flatnonzero(binary.any(axis=1))
+    cols = np.flatnonzero(binary.any(axis=0))
+    if rows.size == 0:
+        bbox = (0, 0, 0, 0)
+    else:
+        bbox = (int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1)
+    top, bottom, left, right = bbox
+    flat = binary[top:bottom, left:right].ravel()
+
+    if fmt == "bits":
+        data = np.packbits(flat).tobytes()
+    elif flat.size == 0:
+        data = b""
+    else:
+        changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        counts = np.diff(np.concatenate(([0], changes, [flat.size])))
+        if flat[0]:
+            counts = np.concatenate(([0], counts))
+        data = _encode_varints(counts).tobytes()
+    return {
+        "format": fmt,
+        "width": width,
+        "height": height,
+        "bbox": list(bbox),
+        "data": base64.b64encode(data).decode(),
+    }
+
+
+def encode_mask_png(mask: np.ndarray) -> str:
+    # 8-bit grayscale PNG as the SD server takes masks. Written here rather
+    # than with OpenCV so that building the img2img payload stays numpy only.
+    height, width = mask.shape[:2]
+
+    def _chunk(kind: bytes, payload: bytes) -> bytes:
+        body = kind + payload
+        return (
+            len(payload).to_bytes(4, "big") + body + zlib.crc32(body).to_bytes(4, "big")
+        )
+
+    header = (
+        width.to_bytes(4, "big") + height.to_bytes(4, "big") + bytes([8, 0, 0, 0, 0])
+    )
+    # filter type 0 (none) in front of each row
+    scanlines = np.zeros((height, width + 1), dtype=np.uint8)
+    scanlines[:, 1:] = mask
+    png = (
+        b"\x89PNG\r\n\x1a\n"
+        + _chunk(b"IHDR", header)
+        + _chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6))
+        + _chunk(b"IEND", b"")
+    )
+    return base64.b64encode(png).decode()
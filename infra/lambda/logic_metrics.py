@@ -0,0 +1,108 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "RetouchApp")
+ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+MAX_VALUES = 100  # per metric and log line, the EMF limit
+
+
+class MetricsRecorder:
+    # Spans and counters of the current invocation. A container runs one
+    # invocation at a time, but spans may come from its worker threads.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.timings = defaultdict(list)  # name -> [ms]
+            self.counters = defaultdict(float)
+
+    def add_timing(self, name: str, ms: float):
+        with self._lock:
+            self.timings[name].append(ms)
+
+    def add_count(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def to_emf(self, function_name: str) -> dict:
+        # CloudWatch Embedded Metric Format, metrics are extracted from the log
+        with self._lock:
+            timings = {k: v[:MAX_VALUES] for k, v in self.timings.items()}
+            counters = dict(self.counters)
+        metrics = [{"Name": k, "Unit": "Milliseconds"} for k in timings]
+        metrics += [{"Name": k, "Unit": "Count"} for k in counters]
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": NAMESPACE,
+                        "Dimensions": [["Function"]],
+                        "Metrics": metrics[:100],
+                    }
+                ],
+            },
+            "Function": function_name,
+            **timings,
+            **counters,
+        }
+
+
+recorder = MetricsRecorder()
+
+
+@contextmanager
+def span(name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add_timing(name, (time.perf_counter() - start) * 1000)
+
+
+def timed(name: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, value: float = 1):
+    recorder.add_count(name, value)
+
+
+def instrument_handler(func):
+    # wraps lambda_handler: one "handler" span plus one EMF log line per call
+    function_name = func.__module__
+
+    @functools.wraps(func)
+    def wrapper(event, context):
+        recorder.reset()
+        status = 500
+        start = time.perf_counter()
+        try:
+            response = func(event, context)
+            if isinstance(response, dict):
+                status = response.get("statusCode", 200)
+            else:
+                status = 200
+            return response
+        finally:
+            recorder.add_timing("handler", (time.perf_counter() - start) * 1000)
+            recorder.add_count(f"status.{status // 100}xx")
+            if ENABLED:
+                print(json.dumps(recorder.to_emf(function_name)))
+
+    return wrapper
@@ -0,0 +1,75 @@
+import base64
+from typing import Dict, Tuple
+
+
+class MultipartError(ValueError):
+    # a malformed body or a missing part, the client's fault
+    pass
+
+
+def get_header(event: dict, name: str) -> str:
+    # HTTP API lowercases header names, but be lenient for local invocations
+    headers = event.get("headers") or {}
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return ""
+
+
+def get_raw_body(event: dict) -> bytes:
+    body = event.get("body") or ""
+    if event.get("isBase64Encoded"):
+        return base64.b64decode(body)
+    return body.encode()
+
+
+def is_multipart(event: dict) -> bool:
+    return get_header(event, "content-type").startswith("multipart/form-data")
+
+
+def getBoundary(event_content_type: str) -> bytes:
+    if "boundary=" not in event_content_type:
+        raise MultipartError("no multipart boundary")
+    boundary = event_content_type.split(";", 1)[1].strip().replace("boundary=", "", 1)
+    return ("--" + boundary).encode()
+
+
+def _parse_part_headers(raw_headers: bytes) -> Dict[str, str]:
+    params = {}
+    for line in raw_headers.decode("utf-8", "replace").split("\r\n"):
+        name, _, value = line.partition(":")
+        if name.strip().lower() != "content-disposition":
+            continue
+        for param in value.split(";")[1:]:
+            key, _, val = param.strip().partition("=")
+            params[key.lower()] = val.strip('"')
+    return params
+
+
+def parse_multipart(event: dict) -> Tuple[Dict[str, str], Dict[str, bytes]]:
+    # returns (text fields, file parts as raw bytes)
+    boundary = getBoundary(get_header(event, "content-type"))
+    raw_body = get_raw_body(event)
+
+    fields = {}
+    files = {}
+    for part in raw_body.split(boundary)[1:]:
+        if part.startswith(b"--"):
+            break  # closing boundary
+        raw_headers, _, content = part.partition(b"\r\n\r\n")
+        params = _parse_part_headers(raw_headers.lstrip(b"\r\n"))
+        name = params.get("name")
+        if name is None:
+            continue
+        content = content[: -len(b"\r\n")] if content.endswith(b"\r\n") else content
+        if "filename" in params:
+            files[name] = content
+        else:
+            fields[name] = content.decode()
+    return fields, files
+
+
+def require_part(parts: dict, name: str):
+    if name not in parts:
+        raise MultipartError(f'no "{name}" part')
+    return parts[name]
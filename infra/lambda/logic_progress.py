@@ -0,0 +1,90 @@
+import os
+import threading
+from typing import Callable
+from logic_sd_client import TRANSPORT_ERRORS, SDClient, SDServerError
+
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "1"))  # in sec
+PROGRESS_TIMEOUT = 2  # in sec
+
+
+def parse_progress(body: dict, steps: int) -> dict:
+    # the parts of /internal/progress the client shows. It has no step count,
+    # so the step is taken from the fraction done and the request's steps.
+    fraction = float(body.get("progress") or 0.0)
+    preview = body.get("live_preview") or None
+    if preview is not None:
+        preview = preview.split(",", 1)[-1]  # data URL -> base64
+    return {
+        "progress": fraction,
+        "etaRelative": float(body.get("eta") or 0.0),
+        "step": int(fraction * steps),
+        "steps": steps,
+        "preview": preview,
+    }
+
+
+class ProgressPoller:
+    # Polls the progress of one task while the request of that task runs, and
+    # calls on_progress whenever the step or the preview changes, with preview
+    # set only when it is a new one. The request is tagged with force_task_id,
+    # and the server only reports on that task, never on somebody else's job
+    # running on the same backend.
+    def __init__(
+        self,
+        client: SDClient,
+        task_id: str,
+        steps: int,
+        on_progress: Callable[[dict], None],
+        interval: float = PROGRESS_INTERVAL,
+    ):
+        self._client = client
+        self._task_id = task_id
+        self._steps = steps
+        self._on_progress = on_progress
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._last_step = None
+        self._last_preview_id = -1
+
+    def __enter__(self) -> "ProgressPoller":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        # not joined, a poll in flight must not delay the result
+        self._stopped.set()
+
+    def _run(self):
+        # the first poll waits as well, the server needs a moment to start
+        while not self._stopped.wait(self._interval):
+            try:
+                body = self._client.post(
+                    "/internal/progress",
+                    {
+                        "id_task": self._task_id,
+                        "id_live_preview": self._last_preview_id,
+                        "live_preview": True,
+                    },
+                    timeout=PROGRESS_TIMEOUT,
+                )
+            except (SDServerError, ValueError) + TRANSPORT_ERRORS as error:
+                print(f"progress poll failed: {error}")
+                continue
+            if not body.get("active"):
+                continue  # still queued behind other jobs, or done
+            progress = parse_progress(body, self._steps)
+            # the server only sends a preview newer than the one passed in
+            if progress["preview"] is None and progress["step"] == self._last_step:
+                continue
+            if self._stopped.is_set():
+                continue
+            self._last_step = progress["step"]
+            if progress["preview"] is not None:
+                self._last_preview_id = int(body.get("id_live_preview", -1))
+            try:
+                self._on_progress(progress)
+            except Exception as error:
+                # progress is best effort, never fail the job over it
+                print(f"progress callback failed: {error}")
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import List, Optional
+from botocore.exceptions import ClientError
+from logic_storage import upload_file_to_s3, download_file_from_s3
+
+DEFAULT_TTL = 60 * 60 * 24  # in sec
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+def cache_key(namespace: str, payload: dict) -> str:
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return namespace + "/" + hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _now() -> float:
+    return datetime.utcnow().timestamp()
+
+
+class LRUCacheBackend:
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= _now():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes, ttl: float):
+        if len(value) > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, _now() + ttl)
+            self._size += len(value)
+            while self._size > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        value, _ = self._entries.pop(key)
+        self._size -= len(value)
+
+
+class S3CacheBackend:
+    def __init__(self, bucket_name: str, prefix: str = "cache/"):
+        self._bucket_name = bucket_name
+        self._prefix = prefix
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            data = download_file_from_s3(self._bucket_name, self._prefix + key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        entry = json.loads(data)
+        if entry["expiresAt"] <= _now():
+            return None
+        return entry["value"].encode()
+
+    def put(self, key: str, value: bytes, ttl: float):
+        # the bucket lifecycle rule removes stale objects, expiresAt keeps TTL exact
+        entry = {"expiresAt": _now() + ttl, "value": value.decode()}
+        upload_file_to_s3(
+            json.dumps(entry).encode(), self._bucket_name, self._prefix + key
+        )
+
+
+class ResultCache:
+    # backends are looked up in order, e.g. warm-container memory first, then S3
+    def __init__(self, backends: List, ttl: float = DEFAULT_TTL):
+        self._backends = backends
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        for i, backend in enumerate(self._backends):
+            value = backend.get(key)
+            if value is not None:
+                for upper in self._backends[:i]:
+                    upper.put(key, value, self._ttl)
+                self.hits += 1
+                return json.loads(value)
+        self.misses += 1
+        return None
+
+    def put(self, key: str, result: dict):
+        value = json.dumps(result).encode()
+        for backend in self._backends:
+            backend.put(key, value, self._ttl)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def create_result_cache() -> ResultCache:
+    backends = [
+        LRUCacheBackend(
+            int(os.environ.get("RESULT_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES))
+        )
+    ]
+    bucket_name = os.environ.get("WORK_BUCKET_NAME")
+    if bucket_name:
+        backends.append(S3CacheBackend(bucket_name))
+    return ResultCache(backends, float(os.environ.get("RESULT_CACHE_TTL", DEFAULT_TTL)))
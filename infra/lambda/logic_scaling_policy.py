@@ -0,0 +1,124 @@
+import math
+import os
+from typing import Dict, Optional
+
+DAY = 60 * 60 * 24  # in sec
+SLOT = 60 * 15  # resolution of the time-of-day profile, in sec
+
+# decisions of ScalingPolicy.decide()
+START = "start"
+STOP = "stop"
+KEEP = "keep"
+
+
+class ArrivalStats:
+    # Expected number of requests in a time window, from per-minute counts
+    # ({minute start in epoch sec: count}). Blends the average time-of-day
+    # profile of the last history_days with the rate of the last recent_window
+    # sec, so that both the daily pattern and a burst going on right now count.
+    def __init__(
+        self,
+        counts: Dict[int, int],
+        now: float,
+        history_days: int = 28,
+        recent_window: float = 60 * 30,
+        recent_weight: float = 0.5,
+    ):
+        self.now = now
+        self.recent_weight = recent_weight
+        self.profile = [0.0] * (DAY // SLOT)  # mean arrivals per slot of the day
+        n_recent = 0
+        history_start = now - history_days * DAY
+        for minute_ts, count in counts.items():
+            if history_start <= minute_ts < now:
+                self.profile[int(minute_ts % DAY) // SLOT] += count / history_days
+            if now - recent_window <= minute_ts < now:
+                n_recent += count
+        self.recent_rate = n_recent / recent_window  # per sec
+
+    def seasonal_arrivals(self, start: float, end: float) -> float:
+        total = 0.0
+        t = start
+        while t < end:
+            slot_end = min((math.floor(t / SLOT) + 1) * SLOT, end)
+            total += self.profile[int(t % DAY) // SLOT] * (slot_end - t) / SLOT
+            t = slot_end
+        return total
+
+    def expected_arrivals(self, start: float, end: float) -> float:
+        recent = self.recent_rate * (end - start)
+        seasonal = self.seasonal_arrivals(start, end)
+        return self.recent_weight * recent + (1 - self.recent_weight) * seasonal
+
+    def arrival_probability(self, start: float, end: float) -> float:
+        # chance of at least one request, treating arrivals as Poisson
+        return 1 - math.exp(-self.expected_arrivals(start, end))
+
+
+class ScalingPolicy:
+    # Weighs GPU cost against the cold start wait users pay when a request
+    # finds the server stopped. Keeping the server up for the next horizon sec
+    # costs gpu_cost * horizon. Stopping it costs boot_time of waiting, priced
+    # at wait_cost, if anyone shows up within the horizon.
+    #
+    # A running server is stopped once it has been idle for min_idle and that
+    # trade-off says so, or unconditionally after max_idle. A stopped server is
+    # started ahead of predicted demand, with start_margin as hysteresis.
+    def __init__(
+        self,
+        boot_time: float = 300,  # in sec
+        gpu_cost_per_hour: float = 0.71,
+        wait_cost_per_hour: float = 20.0,  # value of an hour of user waiting
+        horizon: float = 60 * 15,  # in sec
+        min_idle: float = 60 * 10,  # in sec
+        max_idle: float = 60 * 40,  # in sec
+        start_margin: float = 2.0,
+    ):
+        self.boot_time = boot_time
+        self.gpu_cost = gpu_cost_per_hour / 3600
+        self.wait_cost = wait_cost_per_hour / 3600
+        self.horizon = horizon
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.start_margin = start_margin
+
+    def cold_start_cost(self, stats: ArrivalStats, start: float, end: float) -> float:
+        return stats.arrival_probability(start, end) * self.boot_time * self.wait_cost
+
+    def decide(
+        self,
+        now: float,
+        running: bool,
+        last_active: Optional[float],
+        stats: ArrivalStats,
+    ) -> str:
+        # last_active: the later of the last request and the instance start
+        if running:
+            idle = math.inf if last_active is None else now - last_active
+            if idle >= self.max_idle:
+                return STOP
+            if idle < self.min_idle:
+                return KEEP
+            keep_cost = self.gpu_cost * self.horizon
+            if self.cold_start_cost(stats, now, now + self.horizon) < keep_cost:
+                return STOP
+            return KEEP
+
+        # started now, the server is ready boot_time later and covers the horizon
+        window = self.boot_time + self.horizon
+        start_cost = self.gpu_cost * window * self.start_margin
+        if self.cold_start_cost(stats, now, now + window) > start_cost:
+            return START
+        return KEEP
+
+
+def create_scaling_policy(max_idle: Optional[float] = None) -> ScalingPolicy:
+    kwargs = {
+        "boot_time": float(os.environ.get("SD_BOOT_TIME", "300")),
+        "gpu_cost_per_hour": float(os.environ.get("GPU_COST_PER_HOUR", "0.71")),
+        "wait_cost_per_hour": float(os.environ.get("WAIT_COST_PER_HOUR", "20")),
+        "min_idle": float(os.environ.get("MIN_IDLE_TIME", "600")),
+    }
+    if max_idle is not None:
+        kwargs["max_idle"] = max_idle
+    return ScalingPolicy(**kwargs)
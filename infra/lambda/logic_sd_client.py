@@ -0,0 +1,254 @@
+import bisect
+import gzip
+import http.client
+import json
+import os
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+from urllib.parse import urlsplit
+from logic_metrics import span
+
+DEFAULT_TIMEOUT = 30  # in sec
+# a stopped or booting instance does not answer at all, so connecting gets a
+# short timeout of its own instead of the one of the whole request
+CONNECT_TIMEOUT = float(os.environ.get("SD_CONNECT_TIMEOUT", "3"))  # in sec
+
+# upper bounds of the latency histogram buckets, in sec
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+# the time a handler keeps after its SD calls to refund credit and answer
+DEADLINE_RESERVE = float(os.environ.get("SD_DEADLINE_RESERVE", "3"))  # in sec
+
+# the ways talking to the server fails; socket timeouts and connection
+# errors are OSErrors
+TRANSPORT_ERRORS = (OSError, http.client.HTTPException)
+
+
+class SDServerError(Exception):
+    def __init__(self, status: int, body: bytes):
+        super().__init__(f"SD server returned {status}: {body[:200]!r}")
+        self.status = status
+
+
+class SDConnectError(ConnectionError):
+    # the request was never sent, so it is safe to send it elsewhere
+    pass
+
+
+def _is_timeout(error: BaseException) -> bool:
+    # socket.timeout is only an alias of TimeoutError from Python 3.10
+    return isinstance(error, (socket.timeout, TimeoutError))
+
+
+def is_retryable(error: Exception) -> bool:
+    # Only a refused or reset connection is worth another try: a 5xx or a
+    # dropped connection comes back at once, while a timed out call has
+    # already spent its time and the server may still be working on it.
+    if isinstance(error, SDServerError):
+        return error.status >= 500
+    if isinstance(error, SDConnectError):
+        return not _is_timeout(error.__cause__)
+    return isinstance(error, ConnectionError)
+
+
+def deadline_from_context(context, reserve: float = DEADLINE_RESERVE):
+    # -> Optional[float], time.monotonic() by which the SD calls of an
+    # invocation must be done so that the Lambda is not killed mid-way
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - reserve
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def to_dict(self) -> dict:
+        return {
+            "count": sum(self.counts),
+            "sum": self.total,
+            "buckets": {str(b): c for b, c in zip(LATENCY_BUCKETS, self.counts)},
+        }
+
+
+class SDClient:
+    # Keeps idle keep-alive connections across warm Lambda invocations. Each
+    # thread takes its own connection out of the pool, so the client can be
+    # shared by concurrent callers.
+    def __init__(self, base_url: str, max_idle: int = 4):
+        parts = urlsplit(base_url)
+        self._scheme = parts.scheme
+        self._host = parts.hostname
+        self._port = parts.port
+        self._prefix = parts.path.rstrip("/")
+        self._max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+        self.n_connections = 0
+        self.histograms = defaultdict(LatencyHistogram)
+
+    def _new_connection(self, timeout: float) -> http.client.HTTPConnection:
+        connect_timeout = min(CONNECT_TIMEOUT, timeout)
+        if self._scheme == "https":
+            connection = http.client.HTTPSConnection(
+                self._host, self._port, timeout=connect_timeout
+            )
+        else:
+            connection = http.client.HTTPConnection(
+                self._host, self._port, timeout=connect_timeout
+            )
+        try:
+            connection.connect()
+        except OSError as error:
+            connection.close()
+            raise SDConnectError(
+                f"cannot connect to {self._host}:{self._port}: {error}"
+            ) from error
+        connection.timeout = timeout
+        connection.sock.settimeout(timeout)
+        self.n_connections += 1
+        return connection
+
+    def _acquire(self, timeout: float, fresh: bool = False):
+        # -> tuple[http.client.HTTPConnection, bool]
+        connection = None
+        if not fresh:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            return self._new_connection(timeout), False
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _release(self, connection: http.client.HTTPConnection):
+        with self._lock:
+            if len(self._idle) < self._max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _request_once(
+        self, method: str, path: str, body: Optional[bytes], timeout: float
+    ) -> bytes:
+        headers = {"Accept-Encoding": "gzip", "Connection": "keep-alive"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        connection, reused = self._acquire(timeout)
+        while True:
+            try:
+                connection.request(method, self._prefix + path, body, headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ):
+                connection.close()
+                if not reused:
+                    raise
+                # the server dropped the idle connection, send once more on a new one
+                connection, reused = self._acquire(timeout, fresh=True)
+            except Exception:
+                connection.close()
+                raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+
+        if response.getheader("Content-Encoding") == "gzip":
+            data = gzip.decompress(data)
+        if response.status >= 400:
+            raise SDServerError(response.status, data)
+        return data
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        data: Optional[dict] = None,
+        timeout: float = DEFAULT_TIMEOUT,
+        retries: int = 0,
+        backoff: float = 0.2,  # in sec, doubled on each retry
+        deadline: Optional[float] = None,  # time.monotonic() of all attempts
+    ) -> dict:
+        # retries should only be given for idempotent calls
+        with span("sd " + path.split("?", 1)[0]):
+            return self._request(
+                method, path, data, timeout, retries, backoff, deadline
+            )
+
+    def _request(self, method, path, data, timeout, retries, backoff, deadline):
+        body = None if data is None else json.dumps(data).encode()
+        for attempt in range(retries + 1):
+            attempt_timeout = timeout
+            if deadline is not None:
+                attempt_timeout = min(timeout, deadline - time.monotonic())
+                if attempt_timeout <= 0:
+                    raise socket.timeout(f"deadline of {path} exceeded")
+            start = time.perf_counter()
+            try:
+                result = self._request_once(method, path, body, attempt_timeout)
+                return json.loads(result)
+            except TRANSPORT_ERRORS + (SDServerError,) as error:
+                if attempt == retries or not is_retryable(error):
+                    raise
+                delay = backoff * (2**attempt) * (1 + random.random())
+                if deadline is not None and time.monotonic() + delay >= deadline:
+                    raise
+            finally:
+                self.histograms[path].observe(time.perf_counter() - start)
+            time.sleep(delay)
+
+    def get(self, path: str, timeout: float = DEFAULT_TIMEOUT, retries: int = 2):
+        return self.request("GET", path, timeout=timeout, retries=retries)
+
+    def post(
+        self,
+        path: str,
+        data: dict,
+        timeout: float = DEFAULT_TIMEOUT,
+        retries: int = 0,
+    ):
+        return self.request("POST", path, data, timeout=timeout, retries=retries)
+
+    def stats(self) -> dict:
+        return {
+            "connections": self.n_connections,
+            "latency": {k: v.to_dict() for k, v in self.histograms.items()},
+        }
+
+
+_clients = {}
+
+
+def get_sd_client(base_url: Optional[str] = None) -> SDClient:
+    # one client per server, reused across warm invocations
+    if base_url is None:
+        base_url = os.environ["SD_SERVER_URL"]
+    client = _clients.get(base_url)
+    if client is None:
+        client = _clients[base_url] = SDClient(base_url)
+    return client
+
+
+def probe_sd_server(base_url: Optional[str] = None, timeout: float = 2) -> bool:
+    try:
+        #  arbitrary GET endpoint for healthcheck
+        get_sd_client(base_url).get("/sdapi/v1/options", timeout=timeout, retries=0)
+    except (SDServerError, ValueError) + TRANSPORT_ERRORS:
+        return False
+    return True
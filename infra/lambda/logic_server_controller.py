@@ -1,8 +1,9 @@
-import boto3
-
 import urllib.request
 import urllib.parse
 import os
+import time
+from botocore.exceptions import ClientError
+from logic_aws import get_resource
 
 
 def notify_line(msg):
@@ -22,23 +23,71 @@ def notify_line(msg):
     res = urllib.request.urlopen(req, timeout=5)
 
 
+TARGET_NAME = os.environ.get("SD_INSTANCE_NAME", "sd-service")
+TARGET_STATES = ["pending", "running", "stopping", "stopped"]
+INSTANCE_CACHE_TTL = float(os.environ.get("INSTANCE_CACHE_TTL", "300"))  # in sec
+
+# ids of the tagged instances, kept across warm invocations
+_instance_ids_cache = {"ids": None, "expiresAt": 0.0}
+
+
+def invalidate_instance_cache():
+    _instance_ids_cache.update(ids=None, expiresAt=0.0)
+
+
 class ServerController:
     def __init__(self):
-        self._ec2 = boto3.resource("ec2")
-        self._instance = None
+        self._ec2 = get_resource("ec2")
+        self._instances = None
+
+    def _find_target_instances(self):
+        # one filtered DescribeInstances instead of walking every instance's tags
+        instances = self._ec2.instances.filter(
+            Filters=[
+                {"Name": "tag:Name", "Values": [TARGET_NAME]},
+                {"Name": "instance-state-name", "Values": TARGET_STATES},
+            ]
+        )
+        return sorted(instances, key=lambda instance: instance.id)
 
-    def _find_target_instance(self):
-        instances = self._ec2.instances.all()
-        for instance in instances:
-            for tag in instance.tags:
-                if tag["Key"] == "Name" and tag["Value"] == "sd-service":
-                    return instance
+    def _describe_instances(self, ids: list):
+        # the cached ids in one DescribeInstances, with their attributes loaded;
+        # None once one of them is gone or no longer in a target state
+        if not ids:
+            return None  # no InstanceIds would describe every instance
+        try:
+            instances = list(
+                self._ec2.instances.filter(
+                    InstanceIds=ids,
+                    Filters=[{"Name": "instance-state-name", "Values": TARGET_STATES}],
+                )
+            )
+        except ClientError as error:
+            print(f"cached instances not found: {error}")
+            return None
+        if len(instances) != len(ids):
+            return None
+        return sorted(instances, key=lambda instance: instance.id)
+
+    @property
+    def target_instances(self):
+        if self._instances is None:
+            now = time.monotonic()
+            ids = _instance_ids_cache["ids"]
+            if ids is not None and now < _instance_ids_cache["expiresAt"]:
+                self._instances = self._describe_instances(ids)
+            if self._instances is None:
+                self._instances = self._find_target_instances()
+                _instance_ids_cache.update(
+                    ids=[instance.id for instance in self._instances],
+                    expiresAt=now + INSTANCE_CACHE_TTL,
+                )
+        return self._instances
 
     @property
     def target_instance(self):
-        if self._instance is None:
-            self._instance = self._find_target_instance()
-        return self._instance
+        instances = self.target_instances
+        return instances[0] if instances else None
 
     def get_target_instance_status(self):
         instance = self.target_instance
@@ -47,3 +96,22 @@ class ServerController:
     def get_target_instance_ip_address(self):
         instance = self.target_instance
         return instance.public_ip_address or "unknown"
+
+    def get_instance_statuses(self) -> dict:
+        return {
+            instance.id: instance.state["Name"].upper()
+            for instance in self.target_instances
+        }
+
+    def start(self, instance=None):
+        (instance or self.target_instance).start()
+        self._on_state_change()
+
+    def stop(self, instance=None):
+        (instance or self.target_instance).stop()
+        self._on_state_change()
+
+    def _on_state_change(self):
+        # state and addresses are about to change, look everything up again
+        invalidate_instance_cache()
+        self._instances = None
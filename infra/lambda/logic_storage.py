@@ -0,0 +1,14 @@
+from logic_aws import get_client
+from io import BytesIO
+
+
+def upload_file_to_s3(data: bytes, bucket_name: str, key: str):
+    s3 = get_client("s3")
+    s3.upload_fileobj(BytesIO(data), bucket_name, key)
+
+
+def download_file_from_s3(bucket_name: str, key: str) -> bytes:
+    s3 = get_client("s3")
+    buffered = BytesIO()
+    s3.download_fileobj(bucket_name, key, buffered)
+    return buffered.getvalue()
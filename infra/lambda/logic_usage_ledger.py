@@ -0,0 +1,313 @@
+import os
+import secrets
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+from boto3.dynamodb.conditions import Key
+from logic_aws import get_resource
+from logic_metrics import count, timed
+
+# Append-only usage ledger in a table of its own (USAGE_TABLE_NAME), so that
+# scans of the user table, e.g. refresh_credit's, do not read through it:
+#
+#   event   pk=<username>           sk=usage#<UTC time>#<random>
+#   rollup  pk=usage#hour           sk=<YYYY-MM-DDTHH>
+#           pk=usage#day[#<user>]   sk=<YYYY-MM-DD>
+#
+# The handlers write one event per request that reached the SD server or the
+# result cache. The rollups sum the events per hour and per day for the whole
+# service, and per day for each user. usage_rollup.py keeps them up to date
+# from the table stream, so a report reads a few buckets instead of scanning.
+EVENT_PREFIX = "usage#"
+HOUR = "hour"
+DAY = "day"
+BUCKET_FORMATS = {HOUR: "%Y-%m-%dT%H", DAY: "%Y-%m-%d"}
+BUCKET_SECONDS = {HOUR: 60 * 60, DAY: 60 * 60 * 24}
+# events expire, rollups are kept for good; in sec
+EVENT_RETENTION = int(os.environ.get("USAGE_EVENT_RETENTION", str(60 * 60 * 24 * 90)))
+
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+# A rollup item holds the sums of requests, credit and gpuSeconds (SD time),
+# also by plan and kind of request (e.g. "requests#plan:free"), and the number
+# of failed and cached requests. A day of the service also counts its "users":
+# a user's day item records the batch that created it, and that batch adds
+# the user to the day.
+ROLLUP_CONCURRENCY = int(os.environ.get("ROLLUP_CONCURRENCY", "8"))
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _iso(ts: float) -> str:
+    # fixed width, so that event keys sort by time
+    return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def bucket_of(ts: float, granularity: str) -> str:
+    return datetime.utcfromtimestamp(ts).strftime(BUCKET_FORMATS[granularity])
+
+
+def bucket_start(bucket: str, granularity: str) -> int:
+    start = datetime.strptime(bucket, BUCKET_FORMATS[granularity]) - EPOCH
+    return int(start.total_seconds())
+
+
+def rollup_pk(granularity: str, username: Optional[str] = None) -> str:
+    pk = EVENT_PREFIX + granularity
+    return pk if username is None else f"{pk}#{username}"
+
+
+def _number(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    return value
+
+
+def rollup_events(events: Iterable[dict]) -> Dict[Tuple[str, str], dict]:
+    # {(pk, sk): {counter: sum}} of the buckets the events fall in, as
+    # usage_rollup.py adds them to the rollup items
+    buckets = defaultdict(lambda: defaultdict(float))
+    for event in events:
+        ts = float(event["ts"])
+        values = {
+            "requests": 1,
+            "credit": int(event.get("credit", 0)),
+            "gpuSeconds": float(event.get("gpuSeconds", 0)),
+        }
+        for granularity, username in ((HOUR, None), (DAY, None), (DAY, event["pk"])):
+            key = (rollup_pk(granularity, username), bucket_of(ts, granularity))
+            bucket = buckets[key]
+            for name, value in values.items():
+                bucket[name] += value
+                if username is None:
+                    bucket[f"{name}#plan:{event.get('plan') or '-'}"] += value
+                    bucket[f"{name}#kind:{event['kind']}"] += value
+            bucket["failed"] += event.get("status") == STATUS_FAILED
+            bucket["cached"] += bool(event.get("cached"))
+    return {key: dict(bucket) for key, bucket in buckets.items()}
+
+
+def merge_rollups(items: Iterable[dict]) -> dict:
+    # sums rollup items as returned by UsageLedger.get_rollups(); the "users"
+    # of the days become "userDays", as distinct users over several days are
+    # not kept, and hours do not count users at all
+    total = defaultdict(float)
+    for item in items:
+        for name, value in item.items():
+            if name not in ("bucket", "start"):
+                total["userDays" if name == "users" else name] += value
+    return {name: _number(Decimal(str(round(v, 3)))) for name, v in total.items()}
+
+
+def usage_event(
+    username: str,
+    kind: str,
+    plan: Optional[str] = None,
+    credit: int = 0,
+    gpu_seconds: float = 0.0,
+    status: str = STATUS_OK,
+    cached: bool = False,
+    ts: Optional[float] = None,
+) -> dict:
+    # the ledger item of one request; gpu_seconds is the time spent on SD
+    if ts is None:
+        ts = datetime.utcnow().timestamp()
+    item = {
+        "pk": username,
+        "sk": f"{EVENT_PREFIX}{_iso(ts)}#{secrets.token_hex(4)}",
+        "ts": Decimal(str(round(ts, 6))),
+        "kind": kind,
+        "credit": Decimal(credit),
+        "gpuSeconds": Decimal(str(round(gpu_seconds, 3))),
+        "status": status,
+        "expiresAt": Decimal(int(ts) + EVENT_RETENTION),
+    }
+    if plan:
+        item["plan"] = plan
+    if cached:
+        item["cached"] = True
+    return item
+
+
+class UsageLedger:
+    def __init__(self):
+        dynamodb = get_resource("dynamodb")
+        self._table = dynamodb.Table(os.environ["USAGE_TABLE_NAME"])
+        self.consumed_capacity = 0.0
+        self._lock = threading.Lock()
+
+    @timed("dynamo.record_usage")
+    def record(
+        self, username: str, kind: str, plan: Optional[str] = None, **kwargs
+    ) -> Optional[dict]:
+        # one put of usage_event(), never fails the request it records
+        item = usage_event(username, kind, plan, **kwargs)
+        try:
+            self._table.put_item(Item=item)
+        except Exception as error:
+            print(f"usage not recorded: {error}")
+            count("usage.unrecorded")
+            return None
+        return item
+
+    @timed("dynamo.apply_rollups")
+    def apply_rollups(
+        self,
+        rollups: Dict[Tuple[str, str], dict],
+        batch_id: str,
+        max_workers: int = ROLLUP_CONCURRENCY,
+    ) -> int:
+        # Adds rollup_events() of one stream batch to the rollup items,
+        # concurrently, and returns how many were updated. A failed batch is
+        # retried as a whole, so each item remembers the last batch added to
+        # it and takes it only once. Only an item another batch updated
+        # between the failure and the retry would count the batch twice.
+        # The users' day items go first, the days of the service then add
+        # the users whose item this batch created.
+        client = self._table.meta.client
+        day_pk = rollup_pk(DAY)
+        user_days = [key for key in rollups if key[0].startswith(day_pk + "#")]
+        others = [key for key in rollups if not key[0].startswith(day_pk + "#")]
+
+        def _apply(key: Tuple[str, str]) -> Tuple[bool, bool]:
+            # (updated, the item was created by this batch)
+            names = {"#batch": "lastBatch", "#first": "firstBatch"}
+            values, adds = {":batch": batch_id}, []
+            for i, (name, value) in enumerate(sorted(rollups[key].items())):
+                names[f"#a{i}"] = name
+                values[f":a{i}"] = Decimal(str(round(value, 3)))
+                adds.append(f"#a{i} :a{i}")
+            try:
+                response = client.update_item(
+                    TableName=self._table.name,
+                    Key={"pk": key[0], "sk": key[1]},
+                    UpdateExpression=(
+                        f"ADD {', '.join(adds)} SET #batch = :batch,"
+                        " #first = if_not_exists(#first, :batch)"
+                    ),
+                    ConditionExpression=(
+                        "attribute_not_exists(#batch) OR #batch <> :batch"
+                    ),
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=values,
+                    # only a user's day item is read back, to tell a new user
+                    ReturnValues=(
+                        "ALL_NEW" if key[0].startswith(day_pk + "#") else "NONE"
+                    ),
+                    ReturnValuesOnConditionCheckFailure="ALL_OLD",
+                    ReturnConsumedCapacity="TOTAL",
+                )
+            except client.exceptions.ConditionalCheckFailedException as error:
+                # a retried batch, the item tells whether it created the item
+                first = (error.response.get("Item") or {}).get("firstBatch")
+                return False, first in (batch_id, {"S": batch_id})
+            self._add_consumed_capacity(response)
+            first = response.get("Attributes", {}).get("firstBatch")
+            return True, first == batch_id
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_apply, user_days))
+            for (_, day), (_, created) in zip(user_days, results):
+                if created:
+                    rollups[(day_pk, day)]["users"] = (
+                        rollups[(day_pk, day)].get("users", 0) + 1
+                    )
+            results += executor.map(_apply, others)
+        n_applied = sum(applied for applied, _ in results)
+        if n_applied < len(rollups):
+            print(f"batch {batch_id} was in {len(rollups) - n_applied} rollups already")
+        return n_applied
+
+    def _add_consumed_capacity(self, response: dict):
+        capacity = response.get("ConsumedCapacity") or {}
+        with self._lock:
+            self.consumed_capacity += capacity.get("CapacityUnits", 0)
+
+    def _query(self, **kwargs) -> List[dict]:
+        items = []
+        while True:
+            response = self._table.query(ReturnConsumedCapacity="TOTAL", **kwargs)
+            items.extend(response.get("Items", []))
+            self._add_consumed_capacity(response)
+            last_key = response.get("LastEvaluatedKey")
+            if last_key is None:
+                return items
+            kwargs["ExclusiveStartKey"] = last_key
+
+    @timed("dynamo.get_usage_events")
+    def get_events(
+        self, username: str, since: float, until: float, limit: Optional[int] = None
+    ) -> List[dict]:
+        # the user's events in [since, until), oldest first
+        kwargs = {
+            "KeyConditionExpression": Key("pk").eq(username)
+            & Key("sk").between(EVENT_PREFIX + _iso(since), EVENT_PREFIX + _iso(until))
+        }
+        if limit is not None:
+            kwargs["Limit"] = limit
+        items = self._query(**kwargs)
+        items = [item for item in items if float(item["ts"]) < until]
+        return [
+            {name: _number(value) for name, value in item.items()}
+            for item in items[:limit]
+        ]
+
+    @timed("dynamo.get_usage_rollups")
+    def get_rollups(
+        self,
+        since: float,
+        until: float,
+        granularity: str = HOUR,
+        username: Optional[str] = None,
+    ) -> List[dict]:
+        # the buckets overlapping [since, until), oldest first, with "bucket"
+        # and its "start" in epoch sec; buckets without requests are absent.
+        # A user's usage is rolled up by day only.
+        if username is not None and granularity != DAY:
+            raise ValueError("the usage of a user is by day")
+        if until <= since:
+            return []
+        first = bucket_of(since, granularity)
+        last = bucket_of(until - 1e-3, granularity)
+        items = self._query(
+            KeyConditionExpression=Key("pk").eq(rollup_pk(granularity, username))
+            & Key("sk").between(first, last)
+        )
+        rollups = []
+        for item in items:
+            rollup = {
+                "bucket": item["sk"],
+                "start": bucket_start(item["sk"], granularity),
+            }
+            for name, value in item.items():
+                if name not in ("pk", "sk", "lastBatch", "firstBatch"):
+                    rollup[name] = _number(value)
+            rollups.append(rollup)
+        return rollups
+
+    def get_usage(
+        self, since: float, until: float, username: Optional[str] = None
+    ) -> dict:
+        # totals over [since, until) rounded out to whole hours (days for a
+        # user), from the day buckets the range covers and the hour buckets
+        # at its ragged ends
+        day = BUCKET_SECONDS[DAY]
+        step = BUCKET_SECONDS[HOUR] if username is None else day
+        since = int(since // step * step)
+        until = int(-(-until // step) * step)
+        first_day, last_day = -(-since // day) * day, until // day * day
+        if username is not None:
+            items = self.get_rollups(since, until, DAY, username)
+        elif first_day >= last_day:
+            items = self.get_rollups(since, until, HOUR, username)
+        else:
+            items = (
+                self.get_rollups(since, first_day, HOUR)
+                + self.get_rollups(first_day, last_day, DAY)
+                + self.get_rollups(last_day, until, HOUR)
+            )
+        total = merge_rollups(items)
+        return {"since": since, "until": until, "buckets": len(items), **total}
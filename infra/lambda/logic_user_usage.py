@@ -1,11 +1,37 @@
 from decimal import Decimal
-import boto3
 from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import os
 import json
 import base64
-from typing import Optional
-from datetime import datetime
+import random
+import threading
+import time
+from typing import Dict, Optional
+from datetime import datetime, timedelta
+from logic_aws import get_resource
+from logic_metrics import timed
+
+# minimum interval between heartbeat writes, in sec. With several warm
+# containers calledAt can lag the real last call by up to twice this.
+LAST_CALLED_GRANULARITY = float(os.environ.get("LAST_CALLED_GRANULARITY", "60"))
+
+# per-minute request counts are kept this long for the scaling policy, in sec
+ARRIVAL_RETENTION = 60 * 60 * 24 * 35
+# minimum interval between a container's writes of its arrival counts, in sec
+ARRIVAL_FLUSH_INTERVAL = float(
+    os.environ.get("ARRIVAL_FLUSH_INTERVAL", str(LAST_CALLED_GRANULARITY))
+)
+
+# when this container last wrote (or saw) the heartbeat, across warm invocations
+_last_called_written = None
+
+# arrivals this container counted but has not written, {(day, minute): count},
+# and when it last wrote them
+_pending_arrivals = {}
+_arrivals_written = None
+_arrivals_lock = threading.Lock()
 
 
 def extract_username(auth_token):
@@ -21,11 +47,38 @@ def validate_admin_user(auth_token):
     return extract_username(auth_token) == "root"
 
 
+THROTTLING_ERRORS = (
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+)
+
+_capacity_lock = threading.Lock()
+
+
+def _with_throttling_backoff(func, max_attempts: int = 6, **kwargs):
+    # on top of botocore's own retries, which give up quickly on bulk jobs
+    for attempt in range(max_attempts):
+        try:
+            return func(**kwargs)
+        except ClientError as error:
+            code = error.response["Error"]["Code"]
+            if code not in THROTTLING_ERRORS or attempt == max_attempts - 1:
+                raise
+        time.sleep(0.1 * (2**attempt) * (1 + random.random()))
+
+
+class InsufficientCreditError(Exception):
+    pass
+
+
 class UserUsage:
     def __init__(self, event: Optional[dict] = None):
-        dynamodb = boto3.resource("dynamodb")
+        dynamodb = get_resource("dynamodb")
         table_name = os.environ["DYNAMO_TABLE_NAME"]
         self._table = dynamodb.Table(table_name)
+        self.consumed_capacity = 0.0
+        self.plan = None  # known after reserve_credit()
         if event is not None:
             self._username = extract_username(event["headers"]["authorization"])
 
@@ -37,6 +90,7 @@ class UserUsage:
     def username(self, username):
         self._username = username
 
+    @timed("dynamo.get_user_usage")
     def get_user_usage(self):
         response = self._table.get_item(Key={"pk": self._username, "sk": "info"})
         item = response.get("Item")
@@ -57,25 +111,139 @@ class UserUsage:
             AttributeUpdates={"credit": {"Value": Decimal(credit), "Action": "PUT"}},
         )
 
-    def scan_user_infos(self):
-        response = self._table.scan(
-            Select="ALL_ATTRIBUTES",
-            FilterExpression=Attr("sk").eq("info"),
+    @timed("dynamo.reserve_credit")
+    def reserve_credit(self, amount: int) -> int:
+        # Atomically takes amount from the balance in a single round trip and
+        # returns the new balance. Give it back with refund_credit() when the
+        # work it paid for fails; there is nothing else to do on success.
+        try:
+            response = self._table.update_item(
+                Key={"pk": self._username, "sk": "info"},
+                UpdateExpression="ADD #credit :negative",
+                ConditionExpression="#credit >= :amount",
+                ExpressionAttributeNames={"#credit": "credit"},
+                ExpressionAttributeValues={
+                    ":negative": Decimal(-amount),
+                    ":amount": Decimal(amount),
+                },
+                # the plan comes along for admission control, at no extra cost
+                ReturnValues="ALL_NEW",
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            raise InsufficientCreditError(self._username)
+        self.plan = response["Attributes"].get("plan")
+        return int(response["Attributes"]["credit"])
+
+    @timed("dynamo.refund_credit")
+    def refund_credit(self, amount: int) -> int:
+        response = self._table.update_item(
+            Key={"pk": self._username, "sk": "info"},
+            UpdateExpression="ADD #credit :amount",
+            ConditionExpression="attribute_exists(pk)",
+            ExpressionAttributeNames={"#credit": "credit"},
+            ExpressionAttributeValues={":amount": Decimal(amount)},
+            ReturnValues="UPDATED_NEW",
         )
-        items = response.get("Items")
-        return items
+        return int(response["Attributes"]["credit"])
+
+    @timed("dynamo.scan_user_infos")
+    def scan_user_infos(self, total_segments: int = 1) -> list:
+        # All "info" items with only pk/plan/credit, following LastEvaluatedKey.
+        # Segments are scanned in parallel through the thread-safe client.
+        if total_segments == 1:
+            return self._scan_user_info_segment(None, 1)
+        with ThreadPoolExecutor(max_workers=total_segments) as executor:
+            segments = executor.map(
+                lambda segment: self._scan_user_info_segment(segment, total_segments),
+                range(total_segments),
+            )
+        return [item for items in segments for item in items]
+
+    def _scan_user_info_segment(self, segment: Optional[int], total_segments: int):
+        client = self._table.meta.client
+        kwargs = {
+            "TableName": self._table.name,
+            "FilterExpression": Attr("sk").eq("info"),
+            "ProjectionExpression": "#pk, #plan, #credit",
+            "ExpressionAttributeNames": {
+                "#pk": "pk",
+                "#plan": "plan",
+                "#credit": "credit",
+            },
+            "ReturnConsumedCapacity": "TOTAL",
+        }
+        if segment is not None:
+            kwargs.update(Segment=segment, TotalSegments=total_segments)
 
-    def update_last_called(self, ts: Optional[float] = None):
+        items = []
+        while True:
+            response = _with_throttling_backoff(client.scan, **kwargs)
+            items.extend(response.get("Items", []))
+            self._add_consumed_capacity(response)
+            last_key = response.get("LastEvaluatedKey")
+            if last_key is None:
+                return items
+            kwargs["ExclusiveStartKey"] = last_key
+
+    @timed("dynamo.update_user_credits")
+    def update_user_credits(self, credits: dict, max_workers: int = 8) -> int:
+        # credits: username -> new credit, written concurrently
+        client = self._table.meta.client
+
+        def _update(username, credit):
+            response = _with_throttling_backoff(
+                client.update_item,
+                TableName=self._table.name,
+                Key={"pk": username, "sk": "info"},
+                AttributeUpdates={
+                    "credit": {"Value": Decimal(credit), "Action": "PUT"}
+                },
+                ReturnConsumedCapacity="TOTAL",
+            )
+            self._add_consumed_capacity(response)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(lambda kv: _update(*kv), credits.items()))
+        return len(credits)
+
+    def _add_consumed_capacity(self, response: dict):
+        capacity = response.get("ConsumedCapacity") or {}
+        with _capacity_lock:
+            self.consumed_capacity += capacity.get("CapacityUnits", 0)
+
+    @timed("dynamo.update_last_called")
+    def update_last_called(
+        self, ts: Optional[float] = None, granularity: float = LAST_CALLED_GRANULARITY
+    ):
+        # The GLOBAL row is hot, so the write is skipped while the stored value
+        # is less than granularity old: first by what this warm container last
+        # wrote, then by a condition on the stored value.
+        global _last_called_written
         if ts is None:
             ts = datetime.utcnow().timestamp()
-        self._table.update_item(
-            Key={"pk": "GLOBAL", "sk": "lastCalled"},
-            AttributeUpdates={
-                "calledAt": {"Value": Decimal(ts), "Action": "PUT"},
-                "calledBy": {"Value": self.username, "Action": "PUT"},
-            },
-        )
+        if _last_called_written is not None and ts - _last_called_written < granularity:
+            return False
+
+        try:
+            self._table.update_item(
+                Key={"pk": "GLOBAL", "sk": "lastCalled"},
+                UpdateExpression="SET calledAt = :ts, calledBy = :username",
+                ConditionExpression=(
+                    "attribute_not_exists(calledAt) OR calledAt <= :threshold"
+                ),
+                ExpressionAttributeValues={
+                    ":ts": Decimal(ts),
+                    ":username": self.username,
+                    ":threshold": Decimal(ts - granularity),
+                },
+            )
+        except self._table.meta.client.exceptions.ConditionalCheckFailedException:
+            _last_called_written = ts  # another container wrote it recently
+            return False
+        _last_called_written = ts
+        return True
 
+    @timed("dynamo.get_last_called")
     def get_last_called(self) -> Optional[float]:
         response = self._table.get_item(Key={"pk": "GLOBAL", "sk": "lastCalled"})
         item = response.get("Item")
@@ -85,6 +253,86 @@ class UserUsage:
                 return float(called)
         return None
 
+    @timed("dynamo.record_arrival")
+    def record_arrival(self, ts: Optional[float] = None) -> bool:
+        # One item per UTC day holding a counter per minute of the day, e.g.
+        # m570 for 09:30. The scaling policy learns the arrival rate from it.
+        # The GLOBAL row is hot, so a warm container adds its arrivals up and
+        # writes them at most once per ARRIVAL_FLUSH_INTERVAL, its first one at
+        # once. What a container counted after its last write is lost with it,
+        # which the policy, needing only the rate, tolerates.
+        global _arrivals_written
+        if ts is None:
+            ts = datetime.utcnow().timestamp()
+        day = datetime.utcfromtimestamp(ts)
+        key = (day.strftime("%Y-%m-%d"), day.hour * 60 + day.minute)
+        with _arrivals_lock:
+            _pending_arrivals[key] = _pending_arrivals.get(key, 0) + 1
+            if (
+                _arrivals_written is not None
+                and ts - _arrivals_written < ARRIVAL_FLUSH_INTERVAL
+            ):
+                return False
+            pending = dict(_pending_arrivals)
+            _pending_arrivals.clear()
+            _arrivals_written = ts
+
+        by_day = {}
+        for (date, minute), n in pending.items():
+            by_day.setdefault(date, {})[minute] = n
+        for date, minutes in by_day.items():
+            try:
+                self._table.update_item(
+                    Key={"pk": "GLOBAL", "sk": "arrivals#" + date},
+                    UpdateExpression="ADD "
+                    + ", ".join(f"#m{i} :n{i}" for i in range(len(minutes)))
+                    + " SET expiresAt = if_not_exists(expiresAt, :expires)",
+                    ExpressionAttributeNames={
+                        f"#m{i}": f"m{minute}" for i, minute in enumerate(minutes)
+                    },
+                    ExpressionAttributeValues={
+                        **{
+                            f":n{i}": Decimal(n) for i, n in enumerate(minutes.values())
+                        },
+                        ":expires": Decimal(int(ts) + ARRIVAL_RETENTION),
+                    },
+                )
+            except ClientError:
+                # what is not written yet goes out with the next write
+                with _arrivals_lock:
+                    for key, n in pending.items():
+                        _pending_arrivals[key] = _pending_arrivals.get(key, 0) + n
+                raise
+            for minute in minutes:
+                del pending[(date, minute)]
+        return True
+
+    @timed("dynamo.get_arrival_counts")
+    def get_arrival_counts(self, since: float, until: float) -> Dict[int, int]:
+        # {minute start in epoch sec: number of requests} for [since, until)
+        first = datetime.utcfromtimestamp(since).date()
+        last = datetime.utcfromtimestamp(until).date()
+        days = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+        keys = [{"pk": "GLOBAL", "sk": "arrivals#" + d.isoformat()} for d in days]
+
+        counts = {}
+        dynamodb = get_resource("dynamodb")
+        for i in range(0, len(keys), 100):  # BatchGetItem limit
+            request = {self._table.name: {"Keys": keys[i : i + 100]}}
+            while request:
+                response = dynamodb.batch_get_item(RequestItems=request)
+                for item in response["Responses"].get(self._table.name, []):
+                    day = datetime.strptime(item["sk"].split("#", 1)[1], "%Y-%m-%d")
+                    start = (day - datetime(1970, 1, 1)).total_seconds()
+                    for name, value in item.items():
+                        if name.startswith("m") and name[1:].isdigit():
+                            minute_ts = int(start) + int(name[1:]) * 60
+                            if since <= minute_ts + 60 and minute_ts < until:
+                                counts[minute_ts] = int(value)
+                request = response.get("UnprocessedKeys")
+        return counts
+
+    @timed("dynamo.get_auto_termination")
     def get_auto_termination(self) -> Optional[int]:
         response = self._table.get_item(Key={"pk": "GLOBAL", "sk": "autoTermination"})
         item = response.get("Item")
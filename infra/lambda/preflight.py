@@ -1,6 +1,8 @@
 import json
+from logic_metrics import instrument_handler
 
 
+@instrument_handler
 def lambda_handler(event, context):
     return {
         "statusCode": 200,
@@ -1,28 +1,35 @@
 import os
 from logic_user_usage import UserUsage
+from logic_metrics import instrument_handler
 
+DEFAULT_FULL_CREDIT = 10000
+SCAN_SEGMENTS = int(os.environ.get("SCAN_SEGMENTS", "4"))
+WRITE_CONCURRENCY = int(os.environ.get("WRITE_CONCURRENCY", "8"))
 
+
+def load_full_credits() -> dict:
+    return {
+        os.environ["PLAN_NAME_FREE"]: int(os.environ["FULL_CREDIT_FREE"]),
+        os.environ["PLAN_NAME_STANDARD"]: int(os.environ["FULL_CREDIT_STANDARD"]),
+    }
+
+
+@instrument_handler
 def lambda_handler(event, context):
+    full_credits = load_full_credits()
     user_usage = UserUsage()
-    user_infos = user_usage.scan_user_infos()
+    user_infos = user_usage.scan_user_infos(total_segments=SCAN_SEGMENTS)
 
-    n_updated = 0
+    credits = {}
     for user_info in user_infos:
-        plan = user_info["plan"]
-        credit = int(user_info["credit"])
-
-        if plan == os.environ["PLAN_NAME_FREE"]:
-            full_credit = int(os.environ["FULL_CREDIT_FREE"])
-        elif plan == os.environ["PLAN_NAME_STANDARD"]:
-            full_credit = int(os.environ["FULL_CREDIT_STANDARD"])
-        else:
-            full_credit = 10000
-
-        if credit == full_credit:
-            continue
-
-        user_usage.username = user_info["pk"]
-        user_usage.update_user_credit(full_credit)
-        n_updated += 1
+        full_credit = full_credits.get(user_info["plan"], DEFAULT_FULL_CREDIT)
+        if int(user_info["credit"]) != full_credit:
+            credits[user_info["pk"]] = full_credit
+
+    n_updated = user_usage.update_user_credits(credits, WRITE_CONCURRENCY)
+    print(
+        f"scanned {len(user_infos)} users,"
+        f" consumed {user_usage.consumed_capacity} capacity units"
+    )
 
     return f"refreshed {n_updated} users' credit"
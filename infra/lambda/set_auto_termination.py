@@ -1,8 +1,10 @@
 import json
 from logic_user_usage import UserUsage, validate_admin_user
 from logic_server_controller import notify_line
+from logic_metrics import instrument_handler
 
 
+@instrument_handler
 def lambda_handler(event, context):
     if not validate_admin_user(event["headers"]["authorization"]):
         return {"statusCode": 404, "body": json.dumps("only root can control")}
@@ -1,28 +1,72 @@
 from logic_server_controller import ServerController, notify_line
-from logic_user_usage import UserUsage
+from logic_user_usage import UserUsage, LAST_CALLED_GRANULARITY
+from logic_scaling_policy import (
+    DAY,
+    START,
+    STOP,
+    ArrivalStats,
+    create_scaling_policy,
+)
 from datetime import datetime
+import os
+from logic_metrics import instrument_handler
 
+HISTORY_DAYS = int(os.environ.get("ARRIVAL_HISTORY_DAYS", "28"))
 
+
+@instrument_handler
 def lambda_handler(event, context):
+    # Runs every few minutes over every instance of the pool: stops each idle
+    # one, or starts a stopped one ahead of the demand predicted from the
+    # request history when none is up.
     server_controller = ServerController()
+    instances = server_controller.target_instances
+    if not instances:
+        print("no server found")
+        return False
 
-    if server_controller.get_target_instance_status() == "RUNNING":
-        user_usage = UserUsage()
-        last_called = user_usage.get_last_called()
-        if last_called:
-            duration = user_usage.get_auto_termination() or 60 * 40  # in sec
-            now = datetime.utcnow().timestamp()
-            if now - last_called >= duration:
-                server_controller.target_instance.stop()
-                notify_line("instance stop")
-                print("stopped server")
-                return True
+    user_usage = UserUsage()
+    now = datetime.utcnow().timestamp()
+    # the configured idle window stays the upper bound
+    duration = user_usage.get_auto_termination() or 60 * 40  # in sec
+    # lastCalled is written at most once per granularity, allow for the lag
+    policy = create_scaling_policy(max_idle=duration + 2 * LAST_CALLED_GRANULARITY)
+    counts = user_usage.get_arrival_counts(now - HISTORY_DAYS * DAY, now)
+    stats = ArrivalStats(counts, now, history_days=HISTORY_DAYS)
+    expected = stats.expected_arrivals(now, now + policy.horizon)
 
-            print("server idle time is not long")
-        else:
-            print("last called time is not available")
+    statuses = {instance.id: instance.state["Name"].upper() for instance in instances}
+    running = [i for i in instances if statuses[i.id] == "RUNNING"]
+    stopped = [i for i in instances if statuses[i.id] == "STOPPED"]
+    for instance in instances:
+        if instance not in running and instance not in stopped:
+            print(f"{instance.id} is {statuses[instance.id].lower()}")
 
-    else:
-        print("server is not running")
+    # lastCalled is shared by the pool, so an instance launched after it is
+    # idle only from its own launch on
+    last_called = user_usage.get_last_called() if running else None
+    changed = False
+    for instance in running:
+        last_active = max(last_called or 0, instance.launch_time.timestamp())
+        decision = policy.decide(now, True, last_active, stats)
+        print(f"{instance.id} running: {decision}, expecting {expected:.2f} requests")
+        if decision == STOP:
+            server_controller.stop(instance)
+            notify_line(f"instance stop ({instance.id})")
+            print(f"stopped {instance.id}")
+            changed = True
 
-    return False
+    # one stopped instance is enough to serve the predicted demand, and only
+    # when nothing is up or on its way up
+    if len(stopped) == len(instances):
+        instance = stopped[0]
+        decision = policy.decide(now, False, None, stats)
+        print(f"{instance.id} stopped: {decision}, expecting {expected:.2f} requests")
+        if decision == START:
+            server_controller.start(instance)
+            notify_line(
+                f"instance start ({instance.id}, expecting {expected:.1f} requests)"
+            )
+            print(f"started {instance.id} ahead of demand")
+            changed = True
+    return changed
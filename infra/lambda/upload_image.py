@@ -0,0 +1,43 @@
+import base64
+import binascii
+import json
+from logic_image_store import create_image_store, strip_data_url
+from logic_multipart import MultipartError, is_multipart, parse_multipart
+from logic_metrics import instrument_handler
+
+# kept across warm invocations
+image_store = create_image_store()
+
+
+def load_images(event: dict) -> dict:
+    # name -> base64 image. Multipart uploads may carry several files, a raw
+    # image body arrives base64-encoded by API Gateway and JSON clients send
+    # a data URL as plain text.
+    if is_multipart(event):
+        _, files = parse_multipart(event)
+        return {name: base64.b64encode(data).decode() for name, data in files.items()}
+    return {"image": strip_data_url(event.get("body") or "")}
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    try:
+        images = load_images(event)
+    except MultipartError as error:
+        return {"statusCode": 400, "body": json.dumps(f"invalid body: {error}")}
+    for img_str in images.values():
+        try:
+            if not base64.b64decode(img_str, validate=True):
+                raise ValueError("empty image")
+        except (binascii.Error, ValueError):
+            return {"statusCode": 400, "body": json.dumps("invalid image")}
+
+    handles = {name: image_store.put(img_str) for name, img_str in images.items()}
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {"handles": handles}
+            if is_multipart(event)
+            else {"handle": handles["image"]}
+        ),
+    }
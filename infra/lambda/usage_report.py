@@ -0,0 +1,49 @@
+import json
+from datetime import datetime
+from logic_user_usage import validate_admin_user
+from logic_usage_ledger import BUCKET_SECONDS, DAY, HOUR, UsageLedger
+from logic_metrics import instrument_handler
+
+DEFAULT_RANGE = 60 * 60 * 24  # in sec
+MAX_BUCKETS = 24 * 93  # a quarter of hours
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    # GET /sd-service/usage?since=&until=&granularity=hour|day&username=
+    # since and until in epoch sec, by default the last 24 hours; the usage
+    # of a user is by day
+    if not validate_admin_user(event["headers"]["authorization"]):
+        return {"statusCode": 404, "body": json.dumps("only root can read usage")}
+
+    params = event.get("queryStringParameters") or {}
+    username = params.get("username") or None
+    granularity = params.get("granularity", HOUR if username is None else DAY)
+    try:
+        until = float(params.get("until") or datetime.utcnow().timestamp())
+        since = float(params.get("since") or until - DEFAULT_RANGE)
+    except ValueError:
+        return {"statusCode": 400, "body": json.dumps("since and until are epoch sec")}
+    if granularity not in BUCKET_SECONDS:
+        return {"statusCode": 400, "body": json.dumps("granularity is hour or day")}
+    if username is not None and granularity != DAY:
+        return {"statusCode": 400, "body": json.dumps("user usage is by day")}
+    n_buckets = (until - since) / BUCKET_SECONDS[granularity]
+    if not 0 < n_buckets <= MAX_BUCKETS:
+        return {"statusCode": 400, "body": json.dumps("invalid range")}
+
+    ledger = UsageLedger()
+    buckets = ledger.get_rollups(since, until, granularity, username)
+    total = ledger.get_usage(since, until, username)
+    print(f"usage report read {ledger.consumed_capacity} capacity units")
+    return {
+        "statusCode": 200,
+        "body": json.dumps(
+            {
+                "granularity": granularity,
+                "username": username,
+                "buckets": buckets,
+                "total": total,
+            }
+        ),
+    }
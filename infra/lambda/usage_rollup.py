@@ -0,0 +1,41 @@
+from boto3.dynamodb.types import TypeDeserializer
+from logic_usage_ledger import EVENT_PREFIX, UsageLedger, rollup_events
+from logic_metrics import count, instrument_handler
+
+_deserializer = TypeDeserializer()
+
+
+def load_events(records: list) -> list:
+    # usage events inserted into the table; the event source filter already
+    # drops every other record, this only guards against a wider filter
+    events = []
+    for record in records:
+        if record.get("eventName") != "INSERT":
+            continue
+        image = record["dynamodb"].get("NewImage") or {}
+        if not image.get("sk", {}).get("S", "").startswith(EVENT_PREFIX):
+            continue
+        events.append(
+            {name: _deserializer.deserialize(value) for name, value in image.items()}
+        )
+    return events
+
+
+@instrument_handler
+def lambda_handler(event, context):
+    # Adds a batch of the table stream to the hourly and daily usage rollups
+    records = event["Records"]
+    events = load_events(records)
+    if not events:
+        return "no usage events"
+
+    # a retried batch comes with the same records
+    batch_id = f"{records[0]['eventID']}-{records[-1]['eventID']}"
+    ledger = UsageLedger()
+    n_buckets = ledger.apply_rollups(rollup_events(events), batch_id)
+    count("usage.events", len(events))
+    print(
+        f"rolled up {len(events)} usage events into {n_buckets} buckets,"
+        f" consumed {ledger.consumed_capacity} capacity units"
+    )
+    return f"rolled up {len(events)} usage events"
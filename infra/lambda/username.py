@@ -1,8 +1,10 @@
 import json
 import os
 from logic_user_usage import UserUsage
+from logic_metrics import instrument_handler
 
 
+@instrument_handler
 def lambda_handler(event, context):
     user_usage = UserUsage(event)
     usage = user_usage.get_user_usage()
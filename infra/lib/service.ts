@@ -19,6 +19,8 @@ import * as dynamodb from "aws-cdk-lib/aws-dynamodb";
 import { Construct } from "constructs";
 import * as events from "aws-cdk-lib/aws-events";
 import * as targets from "aws-cdk-lib/aws-events-targets";
+import * as sqs from "aws-cdk-lib/aws-sqs";
+import * as lambdaEventSources from "aws-cdk-lib/aws-lambda-event-sources";
 
 export class ServiceStack extends Stack {
   constructor(scope: Construct, id: string, props?: StackProps) {
@@ -49,6 +51,11 @@ export class ServiceStack extends Stack {
     // S3
     const bucket = new s3.Bucket(this, "workBucket", {
       bucketName: "retouchapp-work",
+      lifecycleRules: [
+        { prefix: "jobs/", expiration: Duration.days(1) },
+        { prefix: "cache/", expiration: Duration.days(1) },
+        { prefix: "images/", expiration: Duration.days(1) },
+      ],
     });
 
     // TODO cognito と dynamoのようなユーザ管理に関するものは別スタックにする
@@ -65,6 +72,47 @@ export class ServiceStack extends Stack {
       },
       billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
       removalPolicy: RemovalPolicy.RETAIN,
+      timeToLiveAttribute: "expiresAt",
+    });
+    // the usage ledger (logic_usage_ledger.py), apart from the users so that
+    // scans of the user table do not read through it
+    const usageTable = new dynamodb.Table(this, "retouchappUsageDB", {
+      tableName: "retouchappUsageDB",
+      partitionKey: {
+        name: "pk",
+        type: dynamodb.AttributeType.STRING,
+      },
+      sortKey: {
+        name: "sk",
+        type: dynamodb.AttributeType.STRING,
+      },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      removalPolicy: RemovalPolicy.RETAIN,
+      timeToLiveAttribute: "expiresAt",
+      // usage events are rolled up from the stream (usage_rollup.py)
+      stream: dynamodb.StreamViewType.NEW_IMAGE,
+    });
+
+    // SQS
+    // a job whose worker is killed on every delivery ends up here; the worker
+    // fails and refunds it on the last one (JOB_MAX_RECEIVES)
+    const generateJobMaxReceives = 3;
+    const generateJobDeadLetterQueue = new sqs.Queue(
+      this,
+      "generateJobDeadLetterQueue",
+      {
+        queueName: "retouchapp-generate-job-dlq",
+        retentionPeriod: Duration.days(14),
+      }
+    );
+    const generateJobQueue = new sqs.Queue(this, "generateJobQueue", {
+      queueName: "retouchapp-generate-job",
+      visibilityTimeout: Duration.minutes(6),
+      retentionPeriod: Duration.hours(1),
+      deadLetterQueue: {
+        queue: generateJobDeadLetterQueue,
+        maxReceiveCount: generateJobMaxReceives,
+      },
     });
 
     // Cognito
@@ -164,16 +212,21 @@ export class ServiceStack extends Stack {
         handler: "shutdown_server.lambda_handler",
         functionName: "retouchapp-shutdown-server",
         logRetention: logs.RetentionDays.FIVE_DAYS,
-        timeout: Duration.seconds(6),
+        timeout: Duration.seconds(15),
         environment: {
           DYNAMO_TABLE_NAME: dynamoTable.tableName,
           LINE_NOTIFY_ACCESS_TOKEN: lineNotifyAccessToken,
+          SD_BOOT_TIME: "300",
+          GPU_COST_PER_HOUR: "0.71",
+          WAIT_COST_PER_HOUR: "20",
+          MIN_IDLE_TIME: "600",
+          ARRIVAL_HISTORY_DAYS: "28",
         },
       }
     );
     dynamoTable.grantReadWriteData(shutdownServerLambda);
     new events.Rule(this, "shutdownServerRule", {
-      schedule: events.Schedule.cron({ minute: "0/15" }),
+      schedule: events.Schedule.cron({ minute: "0/5" }),
       targets: [
         new targets.LambdaFunction(shutdownServerLambda, { retryAttempts: 2 }),
       ],
@@ -277,13 +330,88 @@ export class ServiceStack extends Stack {
       securityGroups: [securityGroupAppClient],
       environment: {
         DYNAMO_TABLE_NAME: dynamoTable.tableName,
+        USAGE_TABLE_NAME: usageTable.tableName,
         CREDIT_CONSUMPTION: servicePlan.creditForImageGeneration,
         SD_SERVER_URL: sdServerUrl,
+        SD_BACKEND_DISCOVERY: "ec2",
+        JOB_QUEUE_URL: generateJobQueue.queueUrl,
+        WORK_BUCKET_NAME: bucket.bucketName,
+        PLAN_NAME_FREE: servicePlan.planNameFree,
+        PLAN_NAME_STANDARD: servicePlan.planNameStandard,
+        ADMISSION_MAX_WAIT: "8",
+        CIRCUIT_AUTO_START: "1",
       },
       reservedConcurrentExecutions: 1,
     });
-    bucket.grantWrite(generateLambda.role!);
+    bucket.grantReadWrite(generateLambda.role!);
     dynamoTable.grantReadWriteData(generateLambda);
+    usageTable.grantReadWriteData(generateLambda);
+    generateJobQueue.grantSendMessages(generateLambda);
+    generateJobQueue.grant(generateLambda, "sqs:GetQueueAttributes");
+
+    const generateWorkerLambda = new lambda.Function(
+      this,
+      "generateWorkerLambda",
+      {
+        runtime: lambda.Runtime.PYTHON_3_8,
+        code: lambda.Code.fromAsset("lambda"),
+        handler: "generate_worker.lambda_handler",
+        functionName: "retouchapp-generate-worker",
+        logRetention: logs.RetentionDays.FIVE_DAYS,
+        layers: [
+          pillowLayerPy38,
+          numpyLayerPy38,
+          opencvLayerPy38,
+          libgthreadLayerPy38,
+        ],
+        timeout: Duration.minutes(5),
+        vpc: vpc,
+        securityGroups: [securityGroupAppClient],
+        environment: {
+          DYNAMO_TABLE_NAME: dynamoTable.tableName,
+          USAGE_TABLE_NAME: usageTable.tableName,
+          CREDIT_CONSUMPTION: servicePlan.creditForImageGeneration,
+          SD_SERVER_URL: sdServerUrl,
+          SD_BACKEND_DISCOVERY: "ec2",
+          JOB_QUEUE_URL: generateJobQueue.queueUrl,
+          WORK_BUCKET_NAME: bucket.bucketName,
+          PLAN_NAME_FREE: servicePlan.planNameFree,
+          PLAN_NAME_STANDARD: servicePlan.planNameStandard,
+          ADMISSION_WORKER_MAX_WAIT: "240",
+          JOB_MAX_RECEIVES: String(generateJobMaxReceives),
+          MAX_BATCH_SIZE: "4",
+          BATCH_WINDOW: "0",
+        },
+        reservedConcurrentExecutions: 1,
+      }
+    );
+    bucket.grantReadWrite(generateWorkerLambda.role!);
+    dynamoTable.grantReadWriteData(generateWorkerLambda);
+    usageTable.grantReadWriteData(generateWorkerLambda);
+    generateJobQueue.grant(generateWorkerLambda, "sqs:GetQueueAttributes");
+    generateWorkerLambda.addEventSource(
+      new lambdaEventSources.SqsEventSource(generateJobQueue, {
+        batchSize: 4,
+        maxBatchingWindow: Duration.seconds(1),
+      })
+    );
+
+    const jobStatusLambda = new lambda.Function(this, "jobStatusLambda", {
+      runtime: lambda.Runtime.PYTHON_3_10,
+      code: lambda.Code.fromAsset("lambda"),
+      handler: "job_status.lambda_handler",
+      functionName: "retouchapp-job-status",
+      logRetention: logs.RetentionDays.FIVE_DAYS,
+      timeout: Duration.seconds(10),
+      environment: {
+        DYNAMO_TABLE_NAME: dynamoTable.tableName,
+        JOB_QUEUE_URL: generateJobQueue.queueUrl,
+        WORK_BUCKET_NAME: bucket.bucketName,
+      },
+    });
+    bucket.grantRead(jobStatusLambda.role!);
+    dynamoTable.grantReadData(jobStatusLambda);
+    generateJobQueue.grant(jobStatusLambda, "sqs:GetQueueAttributes");
 
     const edgeLambda = new lambda.Function(this, "edgeLambda", {
       runtime: lambda.Runtime.PYTHON_3_10,
@@ -297,13 +425,34 @@ export class ServiceStack extends Stack {
       securityGroups: [securityGroupAppClient],
       environment: {
         DYNAMO_TABLE_NAME: dynamoTable.tableName,
+        USAGE_TABLE_NAME: usageTable.tableName,
         CREDIT_CONSUMPTION: servicePlan.creditForEdgeDetection,
         SD_SERVER_URL: sdServerUrl,
+        SD_BACKEND_DISCOVERY: "ec2",
+        WORK_BUCKET_NAME: bucket.bucketName,
+        PLAN_NAME_FREE: servicePlan.planNameFree,
+        PLAN_NAME_STANDARD: servicePlan.planNameStandard,
+        ADMISSION_MAX_WAIT: "8",
+        CIRCUIT_AUTO_START: "1",
       },
       reservedConcurrentExecutions: 1,
     });
-    bucket.grantRead(edgeLambda.role!);
+    bucket.grantReadWrite(edgeLambda.role!);
     dynamoTable.grantReadWriteData(edgeLambda);
+    usageTable.grantReadWriteData(edgeLambda);
+
+    const uploadImageLambda = new lambda.Function(this, "uploadImageLambda", {
+      runtime: lambda.Runtime.PYTHON_3_10,
+      code: lambda.Code.fromAsset("lambda"),
+      handler: "upload_image.lambda_handler",
+      functionName: "retouchapp-upload-image",
+      logRetention: logs.RetentionDays.FIVE_DAYS,
+      timeout: Duration.seconds(10),
+      environment: {
+        WORK_BUCKET_NAME: bucket.bucketName,
+      },
+    });
+    bucket.grantReadWrite(uploadImageLambda.role!);
 
     const appSeverStatusLambda = new lambda.Function(
       this,
@@ -320,9 +469,41 @@ export class ServiceStack extends Stack {
         securityGroups: [securityGroupAppClient],
         environment: {
           SD_SERVER_URL: sdServerUrl,
+          SD_BACKEND_DISCOVERY: "ec2",
+          DYNAMO_TABLE_NAME: dynamoTable.tableName,
+          PLAN_NAME_FREE: servicePlan.planNameFree,
+          PLAN_NAME_STANDARD: servicePlan.planNameStandard,
         },
       }
     );
+    // admission state for ?detail=1, and the shared circuit breaker state
+    dynamoTable.grantReadWriteData(appSeverStatusLambda);
+
+    // SD backends are discovered from the tagged instances
+    for (const sdClientLambda of [
+      generateLambda,
+      generateWorkerLambda,
+      edgeLambda,
+      appSeverStatusLambda,
+    ]) {
+      sdClientLambda.addToRolePolicy(
+        new iam.PolicyStatement({
+          effect: iam.Effect.ALLOW,
+          actions: ["ec2:DescribeInstances"],
+          resources: ["*"],
+        })
+      );
+    }
+    // the circuit breaker starts a stopped server (CIRCUIT_AUTO_START)
+    for (const autoStartLambda of [generateLambda, edgeLambda]) {
+      autoStartLambda.addToRolePolicy(
+        new iam.PolicyStatement({
+          effect: iam.Effect.ALLOW,
+          actions: ["ec2:StartInstances"],
+          resources: ["*"],
+        })
+      );
+    }
 
     const refreshCreditLambda = new lambda.Function(
       this,
@@ -333,7 +514,10 @@ export class ServiceStack extends Stack {
         handler: "refresh_credit.lambda_handler",
         functionName: "retouchapp-refresh-credit",
         logRetention: logs.RetentionDays.FIVE_DAYS,
+        timeout: Duration.minutes(5),
         environment: {
+          SCAN_SEGMENTS: "4",
+          WRITE_CONCURRENCY: "8",
           DYNAMO_TABLE_NAME: dynamoTable.tableName,
           PLAN_NAME_FREE: servicePlan.planNameFree,
           PLAN_NAME_STANDARD: servicePlan.planNameStandard,
@@ -350,6 +534,52 @@ export class ServiceStack extends Stack {
       ],
     });
 
+    const usageRollupLambda = new lambda.Function(this, "usageRollupLambda", {
+      runtime: lambda.Runtime.PYTHON_3_10,
+      code: lambda.Code.fromAsset("lambda"),
+      handler: "usage_rollup.lambda_handler",
+      functionName: "retouchapp-usage-rollup",
+      logRetention: logs.RetentionDays.FIVE_DAYS,
+      timeout: Duration.seconds(30),
+      environment: {
+        USAGE_TABLE_NAME: usageTable.tableName,
+      },
+    });
+    usageTable.grantReadWriteData(usageRollupLambda);
+    // a failed batch is retried unchanged (no bisecting), so that the rollups
+    // can tell a retried batch by its records
+    usageRollupLambda.addEventSource(
+      new lambdaEventSources.DynamoEventSource(usageTable, {
+        startingPosition: lambda.StartingPosition.TRIM_HORIZON,
+        batchSize: 500,
+        maxBatchingWindow: Duration.seconds(10),
+        retryAttempts: 10,
+        filters: [
+          lambda.FilterCriteria.filter({
+            eventName: lambda.FilterRule.isEqual("INSERT"),
+            dynamodb: {
+              Keys: { sk: { S: lambda.FilterRule.beginsWith("usage#") } },
+            },
+          }),
+        ],
+      })
+    );
+
+    const usageReportLambda = new lambda.Function(this, "usageReportLambda", {
+      runtime: lambda.Runtime.PYTHON_3_10,
+      code: lambda.Code.fromAsset("lambda"),
+      handler: "usage_report.lambda_handler",
+      functionName: "retouchapp-usage-report",
+      logRetention: logs.RetentionDays.FIVE_DAYS,
+      timeout: Duration.seconds(10),
+      environment: {
+        DYNAMO_TABLE_NAME: dynamoTable.tableName,
+        USAGE_TABLE_NAME: usageTable.tableName,
+      },
+    });
+    dynamoTable.grantReadData(usageReportLambda);
+    usageTable.grantReadData(usageReportLambda);
+
     httpApi.addRoutes({
       integration: new apigwv2Integrations.HttpLambdaIntegration(
         "preflightIntegration",
@@ -381,6 +611,17 @@ export class ServiceStack extends Stack {
       authorizer: httpAuthorizer,
     });
 
+    httpApi.addRoutes({
+      integration: new apigwv2Integrations.HttpLambdaIntegration(
+        "jobStatusIntegration",
+        jobStatusLambda
+      ),
+      path: "/render/jobs",
+      methods: [apigwv2.HttpMethod.GET],
+      authorizationScopes: ["aws.cognito.signin.user.admin"],
+      authorizer: httpAuthorizer,
+    });
+
     httpApi.addRoutes({
       integration: new apigwv2Integrations.HttpLambdaIntegration(
         "edgeIntegration",
@@ -391,6 +632,18 @@ export class ServiceStack extends Stack {
       authorizationScopes: ["aws.cognito.signin.user.admin"],
       authorizer: httpAuthorizer,
     });
+
+    httpApi.addRoutes({
+      integration: new apigwv2Integrations.HttpLambdaIntegration(
+        "uploadImageIntegration",
+        uploadImageLambda
+      ),
+      path: "/render/images",
+      methods: [apigwv2.HttpMethod.POST],
+      authorizationScopes: ["aws.cognito.signin.user.admin"],
+      authorizer: httpAuthorizer,
+    });
+
     httpApi.addRoutes({
       integration: new apigwv2Integrations.HttpLambdaIntegration(
         "appServerStatusIntegration",
@@ -432,6 +685,16 @@ export class ServiceStack extends Stack {
       authorizationScopes: ["aws.cognito.signin.user.admin"],
       authorizer: httpAuthorizer,
     });
+    httpApi.addRoutes({
+      integration: new apigwv2Integrations.HttpLambdaIntegration(
+        "usageReportIntegration",
+        usageReportLambda
+      ),
+      path: "/sd-service/usage",
+      methods: [apigwv2.HttpMethod.GET],
+      authorizationScopes: ["aws.cognito.signin.user.admin"],
+      authorizer: httpAuthorizer,
+    });
 
     // output
     new CfnOutput(this, "userPoolId", { value: userPool.userPoolId });
@@ -0,0 +1,120 @@
+"""Benchmarks the anti-glare post-process against the full-frame original.
+
+The original filtered the whole image with cv2.edgePreservingFilter and
+composited with bitwise_and/add; logic_image.anti_glare_filter filters only
+the mask's bounding box plus the filter's reach, in place, with scratch
+buffers kept across calls. Both run on synthetic noise images with a
+brush-sized circular mask at random positions. Reports the median latency
+and the peak traced memory of each at every size, whether the outputs match
+with a hard mask, and the scratch memory kept after --bboxes different masks.
+
+Needs numpy and opencv.
+
+    python tools/bench_anti_glare.py
+    python tools/bench_anti_glare.py --sizes 512,1024 --sigma-s 40 --repeat 10
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "..", "lambda"))
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+import logic_image  # noqa: E402
+
+FLAGS = 1  # cv2.RECURS_FILTER
+
+
+def full_frame_filter(image, mask, sigma_s: float, sigma_r: float):
+    # the implementation before logic_image.anti_glare_filter
+    filtered = cv2.edgePreservingFilter(
+        image, flags=FLAGS, sigma_s=sigma_s, sigma_r=sigma_r
+    )
+    masked_filtered = cv2.bitwise_and(filtered, filtered, mask=mask)
+    masked_image = cv2.bitwise_and(image, image, mask=cv2.bitwise_not(mask))
+    return cv2.add(masked_image, masked_filtered)
+
+
+def bbox_filter(image, mask, sigma_s: float, sigma_r: float):
+    return logic_image.anti_glare_filter(image, mask, FLAGS, sigma_s, sigma_r)
+
+
+def make_inputs(rng, size: int, radius: int) -> tuple:
+    image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    center = tuple(int(v) for v in rng.integers(radius, size - radius, 2))
+    cv2.circle(mask, center, radius, 255, -1)
+    return image, mask
+
+
+def measure(func, inputs: list, sigma_s: float, sigma_r: float) -> tuple:
+    # -> (median sec, peak traced bytes); the first call warms the buffers up
+    func(inputs[0][0].copy(), inputs[0][1], sigma_s, sigma_r)
+    times = []
+    peak = 0
+    for image, mask in inputs:
+        image = image.copy()
+        tracemalloc.start()
+        start = time.perf_counter()
+        func(image, mask, sigma_s, sigma_r)
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return statistics.median(times), peak
+
+
+def kept_buffers() -> tuple:
+    buffers = getattr(logic_image._local, "buffers", {})
+    return len(buffers), sum(b.nbytes for b in buffers.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="512,768,1024", help="px, square")
+    parser.add_argument("--radius", type=int, default=60, help="of the mask, px")
+    parser.add_argument("--sigma-s", type=float, default=20)
+    parser.add_argument("--sigma-r", type=float, default=0.4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--bboxes", type=int, default=50)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"sigma_s {args.sigma_s}, sigma_r {args.sigma_r}, radius {args.radius}px")
+    print(
+        f"{'size':>6} {'full ms':>8} {'full MB':>8} {'bbox ms':>8} {'bbox MB':>8} "
+        f"{'same':>5}"
+    )
+    for size in (int(v) for v in args.sizes.split(",")):
+        inputs = [make_inputs(rng, size, args.radius) for _ in range(args.repeat)]
+        full = measure(full_frame_filter, inputs, args.sigma_s, args.sigma_r)
+        bbox = measure(bbox_filter, inputs, args.sigma_s, args.sigma_r)
+        image, mask = inputs[0]
+        expected = full_frame_filter(image, mask, args.sigma_s, args.sigma_r)
+        actual = bbox_filter(image.copy(), mask, args.sigma_s, args.sigma_r)
+        same = bool(np.array_equal(expected, actual))
+        print(
+            f"{size:>6} {full[0] * 1000:>8.1f} {full[1] / 2**20:>8.1f} "
+            f"{bbox[0] * 1000:>8.1f} {bbox[1] / 2**20:>8.1f} {str(same):>5}"
+        )
+
+    # masks of every size and position, as successive requests bring them
+    sizes = [int(v) for v in args.sizes.split(",")]
+    for i in range(args.bboxes):
+        size = sizes[i % len(sizes)]
+        radius = int(rng.integers(8, size // 4))
+        image, mask = make_inputs(rng, size, radius)
+        logic_image.anti_glare_filter(
+            image, mask, FLAGS, args.sigma_s, args.sigma_r, mask_blur=4
+        )
+    count, n_bytes = kept_buffers()
+    print(f"after {args.bboxes} masks: {count} buffers, {n_bytes / 2**20:.1f}MB kept")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Throughput and tail latency of the SD backend pool against fake servers.
+
+Starts one fake SD server per ``--delays`` entry, points the pool at them via
+SD_SERVER_URLS and fires ``--requests`` img2img calls from ``--concurrency``
+threads. ``--kill-after`` stops the first server midway to exercise failover.
+
+    python tools/bench_backend_pool.py --delays 0.2,0.2,0.6 --concurrency 6
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+)
+
+from fake_sd_server import FakeSDServer  # noqa: E402
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--delays", default="0.2,0.2,0.6", help="sec per image")
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=6)
+    parser.add_argument("--kill-after", type=int, default=None)
+    args = parser.parse_args()
+
+    servers = [FakeSDServer(delay=float(d)).start() for d in args.delays.split(",")]
+    os.environ["SD_SERVER_URLS"] = ",".join(server.url for server in servers)
+    os.environ["BACKEND_HEALTH_INTERVAL"] = "0.5"
+
+    from logic_backend_pool import get_backend_pool
+
+    pool = get_backend_pool()
+    n_done = 0
+    lock = threading.Lock()
+
+    def call(_) -> tuple:
+        nonlocal n_done
+        start = time.perf_counter()
+        try:
+            pool.post("/sdapi/v1/img2img", {"init_images": ["x"]}, timeout=30)
+            error = None
+        except Exception as e:
+            error = e
+        with lock:
+            n_done += 1
+            if n_done == args.kill_after:
+                print(f"stopping {servers[0].url}")
+                servers[0].stop()
+        return time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(call, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, error in results if error is None]
+    errors = [error for _, error in results if error is not None]
+    print(
+        f"{len(latencies)} ok, {len(errors)} failed in {elapsed:.2f}s:"
+        f" {len(latencies) / elapsed:.2f} req/s,"
+        f" p50 {statistics.median(latencies) * 1000:.0f}ms"
+        f" p99 {percentile(latencies, 0.99) * 1000:.0f}ms"
+    )
+    for server in servers:
+        print(f"    {server.url} ({server.delay}s): {server.n_requests} requests")
+
+
+if __name__ == "__main__":
+    main()
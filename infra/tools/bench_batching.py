@@ -0,0 +1,145 @@
+"""Measures images/sec of the worker's batching dispatcher against its window.
+
+Sends --requests img2img payloads built by generate.build_img2img_payload
+through logic_batching.BatchingDispatcher to a fake SD server
+(tools/fake_sd_server.py), --batch-size at a time as the worker runs one SQS
+batch, once per --windows value. A window of 0 does not wait, so only
+requests submitted at the same moment share a call. Two workloads:
+
+  realistic  one job per user, each with its own image, mask and prompt and
+             a random seed, as the jobs of an SQS batch are
+  ideal      the same mask, prompt and settings for every job and no
+             reference_only unit (it carries the job's own image), so that
+             only init_images differ and every batch fills up
+
+--batch-cost sets how much of the per-image delay each further image of a
+batch costs on the fake GPU. Reports images/sec, latency percentiles and the
+SD calls made.
+
+    python tools/bench_batching.py --requests 32 --sd-delay 0.5
+    python tools/bench_batching.py --windows 0,0.05,0.2 --batch-cost 0.6
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_handlers import ENVIRONMENT, generate_events, percentile  # noqa: E402
+from fake_sd_server import FakeSDServer  # noqa: E402
+
+PROMPTS = ("1girl", "1girl, smile", "1boy, jacket", "landscape, sky")
+
+
+def make_bodies(args, workload: str) -> list:
+    import json
+
+    from bench_handlers import make_mask
+    from fake_sd_server import make_png
+
+    width, height = args.image_size
+    events_args = argparse.Namespace(
+        requests=args.requests,
+        image_size=args.image_size,
+        seed=None,
+        anti_glare=False,
+        only_masked=False,
+    )
+    bodies = [json.loads(e["body"]) for e in generate_events(events_args, 1)]
+    for i, body in enumerate(bodies):
+        # every job brings its own picture
+        body["imageData"] = "data:image/png;base64," + make_png(width, height + i)
+        if workload == "realistic":
+            # masks differ in at least one pixel, prompts come from a few
+            mask = make_mask(width - i % 7, height)
+            body["maskData"] = "data:image/png;base64," + mask
+            body["positivePrompt"] = PROMPTS[i % len(PROMPTS)]
+            body["denosing"] = (0.5, 0.6, 0.75)[i % 3]
+        else:
+            # reference_only gets the job's own image, which batches cannot share
+            body["useReference"] = False
+    return bodies
+
+
+def run(args, payloads: list, window: float, server: FakeSDServer) -> dict:
+    from logic_batching import BatchingDispatcher
+    from logic_sd_client import get_sd_client
+
+    client = get_sd_client(server.url)
+
+    def send(data: dict, on_progress=None) -> list:
+        return client.post("/sdapi/v1/img2img", data, timeout=600)["images"]
+
+    dispatcher = BatchingDispatcher(send, window=window, max_batch_size=args.batch_size)
+    latencies = []
+
+    def request(data: dict):
+        started = time.perf_counter()
+        dispatcher.request(data)
+        latencies.append(time.perf_counter() - started)
+
+    n_calls = server.n_requests
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(0, len(payloads), args.batch_size):
+            # the worker finishes one SQS batch before it gets the next
+            with ThreadPoolExecutor(max_workers=args.batch_size) as executor:
+                list(executor.map(request, payloads[i : i + args.batch_size]))
+    wall = time.perf_counter() - started
+    return {
+        "images/s": len(payloads) / wall,
+        "p50 s": percentile(latencies, 0.5),
+        "p95 s": percentile(latencies, 0.95),
+        "SD calls": server.n_requests - n_calls,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=4, help="MAX_BATCH_SIZE")
+    parser.add_argument("--windows", default="0,0.05,0.2", help="in sec")
+    parser.add_argument("--sd-delay", type=float, default=0.5, help="sec per image")
+    parser.add_argument("--batch-cost", type=float, default=0.6, help="x delay")
+    parser.add_argument("--image-size", default="512x768", help="WIDTHxHEIGHT")
+    args = parser.parse_args()
+    args.image_size = tuple(int(v) for v in args.image_size.lower().split("x"))
+    windows = [float(w) for w in args.windows.split(",")]
+
+    os.environ.update(ENVIRONMENT)
+    server = FakeSDServer(delay=args.sd_delay, image_size=(64, 64)).start()
+    server.batch_cost = args.batch_cost
+    os.environ["SD_SERVER_URL"] = server.url
+    with contextlib.redirect_stdout(io.StringIO()):
+        from generate import build_img2img_payload
+
+    print(
+        f"{args.requests} requests, {args.batch_size} per SQS batch, "
+        f"{args.sd_delay}s per image, batch cost {args.batch_cost}"
+    )
+    print(
+        f"{'workload':<10} {'window':>7} {'images/s':>9} {'p50 s':>7} "
+        f"{'p95 s':>7} {'SD calls':>9}"
+    )
+    try:
+        for workload in ("realistic", "ideal"):
+            payloads = [build_img2img_payload(b) for b in make_bodies(args, workload)]
+            for window in windows:
+                result = run(args, payloads, window, server)
+                print(
+                    f"{workload:<10} {window:>7.2f} {result['images/s']:>9.2f} "
+                    f"{result['p50 s']:>7.2f} {result['p95 s']:>7.2f} "
+                    f"{result['SD calls']:>9}"
+                )
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Measures time-to-fail and wasted Lambda seconds against a flapping SD server.
+
+A fake SD server (tools/fake_sd_server.py) goes up and down on a fixed
+schedule while --clients simulated generate invocations call it back to back,
+each as generate does: BackendPool.check_available(), then img2img. While
+down, the server either looks like a stopped instance (--down stopped: the
+port takes no connections, so connecting hangs) or like a booting one
+(--down booting: connections are refused). Compares
+
+    none     no breaker, connecting may take the whole request timeout
+    timeout  no breaker, with the SD_CONNECT_TIMEOUT of logic_sd_client
+    breaker  connect timeout and circuit breaker (logic_circuit_breaker)
+
+and reports per mode the calls that succeeded and failed, the time to fail,
+the Lambda seconds spent on failed calls, and how long after the server came
+back the first call succeeded.
+
+    python tools/bench_circuit_breaker.py
+    python tools/bench_circuit_breaker.py --down booting --up 5 --cycles 3
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+)
+
+import logic_sd_client  # noqa: E402
+from fake_sd_server import FakeSDServer  # noqa: E402
+from logic_backend_pool import BackendPool  # noqa: E402
+from logic_circuit_breaker import CircuitBreaker  # noqa: E402
+
+MODES = ("none", "timeout", "breaker")
+DOWN_MODES = ("stopped", "booting")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class FlappingServer:
+    # a fake SD server on a fixed port that can be taken down and up again
+    def __init__(self, delay: float, down_mode: str):
+        self.delay = delay
+        self.down_mode = down_mode
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        self.port = probe.getsockname()[1]
+        probe.close()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = None
+        self._sockets = []
+        self.up_since = None
+
+    def up(self):
+        for sock in self._sockets:
+            sock.close()
+        self._sockets = []
+        self._server = FakeSDServer(port=self.port, delay=self.delay).start()
+        self.up_since = time.monotonic()
+
+    def down(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+        self.up_since = None
+        if self.down_mode == "booting":
+            return  # nothing listens, connections are refused
+        # a listener that never accepts, with its backlog filled up, drops
+        # the SYNs like an instance that is not there
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("127.0.0.1", self.port))
+        listener.listen(0)
+        self._sockets = [listener]
+        for _ in range(3):
+            filler = socket.socket()
+            filler.settimeout(0.2)
+            try:
+                filler.connect(("127.0.0.1", self.port))
+            except OSError:
+                pass
+            self._sockets.append(filler)
+
+    def stop(self):
+        self.down()
+        for sock in self._sockets:
+            sock.close()
+
+
+def run(args, mode: str) -> dict:
+    server = FlappingServer(args.sd_delay, args.down)
+    breaker = None
+    if mode == "breaker":
+        breaker = CircuitBreaker(open_interval=args.open_interval)
+    pool = BackendPool(discover=lambda: [server.url], breaker=breaker)
+    logic_sd_client.CONNECT_TIMEOUT = (
+        args.timeout if mode == "none" else args.connect_timeout
+    )
+
+    results = []  # (server was up at the start, ok, duration)
+    recoveries = []  # sec from the server coming back to the first success
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def client():
+        while not stop.is_set():
+            up_since = server.up_since
+            start = time.monotonic()
+            try:
+                pool.check_available()
+                pool.post("/sdapi/v1/img2img", {"steps": 1}, timeout=args.timeout)
+                ok = True
+            except Exception:
+                ok = False
+            end = time.monotonic()
+            with lock:
+                results.append((up_since is not None, ok, end - start))
+                if ok and server.up_since is not None:
+                    since = server.up_since
+                    if not recoveries or recoveries[-1][0] != since:
+                        recoveries.append((since, end - since))
+            if not ok:
+                time.sleep(args.retry_interval)
+
+    server.up()
+    threads = [threading.Thread(target=client) for _ in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for _ in range(args.cycles):
+        time.sleep(args.up)
+        server.down()
+        time.sleep(args.down_time)
+        server.up()
+    time.sleep(args.up)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    server.stop()
+
+    failed = [duration for _, ok, duration in results if not ok]
+    return {
+        "ok": sum(ok for _, ok, _ in results),
+        "failed": len(failed),
+        "failP50": percentile(failed, 0.5),
+        "failMax": max(failed, default=float("nan")),
+        "wasted": sum(failed),
+        # the first up phase has nothing to recover from
+        "recovery": max((sec for _, sec in recoveries[1:]), default=float("nan")),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=MODES, help="default: all")
+    parser.add_argument("--down", choices=DOWN_MODES, default="stopped")
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--up", type=float, default=6, help="sec per up phase")
+    parser.add_argument("--down-time", type=float, default=12, help="sec")
+    parser.add_argument("--cycles", type=int, default=2)
+    parser.add_argument("--sd-delay", type=float, default=0.5, help="sec")
+    parser.add_argument("--timeout", type=float, default=30, help="img2img, sec")
+    parser.add_argument("--connect-timeout", type=float, default=3, help="sec")
+    parser.add_argument("--open-interval", type=float, default=5, help="sec")
+    parser.add_argument("--retry-interval", type=float, default=1, help="sec")
+    args = parser.parse_args()
+
+    print(
+        f"{args.clients} clients, server up {args.up}s / down ({args.down})"
+        f" {args.down_time}s x {args.cycles}"
+    )
+    print(
+        f"    {'mode':9}{'ok':>6}{'failed':>8}{'fail p50':>10}{'fail max':>10}"
+        f"{'wasted':>9}{'recovery':>10}"
+    )
+    for mode in [args.mode] if args.mode else MODES:
+        result = run(args, mode)
+        print(
+            f"    {mode:9}{result['ok']:6d}{result['failed']:8d}"
+            f"{result['failP50']:9.2f}s{result['failMax']:9.2f}s"
+            f"{result['wasted']:8.1f}s{result['recovery']:9.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Hammers one user's credit from many threads and counts DynamoDB calls.
+
+With DynamoDB mocked by moto or served by DynamoDB Local
+(--dynamodb-endpoint), checks that credit is never overspent:
+
+  reserve   --threads threads make --attempts reservations of --amount on a
+            balance of --balance; exactly balance // amount may succeed
+  refund    the same, each thread refunding every other reservation it got;
+            the balance must end at what was kept
+  generate  --requests concurrent generate.lambda_handler calls of one user
+            with --credit credits, against a fake SD server
+            (tools/fake_sd_server.py); no more may succeed than were paid
+            for, and failed or rejected calls must be refunded
+
+and then reports the DynamoDB calls per uncached generate and edge request,
+by operation. Exits non-zero when a check fails.
+
+moto evaluates a condition and applies the update in separate steps without a
+lock, so concurrent calls can both pass the check; DynamoDB does both
+atomically per item. Under moto the requests are therefore serialized, as the
+checks are about the handlers, not about moto.
+
+    python tools/bench_credit.py
+    python tools/bench_credit.py --threads 16 --attempts 200 --requests 40
+    python tools/bench_credit.py --dynamodb-endpoint http://localhost:8000
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_handlers import ENVIRONMENT, create_table, edge_events  # noqa: E402
+from bench_handlers import generate_events, seed_users  # noqa: E402
+from fake_sd_server import FakeSDServer  # noqa: E402
+
+USER = "user0"
+
+
+class CallCounter:
+    # DynamoDB operations made through the default boto3 session
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, model, **kwargs):
+        with self._lock:
+            self.calls[model.name] += 1
+
+    def take(self) -> Counter:
+        with self._lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+
+@contextlib.contextmanager
+def atomic_moto():
+    # one DynamoDB request at a time, like the item-level atomicity of DynamoDB
+    from moto import mock_aws
+    from moto.dynamodb.responses import DynamoHandler
+
+    lock = threading.Lock()
+    call_action = DynamoHandler.call_action
+
+    def locked_call_action(self):
+        with lock:
+            return call_action(self)
+
+    DynamoHandler.call_action = locked_call_action
+    try:
+        with mock_aws():
+            yield
+    finally:
+        DynamoHandler.call_action = call_action
+
+
+def make_user_usage():
+    from logic_user_usage import UserUsage
+
+    user_usage = UserUsage()
+    user_usage.username = USER
+    return user_usage
+
+
+def set_credit(credit: int):
+    make_user_usage().update_user_credit(credit)
+
+
+def get_credit() -> int:
+    return int(make_user_usage().get_user_usage()["credit"])
+
+
+def hammer(args, refund: bool) -> tuple:
+    # -> (reservations kept, lowest balance seen)
+    from logic_user_usage import InsufficientCreditError
+
+    set_credit(args.balance)
+
+    def run(_) -> tuple:
+        user_usage = make_user_usage()
+        kept, lowest = 0, args.balance
+        for i in range(args.attempts // args.threads):
+            try:
+                balance = user_usage.reserve_credit(args.amount)
+            except InsufficientCreditError:
+                continue
+            lowest = min(lowest, balance)
+            if refund and i % 2 == 0:
+                user_usage.refund_credit(args.amount)
+            else:
+                kept += 1
+        return kept, lowest
+
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        results = list(executor.map(run, range(args.threads)))
+    return sum(k for k, _ in results), min(low for _, low in results)
+
+
+def check(failures: list, condition: bool, message: str):
+    if not condition:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--attempts", type=int, default=40)
+    parser.add_argument("--amount", type=int, default=3)
+    parser.add_argument("--balance", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=20, help="generate calls")
+    parser.add_argument("--credit", type=int, default=5, help="for generate")
+    parser.add_argument("--dynamodb-endpoint", help="DynamoDB Local instead of moto")
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    # every call of the one user is admitted, the credit is what limits them
+    os.environ["USER_MAX_IN_FLIGHT_FREE"] = str(args.requests)
+    os.environ["ADMISSION_COST_GENERATE"] = os.environ["ADMISSION_COST_EDGE"] = "0.05"
+    server = FakeSDServer(delay=0.05, image_size=(64, 64)).start()
+    os.environ["SD_SERVER_URL"] = server.url
+    failures = []
+
+    import boto3
+
+    if args.dynamodb_endpoint:
+        os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = args.dynamodb_endpoint
+        mock = contextlib.nullcontext()
+    else:
+        mock = atomic_moto()
+    counter = CallCounter()
+
+    with mock:
+        # clients copy the session's handlers when they are created; moto
+        # replaces the default session, so this comes after mocking starts
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-call.dynamodb", counter)
+        create_table()
+        seed_users(1, args.balance)
+
+        kept, lowest = hammer(args, refund=False)
+        expected = args.balance // args.amount
+        print(
+            f"reserve:  {kept} of {args.attempts} reservations succeeded, "
+            f"balance {get_credit()}, lowest seen {lowest}"
+        )
+        check(failures, kept == expected, f"reserve: expected {expected} to succeed")
+        check(failures, get_credit() == args.balance - kept * args.amount, "reserve")
+
+        kept, lowest = hammer(args, refund=True)
+        print(
+            f"refund:   {kept} reservations kept, balance {get_credit()}, "
+            f"lowest seen {lowest}"
+        )
+        check(failures, get_credit() == args.balance - kept * args.amount, "refund")
+        check(failures, lowest >= 0, "refund: the balance went negative")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            import edge
+            import generate
+
+        set_credit(args.credit)
+        events_args = argparse.Namespace(
+            requests=args.requests,
+            image_size=(64, 64),
+            seed=None,
+            anti_glare=False,
+            only_masked=False,
+        )
+        events = generate_events(events_args, 1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(max_workers=args.requests) as executor:
+                responses = list(
+                    executor.map(lambda e: generate.lambda_handler(e, None), events)
+                )
+        statuses = Counter(r["statusCode"] for r in responses)
+        succeeded = statuses[200]
+        print(
+            f"generate: {dict(statuses)} for {args.credit} credits, "
+            f"balance {get_credit()}"
+        )
+        check(failures, succeeded <= args.credit, "generate: credit overspent")
+        check(failures, get_credit() == args.credit - succeeded, "generate: refunds")
+
+        # DynamoDB calls of uncached requests, each from a warm container
+        set_credit(10**6)
+        counter.take()
+        n = 10
+        events_args.requests = n
+        per_request = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            for event in generate_events(events_args, 1):
+                generate.lambda_handler(event, None)
+            per_request["generate"] = counter.take()
+            for event in edge_events(events_args, 1):
+                edge.lambda_handler(event, None)
+            per_request["edge"] = counter.take()
+        for name, calls in per_request.items():
+            detail = ", ".join(f"{op} {c / n:g}" for op, c in sorted(calls.items()))
+            print(f"{name}: {sum(calls.values()) / n:g} DynamoDB calls ({detail})")
+
+    server.stop()
+    for failure in failures:
+        print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
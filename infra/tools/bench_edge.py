@@ -0,0 +1,157 @@
+"""Checks the latency and the timeout budget of the edge Lambda.
+
+Runs edge.lambda_handler in-process against a fake SD server
+(tools/fake_sd_server.py) with DynamoDB mocked by moto, with a Lambda context
+whose remaining time starts at --budget:
+
+  overlap   detection takes --detect-delay and tagging --tagging-delay; as
+            both run at once, the handler should take about the longer of the
+            two, not their sum
+  hang      detection does not answer for far longer than the budget; the
+            handler should give up in time to answer 502 and refund the credit
+  malformed a multipart body without an "image" part should get a 400
+
+Exits non-zero when a check fails.
+
+    python tools/bench_edge.py
+    python tools/bench_edge.py --detect-delay 2 --tagging-delay 1.5 --budget 30
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_handlers import ENVIRONMENT, auth_token, create_table  # noqa: E402
+from bench_handlers import seed_users  # noqa: E402
+from fake_sd_server import FakeSDServer, make_png  # noqa: E402
+
+DETECT_PATH = "/controlnet/detect-only"
+TAGGING_PATH = "/tagger/v1/interrogate"
+CREDIT = 1000
+
+
+class FakeContext:
+    # the part of the Lambda context the handlers use
+    def __init__(self, budget: float):
+        self._deadline = time.monotonic() + budget
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int(max(self._deadline - time.monotonic(), 0) * 1000)
+
+
+def edge_event(username: str) -> dict:
+    # fresh noise each time, otherwise the result cache answers
+    make_png.cache_clear()
+    return {
+        "headers": {"authorization": auth_token(username)},
+        "body": make_png(64, 64),
+    }
+
+
+def invoke(handler, event: dict, budget: float) -> tuple:
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        response = handler(event, FakeContext(budget))
+    return response, time.perf_counter() - start
+
+
+def get_credit(username: str) -> int:
+    from logic_user_usage import UserUsage
+
+    user_usage = UserUsage()
+    user_usage.username = username
+    return int(user_usage.get_user_usage()["credit"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--detect-delay", type=float, default=1.0, help="in sec")
+    parser.add_argument("--tagging-delay", type=float, default=0.8, help="in sec")
+    parser.add_argument("--budget", type=float, default=30, help="Lambda timeout")
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT)
+    os.environ["ADMISSION_COST_EDGE"] = str(args.detect_delay)
+    server = FakeSDServer(image_size=(64, 64)).start()
+    os.environ["SD_SERVER_URL"] = server.url
+    failures = []
+
+    from moto import mock_aws
+
+    with mock_aws():
+        create_table()
+        seed_users(1, CREDIT)
+        with contextlib.redirect_stdout(io.StringIO()):
+            import edge
+
+        server.delays = {
+            DETECT_PATH: args.detect_delay,
+            TAGGING_PATH: args.tagging_delay,
+        }
+        times = []
+        for _ in range(args.requests):
+            response, elapsed = invoke(
+                edge.lambda_handler, edge_event("user0"), args.budget
+            )
+            assert response["statusCode"] == 200, response
+            times.append(elapsed)
+        longer = max(args.detect_delay, args.tagging_delay)
+        total = args.detect_delay + args.tagging_delay
+        median = statistics.median(times)
+        print(
+            f"overlap:   median {median:.2f}s, max of the calls {longer:.2f}s, "
+            f"sum {total:.2f}s"
+        )
+        if median >= (longer + total) / 2:
+            failures.append("overlap: detection and tagging ran one after another")
+
+        server.delays = {DETECT_PATH: args.budget * 4, TAGGING_PATH: 0.1}
+        credit = get_credit("user0")
+        response, elapsed = invoke(
+            edge.lambda_handler, edge_event("user0"), args.budget
+        )
+        refunded = get_credit("user0") == credit
+        print(
+            f"hang:      {response['statusCode']} after {elapsed:.2f}s of a "
+            f"{args.budget:.0f}s budget, credit refunded: {refunded}"
+        )
+        if elapsed >= args.budget:
+            failures.append("hang: the handler outlived the Lambda timeout")
+        if response["statusCode"] != 502 or not refunded:
+            failures.append("hang: expected a refunded 502")
+
+        boundary = "bench"
+        body = (
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="other"; filename="a.png"\r\n'
+            f"\r\nxx\r\n--{boundary}--\r\n"
+        )
+        event = {
+            "headers": {
+                "authorization": auth_token("user0"),
+                "content-type": f"multipart/form-data; boundary={boundary}",
+            },
+            "body": body,
+        }
+        response, _ = invoke(edge.lambda_handler, event, args.budget)
+        print(f"malformed: {response['statusCode']} {json.loads(response['body'])}")
+        if response["statusCode"] != 400:
+            failures.append("malformed: expected a 400")
+
+    server.stop()
+    for failure in failures:
+        print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
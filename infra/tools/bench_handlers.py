@@ -0,0 +1,310 @@
+"""End-to-end benchmark of the generate, edge and refresh_credit Lambdas.
+
+Each scenario runs in a fresh interpreter with its handler imported as in a
+Lambda container, a fake SD server (tools/fake_sd_server.py) on a local port
+and DynamoDB either mocked in-process by moto or served by DynamoDB Local
+(--dynamodb-endpoint). Invocations are spread over --concurrency threads in
+that one process; Lambda itself runs one invocation per container, so this
+mostly shows how the handlers overlap on SD calls and DynamoDB. Reports
+throughput, latency percentiles, the peak RSS growth of the process and the
+bytes of the API payloads and of the SD traffic.
+
+Needs moto (or DynamoDB Local), numpy, opencv and pillow besides boto3.
+
+    python tools/bench_handlers.py --requests 40 --concurrency 4
+    python tools/bench_handlers.py generate --image-size 1024x1536 --sd-delay 0.5
+    python tools/bench_handlers.py refresh_credit --users 5000
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(TOOLS_DIR, "..", "lambda")
+
+SCENARIOS = ("generate", "edge", "refresh_credit")
+TABLE_NAME = "retouchappUserDB"
+USAGE_TABLE_NAME = "retouchappUsageDB"
+
+ENVIRONMENT = {
+    "AWS_DEFAULT_REGION": "ap-northeast-1",
+    "AWS_ACCESS_KEY_ID": "bench",
+    "AWS_SECRET_ACCESS_KEY": "bench",
+    "DYNAMO_TABLE_NAME": TABLE_NAME,
+    "USAGE_TABLE_NAME": USAGE_TABLE_NAME,
+    "CREDIT_CONSUMPTION": "1",
+    "PLAN_NAME_FREE": "free",
+    "PLAN_NAME_STANDARD": "standard",
+    "FULL_CREDIT_FREE": "100",
+    "FULL_CREDIT_STANDARD": "1000",
+    "METRICS_ENABLED": "0",
+}
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def peak_rss() -> int:
+    # in bytes, ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def auth_token(username: str) -> str:
+    payload = base64.b64encode(json.dumps({"username": username}).encode()).decode()
+    return "header." + payload.rstrip("=") + ".signature"
+
+
+def create_table():
+    # the user table and the usage ledger's, both empty
+    import boto3
+
+    client = boto3.client("dynamodb")
+    existing = client.list_tables()["TableNames"]
+    for name in (TABLE_NAME, USAGE_TABLE_NAME):
+        if name in existing:
+            client.delete_table(TableName=name)
+        client.create_table(
+            TableName=name,
+            KeySchema=[
+                {"AttributeName": "pk", "KeyType": "HASH"},
+                {"AttributeName": "sk", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "pk", "AttributeType": "S"},
+                {"AttributeName": "sk", "AttributeType": "S"},
+            ],
+            BillingMode="PAY_PER_REQUEST",
+        )
+
+
+def seed_users(n_users: int, credit: int):
+    from logic_aws import get_resource
+
+    table = get_resource("dynamodb").Table(TABLE_NAME)
+    with table.batch_writer() as batch:
+        for i in range(n_users):
+            plan = "standard" if i % 4 == 0 else "free"
+            batch.put_item(
+                Item={"pk": f"user{i}", "sk": "info", "credit": credit, "plan": plan}
+            )
+
+
+def make_mask(width: int, height: int) -> str:
+    # a rectangle in the middle third
+    import cv2
+    import numpy as np
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[height // 3 : 2 * height // 3, width // 3 : 2 * width // 3] = 255
+    return base64.b64encode(cv2.imencode(".png", mask)[1]).decode()
+
+
+def generate_events(args, n_users: int) -> list:
+    from fake_sd_server import make_png
+
+    width, height = args.image_size
+    image = "data:image/png;base64," + make_png(width, height)
+    mask = "data:image/png;base64," + make_mask(width, height)
+    events = []
+    for i in range(args.requests):
+        body = {
+            "sampler": "DPM++ 2M Karras",
+            "steps": 30,
+            "seed": -1 if args.seed is None else args.seed,
+            "width": width,
+            "height": height,
+            "maskBlur": 4,
+            "cfgScale": 7,
+            "denosing": 0.6,
+            "initialNoiseMultiplier": 1.0,
+            "controlMode": 0,
+            "controlWeight": 1.0,
+            "referenceControlMode": 0,
+            "referenceControlWeight": 1.0,
+            "inpaintingFill": 1,
+            "imageData": image,
+            "maskData": mask,
+            "edgeData": image,
+            "positivePrompt": "1girl",
+            "negativePrompt": "",
+            "useEdge": True,
+            "useReference": True,
+            "useAnotherImageForReference": False,
+            "antiGlareFilterFlag": 1 if args.anti_glare else 0,
+            "antiGlareFilterSigmaS": 20,
+            "antiGlareFilterSigmaR": 0.2,
+            "inpaintOnlyMasked": args.only_masked,
+        }
+        headers = {"authorization": auth_token(f"user{i % n_users}")}
+        events.append({"headers": headers, "body": json.dumps(body)})
+    return events
+
+
+def edge_events(args, n_users: int) -> list:
+    from fake_sd_server import make_png
+
+    width, height = args.image_size
+    events = []
+    image = None
+    for i in range(args.requests):
+        if image is None or args.seed is None:
+            # fresh noise each time, otherwise the result cache answers
+            make_png.cache_clear()
+            image = make_png(width, height)
+        headers = {"authorization": auth_token(f"user{i % n_users}")}
+        events.append({"headers": headers, "body": image})
+    return events
+
+
+def run_scenario(args) -> dict:
+    # in the child interpreter
+    sys.path[:0] = [LAMBDA_DIR, TOOLS_DIR]
+    os.environ.update(ENVIRONMENT)
+    from fake_sd_server import FakeSDServer
+
+    server = FakeSDServer(delay=args.sd_delay, noise=not args.flat).start()
+    os.environ["SD_SERVER_URL"] = server.url
+    # admission control starts from these until it has measured the server
+    for kind in ("GENERATE", "EDGE"):
+        os.environ.setdefault(f"ADMISSION_COST_{kind}", str(args.sd_delay))
+
+    with contextlib.ExitStack() as stack:
+        if args.dynamodb_endpoint:
+            os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = args.dynamodb_endpoint
+        else:
+            from moto import mock_aws
+
+            stack.enter_context(mock_aws())
+
+        # the import is timed separately, lazy imports land in the first call
+        start = time.perf_counter()
+        handler = __import__(args.scenario).lambda_handler
+        import_time = time.perf_counter() - start
+
+        create_table()
+
+        n_users = args.users if args.scenario == "refresh_credit" else 16
+        seed_users(n_users, 10**9 if args.scenario != "refresh_credit" else 0)
+        if args.scenario == "generate":
+            events = generate_events(args, n_users)
+        elif args.scenario == "edge":
+            events = edge_events(args, n_users)
+        else:
+            # a scheduled batch job, one run at a time
+            events = [{}] * args.refresh_runs
+            args.concurrency = 1
+
+        rss_before = peak_rss()
+
+        def invoke(event) -> tuple:
+            start = time.perf_counter()
+            response = handler(event, None)
+            elapsed = time.perf_counter() - start
+            if isinstance(response, dict):
+                status = response.get("statusCode", 200)
+                size = len(response.get("body") or "")
+            else:
+                status, size = 200, len(json.dumps(response))
+            return elapsed, status, size
+
+        sd_received, sd_sent = server.bytes_received, server.bytes_sent
+        start = time.perf_counter()
+        # the handlers' own logging is not part of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                results = list(executor.map(invoke, events))
+        wall = time.perf_counter() - start
+
+    server.stop()
+    latencies = [elapsed for elapsed, _, _ in results]
+    return {
+        "scenario": args.scenario,
+        "requests": len(results),
+        "errors": sum(status >= 400 for _, status, _ in results),
+        "wall": wall,
+        "throughput": len(results) / wall,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "import": import_time,
+        "rssBefore": rss_before,
+        "rssPeak": peak_rss(),
+        "requestBytes": sum(len(event.get("body") or "") for event in events),
+        "responseBytes": sum(size for _, _, size in results),
+        "sdSentBytes": server.bytes_received - sd_received,
+        "sdReceivedBytes": server.bytes_sent - sd_sent,
+    }
+
+
+def mib(n_bytes: float) -> str:
+    return f"{n_bytes / 2**20:.1f}MiB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"default: {' '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--sd-delay", type=float, default=0.1, help="sec per image")
+    parser.add_argument("--image-size", default="768x1024", help="WIDTHxHEIGHT")
+    parser.add_argument("--flat", action="store_true", help="compressible images")
+    parser.add_argument("--anti-glare", action="store_true")
+    parser.add_argument("--only-masked", action="store_true")
+    parser.add_argument("--seed", type=int, help="fixed seed, hits the cache")
+    parser.add_argument("--users", type=int, default=2000, help="refresh_credit")
+    parser.add_argument("--refresh-runs", type=int, default=3)
+    parser.add_argument("--dynamodb-endpoint", help="e.g. http://localhost:8000")
+    parser.add_argument("--json", action="store_true", help="one JSON per scenario")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)  # child mode
+    args = parser.parse_args()
+    args.image_size = tuple(int(v) for v in args.image_size.lower().split("x"))
+
+    if args.scenario:
+        print(json.dumps(run_scenario(args)))
+        return
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}")
+
+    child_args = [a for a in sys.argv[1:] if a not in SCENARIOS]
+    for scenario in args.scenarios or SCENARIOS:
+        completed = subprocess.run(
+            [sys.executable, __file__, *child_args, "--scenario", scenario],
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            print(f"{scenario}: failed\n{completed.stderr.strip()}")
+            continue
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        if args.json:
+            print(json.dumps(result))
+            continue
+        print(
+            f"{scenario}: {result['requests']} requests, {result['errors']} errors,"
+            f" {result['throughput']:.2f} req/s,"
+            f" p50 {result['p50'] * 1000:.0f}ms p95 {result['p95'] * 1000:.0f}ms"
+            f" p99 {result['p99'] * 1000:.0f}ms"
+        )
+        print(
+            f"    import {result['import'] * 1000:.0f}ms,"
+            f" peak RSS {mib(result['rssPeak'])}"
+            f" (+{mib(result['rssPeak'] - result['rssBefore'])} while serving),"
+            f" API in/out {mib(result['requestBytes'])}/{mib(result['responseBytes'])},"
+            f" SD out/in {mib(result['sdSentBytes'])}/{mib(result['sdReceivedBytes'])}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Counts the EC2 API calls of the SD instance lookups.
+
+With EC2 mocked by moto, launches --instances instances tagged with the SD
+instance name and --others untagged ones, then runs each status check the
+Lambdas make -- ec2status's get_target_instance_status and
+get_target_instance_ip_address, circuit breaker's get_instance_statuses and
+the backend pool's discover_backend_urls -- once with the instance id cache
+empty and --checks times with it warm, each from a new ServerController as a
+new invocation does. Reports the DescribeInstances calls per check and exits
+non-zero when a warm check takes more than one.
+
+    python tools/bench_instance_lookup.py
+    python tools/bench_instance_lookup.py --instances 500 --others 1000
+"""
+
+import argparse
+import os
+import sys
+import threading
+from collections import Counter
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_handlers import ENVIRONMENT  # noqa: E402
+
+TARGET_NAME = "sd-service"
+
+
+class CallCounter:
+    # EC2 operations made through the default boto3 session
+    def __init__(self):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, model, **kwargs):
+        with self._lock:
+            self.calls[model.name] += 1
+
+    def take(self) -> Counter:
+        with self._lock:
+            calls, self.calls = self.calls, Counter()
+        return calls
+
+
+def launch(n: int, name: str = None):
+    import boto3
+
+    ec2 = boto3.client("ec2")
+    image_id = ec2.describe_images()["Images"][0]["ImageId"]
+    tags = []
+    if name is not None:
+        tags = [{"ResourceType": "instance", "Tags": [{"Key": "Name", "Value": name}]}]
+    for start in range(0, n, 100):
+        count = min(100, n - start)
+        ec2.run_instances(
+            ImageId=image_id,
+            MinCount=count,
+            MaxCount=count,
+            InstanceType="t3.micro",
+            TagSpecifications=tags,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--instances", type=int, default=200, help="tagged")
+    parser.add_argument("--others", type=int, default=300, help="untagged")
+    parser.add_argument("--checks", type=int, default=20, help="with a warm cache")
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT, SD_INSTANCE_NAME=TARGET_NAME)
+    os.environ["SD_SERVER_URL"] = "http://127.0.0.1:7861"
+    os.environ["SD_BACKEND_DISCOVERY"] = "ec2"
+
+    import boto3
+    from moto import mock_aws
+
+    counter = CallCounter()
+    failures = []
+    with mock_aws():
+        # moto replaces the default session, so the hook comes after it starts
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-call.ec2", counter)
+        launch(args.instances, TARGET_NAME)
+        launch(args.others)
+
+        import logic_server_controller
+        from logic_backend_pool import discover_backend_urls
+        from logic_server_controller import ServerController
+
+        checks = {
+            "get_target_instance_status": lambda c: c.get_target_instance_status(),
+            "get_target_instance_ip_address": (
+                lambda c: c.get_target_instance_ip_address()
+            ),
+            "get_instance_statuses": lambda c: c.get_instance_statuses(),
+            "discover_backend_urls": lambda c: discover_backend_urls(),
+        }
+        print(f"{args.instances} tagged instances, {args.others} others")
+        print(f"{'check':<32} {'cold':>5} {'warm':>5}")
+        for name, check in checks.items():
+            logic_server_controller.invalidate_instance_cache()
+            counter.take()
+            check(ServerController())
+            cold = sum(counter.take().values())
+            for _ in range(args.checks):
+                check(ServerController())
+            calls = counter.take()
+            warm = sum(calls.values()) / args.checks
+            print(f"{name:<32} {cold:>5} {warm:>5g}")
+            if warm > 1:
+                failures.append(f"{name}: {dict(calls)} for {args.checks} checks")
+
+        # a cached instance that went away is looked up again, not reported
+        instance = ServerController().target_instance
+        boto3.client("ec2").terminate_instances(InstanceIds=[instance.id])
+        statuses = ServerController().get_instance_statuses()
+        if instance.id in statuses or len(statuses) != args.instances - 1:
+            failures.append("a terminated instance stayed in the cached ids")
+
+    for failure in failures:
+        print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
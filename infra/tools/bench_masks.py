@@ -0,0 +1,99 @@
+"""Compares compact masks (lambda/logic_mask.py) with the PNG masks sent today.
+
+Draws brush masks as the editor does, a few round strokes over the image,
+and encodes each as the RGBA PNG data URL the canvas produces and as the
+"rle" and "bits" compact formats. Reports the bytes each adds to the request
+and the time to decode it the way generate does: to the size SD renders at
+(the payload and the anti-glare filter) and at full resolution (preprocess
+with inpaintOnlyMasked).
+
+    python tools/bench_masks.py
+    python tools/bench_masks.py --image-size 2048x3072 --strokes 40 --brush 80
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+)
+
+from logic_image import decode_mask  # noqa: E402
+from logic_mask import MASK_FORMATS, encode_compact_mask  # noqa: E402
+
+SHORTEST_TARGET = 512  # as generate.limit_size()
+
+
+def brush_mask(width: int, height: int, strokes: int, brush: int, rng) -> np.ndarray:
+    # strokes of a few segments each, within a region as when retouching a part
+    mask = np.zeros((height, width, 4), dtype=np.uint8)
+    cx, cy = rng.uniform(0.3, 0.7) * width, rng.uniform(0.3, 0.7) * height
+    spread = 0.2 * min(width, height)
+    for _ in range(strokes):
+        points = np.cumsum(rng.normal(0, spread / 4, (6, 2)), axis=0)
+        points += (cx + rng.normal(0, spread), cy + rng.normal(0, spread))
+        cv2.polylines(mask, [points.astype(np.int32)], False, (255,) * 4, brush)
+    return mask
+
+
+def best_of(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image-size", default="1024x1536", help="WIDTHxHEIGHT")
+    parser.add_argument("--strokes", type=int, default=12)
+    parser.add_argument("--brush", type=int, default=40, help="px")
+    parser.add_argument("--masks", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    scale = SHORTEST_TARGET / min(width, height)
+    target = (round(width * scale), round(height * scale))
+
+    rng = np.random.default_rng(args.seed)
+    totals = {}
+    coverage = []
+    for _ in range(args.masks):
+        rgba = brush_mask(width, height, args.strokes, args.brush, rng)
+        coverage.append((rgba[:, :, 3] > 0).mean())
+        png = base64.b64encode(cv2.imencode(".png", rgba)[1]).decode()
+        encoded = {"png": "data:image/png;base64," + png}
+        for fmt in MASK_FORMATS:
+            encoded[fmt] = encode_compact_mask(rgba[:, :, 3], fmt)
+        for name, mask in encoded.items():
+            total = totals.setdefault(name, [0, 0.0, 0.0])
+            total[0] += len(json.dumps(mask))
+            total[1] += best_of(lambda: decode_mask(mask, target), args.repeat)
+            total[2] += best_of(lambda: decode_mask(mask, (width, height)), args.repeat)
+
+    print(
+        f"{args.masks} masks of {width}x{height}, {args.strokes} strokes of"
+        f" {args.brush}px, {np.mean(coverage):.0%} covered; SD size"
+        f" {target[0]}x{target[1]}"
+    )
+    print(f"    {'format':8}{'bytes':>10}{'ratio':>8}{'decode SD':>11}{'full res':>10}")
+    png_bytes = totals["png"][0]
+    for name, (n_bytes, sd_time, full_time) in totals.items():
+        print(
+            f"    {name:8}{n_bytes // args.masks:10d}{png_bytes / n_bytes:7.1f}x"
+            f"{sd_time / args.masks * 1000:9.2f}ms{full_time / args.masks * 1000:8.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
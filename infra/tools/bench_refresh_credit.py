@@ -0,0 +1,130 @@
+"""Benchmarks refresh_credit on a table of --users users.
+
+Seeds the user table (DynamoDB mocked by moto, or DynamoDB Local with
+--dynamodb-endpoint) with --users "info" items, --used of them below their
+plan's full credit, plus --other-items non-info items per user that the scan
+reads and filters out. Then runs refresh_credit.lambda_handler once per
+SEGMENTSxCONCURRENCY pair of --variants, re-seeding the used credits before
+each run, and checks that every user ends at full credit.
+
+Reports wall time, items scanned, users updated and the capacity DynamoDB
+would charge: a scan pays for every item it reads, before the filter and the
+projection, at half a unit per 4KB page share, and each update one write
+unit. moto reports a made-up capacity, so the units are computed from the
+item sizes instead. moto also scans slower than DynamoDB does, so wall times
+compare the variants with each other rather than predict production.
+
+    python tools/bench_refresh_credit.py
+    python tools/bench_refresh_credit.py --users 20000 --variants 1x1,4x8
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_handlers import ENVIRONMENT, TABLE_NAME, create_table  # noqa: E402
+from bench_usage_ledger import item_size, read_units  # noqa: E402
+
+
+def user_item(i: int, credit_used: bool) -> dict:
+    plan = "standard" if i % 4 == 0 else "free"
+    full = int(ENVIRONMENT[f"FULL_CREDIT_{plan.upper()}"])
+    return {
+        "pk": f"user{i}",
+        "sk": "info",
+        "credit": full - 1 if credit_used else full,
+        "plan": plan,
+    }
+
+
+def seed(args, table, only_used: bool = False) -> list:
+    # -> sizes of the items written
+    sizes = []
+    n_used = int(args.users * args.used)
+    with table.batch_writer() as batch:
+        for i in range(args.users):
+            used = i < n_used
+            if only_used and not used:
+                continue
+            item = user_item(i, used)
+            batch.put_item(Item=item)
+            sizes.append(item_size(item))
+            if only_used:
+                continue
+            for j in range(args.other_items):
+                other = {"pk": f"user{i}", "sk": f"usage#{j:04d}", "credit": 1}
+                batch.put_item(Item=other)
+                sizes.append(item_size(other))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--used", type=float, default=0.3, help="fraction")
+    parser.add_argument("--other-items", type=int, default=0, help="per user")
+    parser.add_argument("--variants", default="1x1,4x8,8x16", help="SEGxWRITERS")
+    parser.add_argument("--dynamodb-endpoint", help="DynamoDB Local instead of moto")
+    args = parser.parse_args()
+    variants = [tuple(int(v) for v in x.split("x")) for x in args.variants.split(",")]
+
+    os.environ.update(ENVIRONMENT)
+    with contextlib.ExitStack() as stack:
+        if args.dynamodb_endpoint:
+            os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = args.dynamodb_endpoint
+        else:
+            from moto import mock_aws
+
+            stack.enter_context(mock_aws())
+        create_table()
+        from logic_aws import get_resource
+
+        table = get_resource("dynamodb").Table(TABLE_NAME)
+        start = time.perf_counter()
+        sizes = seed(args, table)
+        print(
+            f"seeded {len(sizes)} items ({args.users} users) in "
+            f"{time.perf_counter() - start:.1f}s, {sum(sizes) / 2**20:.1f}MB"
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            import refresh_credit
+        from logic_user_usage import UserUsage
+
+        scan_units = read_units(sizes)
+        print(
+            f"{'segments':>8} {'writers':>8} {'wall s':>8} {'scanned':>8} "
+            f"{'updated':>8} {'RCU':>8} {'WCU':>8}"
+        )
+        for segments, writers in variants:
+            seed(args, table, only_used=True)
+            refresh_credit.SCAN_SEGMENTS = segments
+            refresh_credit.WRITE_CONCURRENCY = writers
+            output = io.StringIO()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(output):
+                message = refresh_credit.lambda_handler({}, None)
+            wall = time.perf_counter() - start
+            n_updated = int(message.split()[1])
+            scanned = int(output.getvalue().split("scanned ")[1].split()[0])
+            print(
+                f"{segments:>8} {writers:>8} {wall:>8.1f} {scanned:>8} "
+                f"{n_updated:>8} {scan_units:>8.0f} {n_updated:>8}"
+            )
+            assert scanned == args.users, scanned
+            assert n_updated == int(args.users * args.used), n_updated
+
+        # every user is back at the full credit of their plan
+        infos = UserUsage().scan_user_infos(total_segments=4)
+        for info in infos:
+            i = int(info["pk"][len("user") :])
+            assert info["credit"] == user_item(i, False)["credit"], info
+
+
+if __name__ == "__main__":
+    main()
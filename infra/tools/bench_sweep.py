@@ -0,0 +1,115 @@
+"""Benchmarks an N-variant sweep against N sequential generate calls.
+
+Both run generate.lambda_handler in-process against a fake SD server
+(tools/fake_sd_server.py) with DynamoDB mocked by moto: once as N calls with
+seeds s..s+N-1, as a client exploring seeds does today, and once as a single
+call with "sweep": {"seeds": [s, ..., s+N-1]}, which renders them as one
+batch. --batch-cost sets how much of the per-image delay each further image
+of a batch costs on the fake GPU (1.0: no gain from batching). Reports wall
+time, SD calls and API bytes of each.
+
+    python tools/bench_sweep.py --variants 4 --sd-delay 1 --batch-cost 0.5
+    python tools/bench_sweep.py --variants 8 --grid --anti-glare
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_handlers import ENVIRONMENT, create_table, generate_events  # noqa
+from bench_handlers import seed_users  # noqa: E402
+from fake_sd_server import FakeSDServer  # noqa: E402
+
+SEED = 1234
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--variants", type=int, default=4)
+    parser.add_argument("--sd-delay", type=float, default=1.0, help="sec per image")
+    parser.add_argument("--batch-cost", type=float, default=0.5, help="x delay")
+    parser.add_argument("--image-size", default="768x1024", help="WIDTHxHEIGHT")
+    parser.add_argument("--anti-glare", action="store_true")
+    parser.add_argument("--grid", action="store_true", help="2 denosing values")
+    args = parser.parse_args()
+    args.image_size = tuple(int(v) for v in args.image_size.lower().split("x"))
+
+    # the sweep is synchronous here, whatever its size
+    os.environ.update(
+        ENVIRONMENT,
+        MAX_SWEEP_VARIANTS=str(args.variants),
+        MAX_SYNC_SWEEP_VARIANTS=str(args.variants),
+    )
+    os.environ["ADMISSION_COST_GENERATE"] = str(args.sd_delay)
+    server = FakeSDServer(delay=args.sd_delay).start()
+    server.batch_cost = args.batch_cost
+    os.environ["SD_SERVER_URL"] = server.url
+
+    from moto import mock_aws
+
+    with mock_aws():
+        create_table()
+        seed_users(1, 10**6)
+        import generate
+
+        events_args = argparse.Namespace(
+            requests=1,
+            image_size=args.image_size,
+            seed=SEED,
+            anti_glare=args.anti_glare,
+            only_masked=False,
+        )
+        event = generate_events(events_args, 1)[0]
+        body = json.loads(event["body"])
+        if args.grid:
+            seeds = list(range(SEED, SEED + args.variants // 2))
+            denosings = [0.5, 0.7]
+        else:
+            seeds = list(range(SEED, SEED + args.variants))
+            denosings = [body["denosing"]]
+
+        def run(bodies: list) -> dict:
+            requests_before = server.n_requests
+            sent = 0
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for request_body in bodies:
+                    request = json.dumps(request_body)
+                    sent += len(request)
+                    response = generate.lambda_handler({**event, "body": request}, None)
+                    assert response["statusCode"] == 200, response["body"][:200]
+            return {
+                "wall": time.perf_counter() - start,
+                "sdCalls": server.n_requests - requests_before,
+                "apiBytes": sent,
+            }
+
+        sequential = run(
+            [
+                {**body, "seed": seed, "denosing": denosing}
+                for denosing in denosings
+                for seed in seeds
+            ]
+        )
+        sweep = run([{**body, "sweep": {"seeds": seeds, "denosing": denosings}}])
+
+    server.stop()
+    n_variants = len(seeds) * len(denosings)
+    for name, result in (("sequential", sequential), ("sweep", sweep)):
+        print(
+            f"{name:10}: {n_variants} variants in {result['wall']:.2f}s"
+            f" ({result['wall'] / n_variants:.2f}s each), {result['sdCalls']} SD"
+            f" calls, API in {result['apiBytes'] / 2**20:.1f}MiB"
+        )
+    print(f"speedup {sequential['wall'] / sweep['wall']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
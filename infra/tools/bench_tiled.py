@@ -0,0 +1,228 @@
+"""Checks and measures the tiled high-resolution mode of generate on large images.
+
+For each --sizes entry a fresh interpreter builds a synthetic photo (smooth
+gradients and texture) with brush strokes as the mask and runs
+generate.generate_tiled() against a fake SD server (tools/fake_sd_server.py)
+whose "render" adds a different random brightness offset to each tile, the
+worst case for seams. Reports per size:
+
+    tiles     tiles sent to SD, against a grid over the whole image
+    seam      largest step between neighbouring pixels of (result - original)
+              inside the mask, against the bound offset spread / overlap that
+              feathering allows; without feathering it would be the spread
+    covered   share of masked pixels inside a tile sent to SD (should be 100%)
+    leaked    pixels changed outside the (blurred) mask (should be 0)
+    peak RSS  growth of the peak RSS while rendering, in MiB and relative to
+              the decoded image, which should stay flat as the image grows
+              (the image, its mask and the PNG and base64 copies of input and
+              output, which barely compress here; the tiles add little)
+
+    python tools/bench_tiled.py
+    python tools/bench_tiled.py --sizes 3000x4000 --strokes 30 --concurrency 4
+"""
+
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(TOOLS_DIR, "..", "lambda")
+
+OFFSET = 40  # tile offsets are within +-OFFSET
+MASK_BLUR = 4
+
+
+def reset_peak_rss():
+    # Linux only: the peak so far would otherwise hide the rendering's own
+    with open("/proc/self/clear_refs", "w") as clear_refs:
+        clear_refs.write("5")
+
+
+def peak_rss() -> int:
+    # in bytes
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def current_rss() -> int:
+    # in bytes
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def synthetic_photo(width: int, height: int, rng):
+    import numpy as np
+
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    for channel in range(3):
+        phase = rng.uniform(0, 2 * math.pi)
+        wave = np.sin(x / width * 6 + phase) * np.cos(y / height * 4 + phase)
+        texture = rng.normal(0, 4, (height, width)).astype(np.float32)
+        image[:, :, channel] = np.clip(128 + 80 * wave + texture, 0, 255)
+    return image
+
+
+def brush_mask(width: int, height: int, strokes: int, rng):
+    import cv2
+    import numpy as np
+
+    mask = np.zeros((height, width), dtype=np.uint8)
+    brush = max(min(width, height) // 40, 8)
+    for _ in range(strokes):
+        points = rng.uniform((0.2 * width, 0.2 * height), (0.8 * width, 0.8 * height))
+        points = points + np.cumsum(rng.normal(0, brush * 3, (5, 2)), axis=0)
+        cv2.polylines(mask, [points.astype(np.int32)[:, None]], False, 255, brush)
+    return mask
+
+
+def child(args, width: int, height: int) -> dict:
+    sys.path[:0] = [LAMBDA_DIR, TOOLS_DIR]
+    os.environ.update(
+        MAX_TILES="100000",
+        TILE_CONCURRENCY=str(args.concurrency),
+        TILE_OVERLAP=str(args.overlap),
+        METRICS_ENABLED="0",
+    )
+    import numpy as np
+    from fake_sd_server import FakeSDServer
+    from logic_image import decode_image, encode_image, plan_tiles, resize
+
+    rng = np.random.default_rng(args.seed)
+    offsets = []
+
+    def render(data: dict) -> str:
+        tile = decode_image(data["init_images"][0]).astype(np.int16)
+        offset = int(rng.integers(-OFFSET, OFFSET + 1))
+        offsets.append(offset)
+        out = np.clip(tile + offset, 0, 255).astype(np.uint8)
+        return encode_image(resize(out, (data["width"], data["height"])))
+
+    server = FakeSDServer(delay=args.sd_delay).start()
+    server.render = render
+    os.environ["SD_SERVER_URL"] = server.url
+    import generate
+
+    original = synthetic_photo(width, height, rng)
+    mask = brush_mask(width, height, args.strokes, rng)
+    body = {
+        "sampler": "DPM++ 2M Karras",
+        "steps": 20,
+        "seed": 1,
+        "width": width,
+        "height": height,
+        "maskBlur": MASK_BLUR,
+        "cfgScale": 7,
+        "denosing": 0.6,
+        "initialNoiseMultiplier": 1.0,
+        "controlMode": 0,
+        "controlWeight": 1.0,
+        "referenceControlMode": 0,
+        "referenceControlWeight": 1.0,
+        "inpaintingFill": 1,
+        "imageData": encode_image(original),
+        "maskData": encode_image(mask),
+        "edgeData": "",
+        "positivePrompt": "1girl",
+        "negativePrompt": "",
+        "useEdge": False,
+        "useReference": False,
+        "useAnotherImageForReference": False,
+        "antiGlareFilterFlag": 0,
+        "antiGlareFilterSigmaS": 0,
+        "antiGlareFilterSigmaR": 0,
+        "tiled": True,
+    }
+    n_tiles = generate.count_tiles(body)
+    tile = generate.TILE_SIZE
+    full_grid = math.ceil((width - args.overlap) / (tile - args.overlap)) * math.ceil(
+        (height - args.overlap) / (tile - args.overlap)
+    )
+
+    tiled = np.zeros(mask.shape, dtype=bool)
+    for t in plan_tiles(mask, tile, args.overlap):
+        tiled[t.top : t.bottom, t.left : t.right] = True
+
+    reset_peak_rss()
+    rss_before = current_rss()
+    start = time.perf_counter()
+    out_image = generate.generate_tiled(body)
+    wall = time.perf_counter() - start
+    rss_growth = peak_rss() - rss_before
+    server.stop()
+
+    import cv2
+
+    diff = decode_image(out_image).astype(np.float32) - original
+    diff = diff.mean(axis=2)
+    inside = cv2.erode(mask, np.ones((2 * MASK_BLUR + 3,) * 2, np.uint8)) > 0
+    outside = cv2.dilate(mask, np.ones((2 * MASK_BLUR + 3,) * 2, np.uint8)) == 0
+    # neighbours both inside the mask, where only seams can make steps
+    step_y = np.abs(np.diff(diff, axis=0))[inside[1:] & inside[:-1]]
+    step_x = np.abs(np.diff(diff, axis=1))[inside[:, 1:] & inside[:, :-1]]
+    spread = max(offsets) - min(offsets) if offsets else 0
+    return {
+        "size": f"{width}x{height}",
+        "tiles": n_tiles,
+        "sdCalls": server.n_requests,
+        "fullGrid": full_grid,
+        "seam": float(max(step_y.max(initial=0), step_x.max(initial=0))),
+        "seamBound": spread / args.overlap + 1,  # +1 for rounding to uint8
+        "spread": spread,
+        "covered": float(tiled[mask > 0].mean()),
+        "leaked": int((np.abs(diff[outside]) > 0).sum()),
+        "wall": wall,
+        "rssGrowth": rss_growth,
+        "imageBytes": original.nbytes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="2048x1536,4096x3072,6144x4608")
+    parser.add_argument("--strokes", type=int, default=6)
+    parser.add_argument("--overlap", type=int, default=64, help="px")
+    parser.add_argument("--concurrency", type=int, default=2)
+    parser.add_argument("--sd-delay", type=float, default=0.05, help="sec per tile")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        width, height = (int(v) for v in args.child.split("x"))
+        print(json.dumps(child(args, width, height)))
+        return
+
+    print(
+        f"    {'size':11}{'tiles':>7}{'grid':>6}{'seam':>7}{'bound':>7}"
+        f"{'covered':>9}{'leaked':>8}{'wall':>8}{'peak RSS':>10}{'/image':>8}"
+    )
+    for size in args.sizes.split(","):
+        command = [sys.executable, __file__, "--child", size] + [
+            f"--{name.replace('_', '-')}={value}"
+            for name, value in vars(args).items()
+            if name not in ("child", "sizes")
+        ]
+        output = subprocess.run(command, check=True, capture_output=True, text=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        print(
+            f"    {result['size']:11}{result['tiles']:7d}{result['fullGrid']:6d}"
+            f"{result['seam']:7.2f}{result['seamBound']:7.2f}"
+            f"{result['covered']:9.1%}{result['leaked']:8d}{result['wall']:7.2f}s"
+            f"{result['rssGrowth'] / 2**20:8.0f}MiB"
+            f"{result['rssGrowth'] / result['imageBytes']:7.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
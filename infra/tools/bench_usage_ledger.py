@@ -0,0 +1,339 @@
+"""Compares usage reports from the ledger rollups with full-table scans.
+
+Fills the usage table mocked by moto (or DynamoDB Local, --dynamodb-endpoint)
+with --events usage events (lambda/logic_usage_ledger.py) of --users users
+over --days days, with a daily cycle and a few heavy users. The rollups are
+built as in production: the events go through usage_rollup.lambda_handler()
+in stream batches of --batch-size records (the events themselves are loaded
+in bulk, one put each is the same item), and the last batch is delivered
+twice, as a retried batch is. Then answers, both from the rollups and from a
+scan of the table as reporting had to until now,
+
+    hourly    requests per hour over the last day
+    plans     requests, credit and SD seconds per plan over all the days
+    user      one heavy user's requests per day over the last week
+    users     distinct users per day over the last week
+
+and reports the items read, the read capacity units they cost on DynamoDB
+(estimated from the item sizes, moto does not count them) and the time of
+each, and whether both answers agree. A scan reads the whole table whatever
+the question, so it is run once and its cost counts for each question.
+moto looks through every item of the table for a query as well, so its
+query times grow with the table where DynamoDB's would not, and it walks
+the table from the start for each scan page, so scans slow down with the
+square of the table (a million events take hours under moto).
+
+    python tools/bench_usage_ledger.py
+    python tools/bench_usage_ledger.py --events 20000 --days 7
+    python tools/bench_usage_ledger.py --dynamodb-endpoint http://localhost:8000
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_handlers import ENVIRONMENT, USAGE_TABLE_NAME, create_table  # noqa: E402
+
+os.environ.update(ENVIRONMENT)
+
+DAY = 60 * 60 * 24
+KINDS = ("generate", "edge", "tiled", "sweep")
+KIND_WEIGHTS = (0.6, 0.3, 0.05, 0.05)
+GPU_SECONDS = {"generate": 6.0, "edge": 2.0, "tiled": 40.0, "sweep": 20.0}
+
+
+def week_start(until: float) -> float:
+    # the start of the UTC day a week before, the user question reads days
+    return (until - 7 * DAY) // DAY * DAY
+
+
+def synthetic_events(args, until: float):
+    # (ts, username, plan, kind, gpu seconds) in time order, about a third
+    # of the requests from the 1% heaviest users, more by day than by night
+    import numpy as np
+
+    rng = np.random.default_rng(args.seed)
+    weights = 1 / np.arange(1, args.users + 1)
+    weights /= weights.sum()
+    since = until - args.days * DAY
+    ts = rng.uniform(since, until, args.events * 2)
+    hour = (ts % DAY) / 3600
+    keep = rng.uniform(size=ts.size) < 0.6 + 0.4 * np.sin((hour - 6) / 24 * 2 * np.pi)
+    ts = np.sort(ts[keep][: args.events])
+    users = rng.choice(args.users, ts.size, p=weights)
+    kinds = rng.choice(len(KINDS), ts.size, p=KIND_WEIGHTS)
+    jitter = rng.gamma(4, 0.25, ts.size)
+    for t, user, kind, scale in zip(
+        ts.tolist(), users.tolist(), kinds.tolist(), jitter.tolist()
+    ):
+        plan = "standard" if user % 5 == 0 else "free"
+        name = KINDS[kind]
+        yield t, f"user{user:05d}", plan, name, GPU_SECONDS[name] * scale
+
+
+def fill_ledger(args, table, until: float) -> dict:
+    # loads the events in bulk and rolls them up batch by batch as the
+    # stream would, through the handler
+    from boto3.dynamodb.types import TypeSerializer
+    from logic_usage_ledger import STATUS_FAILED, STATUS_OK, usage_event
+    from logic_usage_ledger import rollup_events
+    import usage_rollup
+
+    serializer = TypeSerializer()
+    stats = Counter()
+    rollup_time = 0.0
+    batch = []
+
+    def _roll_up():
+        nonlocal rollup_time
+        stats["rollupWrites"] += len(rollup_events(usage_rollup.load_events(batch)))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(None):
+            usage_rollup.lambda_handler({"Records": batch}, None)
+        rollup_time += time.perf_counter() - start
+        stats["batches"] += 1
+
+    with table.batch_writer() as writer:
+        for i, (ts, username, plan, kind, gpu_seconds) in enumerate(
+            synthetic_events(args, until)
+        ):
+            # one in 20 from the result cache, one in 50 failed
+            cached, failed = i % 20 == 0, i % 50 == 1
+            item = usage_event(
+                username,
+                kind,
+                plan,
+                credit=0 if cached or failed else 1,
+                gpu_seconds=0.0 if cached else gpu_seconds,
+                status=STATUS_FAILED if failed else STATUS_OK,
+                cached=cached,
+                ts=ts,
+            )
+            writer.put_item(Item=item)
+            stats["events"] += 1
+            batch.append(
+                {
+                    "eventID": str(i),
+                    "eventName": "INSERT",
+                    "dynamodb": {
+                        "NewImage": {
+                            k: serializer.serialize(v) for k, v in item.items()
+                        }
+                    },
+                }
+            )
+            if len(batch) == args.batch_size:
+                _roll_up()
+                batch = []
+            if args.progress and (i + 1) % args.progress == 0:
+                print(f"  {i + 1} events", file=sys.stderr)
+    if batch:
+        _roll_up()
+        # a retried batch adds nothing
+        with contextlib.redirect_stdout(None):
+            usage_rollup.lambda_handler({"Records": batch}, None)
+    return {**stats, "rollupTime": rollup_time}
+
+
+def count_rollup_items(table) -> int:
+    from boto3.dynamodb.conditions import Key
+
+    n_items = 0
+    for pk in ("usage#hour", "usage#day"):
+        n_items += table.query(KeyConditionExpression=Key("pk").eq(pk), Select="COUNT")[
+            "Count"
+        ]
+    return n_items
+
+
+def item_size(item: dict) -> int:
+    # bytes by DynamoDB's rules: names plus values, numbers about a byte per
+    # two digits
+    size = 0
+    for name, value in item.items():
+        size += len(name.encode())
+        if isinstance(value, str):
+            size += len(value.encode())
+        elif isinstance(value, (set, frozenset)):
+            size += sum(len(str(v).encode()) for v in value)
+        elif isinstance(value, bool):
+            size += 1
+        else:
+            size += (len(str(value).replace(".", "").lstrip("-")) + 1) // 2 + 1
+    return size
+
+
+def read_units(sizes: list) -> float:
+    # eventually consistent reads, half a unit per started 4KB
+    return -(-sum(sizes) // 4096) * 0.5
+
+
+class ReadCounter:
+    # wraps the table of a UsageLedger to count what its queries read; moto
+    # reports a made-up capacity
+    def __init__(self, table):
+        self._table = table
+        self.name = table.name
+        self.meta = table.meta
+        self.reset()
+
+    def reset(self):
+        self.items, self.units = 0, 0.0
+
+    def query(self, **kwargs):
+        response = self._table.query(**kwargs)
+        self.items += len(response["Items"])
+        self.units += read_units([item_size(item) for item in response["Items"]])
+        return response
+
+
+def answers_from_scan(table, until: float, user: str) -> tuple:
+    # reads the whole table page by page as a report without rollups has to;
+    # filtering in the scan would not make it read less
+    from logic_usage_ledger import DAY as DAY_BUCKET, HOUR, bucket_of
+
+    hourly = Counter()
+    plans = defaultdict(Counter)
+    daily = Counter()
+    users = defaultdict(set)
+    n_scanned, units = 0, 0.0
+    kwargs = {}
+    while True:
+        response = table.scan(**kwargs)
+        items = response["Items"]
+        n_scanned += len(items)
+        units += read_units([item_size(item) for item in items])
+        for event in items:
+            if not event["sk"].startswith("usage#"):
+                continue
+            ts = float(event["ts"])
+            if ts >= until - DAY:
+                hourly[bucket_of(ts, HOUR)] += 1
+            plan = plans[event.get("plan", "-")]
+            plan["requests"] += 1
+            plan["credit"] += int(event["credit"])
+            plan["gpuSeconds"] += float(event["gpuSeconds"])
+            if ts >= week_start(until):
+                users[bucket_of(ts, DAY_BUCKET)].add(event["pk"])
+                if event["pk"] == user:
+                    daily[bucket_of(ts, DAY_BUCKET)] += 1
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    answers = {
+        "hourly": dict(hourly),
+        "plans": {
+            name: (c["requests"], c["credit"], round(c["gpuSeconds"]))
+            for name, c in plans.items()
+        },
+        "user": dict(daily),
+        "users": {day: len(names) for day, names in users.items()},
+    }
+    return answers, n_scanned, units
+
+
+def answers_from_rollups(ledger, since: float, until: float, user: str) -> tuple:
+    from logic_usage_ledger import DAY as DAY_BUCKET, HOUR
+
+    reads = ledger._table = ReadCounter(ledger._table)
+    timings = {}
+
+    def _timed(name, func, *args):
+        reads.reset()
+        start = time.perf_counter()
+        result = func(*args)
+        timings[name] = (time.perf_counter() - start, reads.items, reads.units)
+        return result
+
+    hourly = _timed("hourly", ledger.get_rollups, until - DAY, until, HOUR)
+    total = _timed("plans", ledger.get_usage, since, until)
+    daily = _timed(
+        "user", ledger.get_rollups, week_start(until), until, DAY_BUCKET, user
+    )
+    days = _timed("users", ledger.get_rollups, week_start(until), until, DAY_BUCKET)
+    plans = {}
+    for name in total:
+        if name.startswith("requests#plan:"):
+            plan = name.split(":", 1)[1]
+            plans[plan] = (
+                total[name],
+                total[f"credit#plan:{plan}"],
+                round(total[f"gpuSeconds#plan:{plan}"]),
+            )
+    answers = {
+        "hourly": {r["bucket"]: r["requests"] for r in hourly},
+        "plans": plans,
+        "user": {r["bucket"]: r["requests"] for r in daily},
+        "users": {r["bucket"]: r["users"] for r in days},
+    }
+    return answers, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--batch-size", type=int, default=500, help="stream records")
+    parser.add_argument("--dynamodb-endpoint", help="e.g. DynamoDB Local")
+    parser.add_argument("--progress", type=int, default=0, help="print every n events")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.dynamodb_endpoint:
+        os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = args.dynamodb_endpoint
+        mock = contextlib.nullcontext()
+    else:
+        from moto import mock_aws
+
+        mock = mock_aws()
+
+    with mock:
+        import boto3
+        from logic_usage_ledger import UsageLedger
+
+        create_table()
+        table = boto3.resource("dynamodb").Table(USAGE_TABLE_NAME)
+        # whole hours, so that both answers cover the same range
+        until = (time.time() // 3600 + 1) * 3600
+        since = until - args.days * DAY
+        user = "user00000"  # the heaviest
+
+        filled = fill_ledger(args, table, until)
+        n_rollups = count_rollup_items(table)
+        print(
+            f"{filled['events']} events of {args.users} users over {args.days} days,"
+            f" rolled up in {filled['batches']} batches of {args.batch_size}"
+        )
+        print(
+            f"    {filled['rollupWrites'] / filled['events']:.2f} rollup writes"
+            f" and {filled['rollupTime'] / filled['events'] * 1000:.2f}ms per event,"
+            f" {n_rollups} service rollup items"
+        )
+
+        start = time.perf_counter()
+        expected, n_scanned, scan_units = answers_from_scan(table, until, user)
+        scan_time = time.perf_counter() - start
+        ledger = UsageLedger()
+        answers, timings = answers_from_rollups(ledger, since, until, user)
+
+    print(
+        f"    {'question':10}{'rollups: items':>16}{'RCU':>8}{'time':>10}"
+        f"{'scan: items':>14}{'RCU':>9}{'time':>10}{'same':>6}"
+    )
+    for name, (seconds, n_items, units) in timings.items():
+        print(
+            f"    {name:10}{n_items:16d}{units:8.1f}{seconds * 1000:8.1f}ms"
+            f"{n_scanned:14d}{scan_units:9.0f}{scan_time:9.1f}s"
+            f"{'yes' if answers[name] == expected[name] else 'NO':>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""Checks admission control end to end, in memory and on DynamoDB.
+
+Runs AdmissionController with real threads and sleeps against the in-process
+store and against DynamoAdmissionStore (DynamoDB mocked by moto, or DynamoDB
+Local with --dynamodb-endpoint), and asserts that
+  fairness    with --capacity slots and clients of one standard user and
+              --free-users free users always waiting, the slot time splits
+              by the plan weights, the free users get equal shares, and
+              neither the capacity nor a user's in-flight limit is exceeded
+  expiry      the lease of a holder that never releases it runs out after
+              the lease TTL and its slot goes to the next waiter
+  renewal     a holder inside admitted() for several lease TTLs keeps its
+              slot, and the waiter gets it as soon as the holder is done
+  units       requests of several units (sweeps, tiles) hold that many
+              slots, at most --capacity, beside requests of one unit, and
+              neither kind is starved by the other
+  contention  (DynamoDB only) --threads threads updating the state at once
+              lose no update, and report the round trips per update
+Exits non-zero when a check fails.
+
+Times are scaled down: a request holds its slot for --hold seconds and the
+poll interval is shortened to match.
+
+    python tools/check_admission.py
+    python tools/check_admission.py --duration 20 --free-users 4
+    python tools/check_admission.py --dynamodb-endpoint http://localhost:8000
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_credit import CallCounter, atomic_moto  # noqa: E402
+from bench_handlers import ENVIRONMENT, create_table  # noqa: E402
+
+
+class Occupancy:
+    # slots held right now and in total, as seen by the holders
+    def __init__(self):
+        self.held = Counter()  # user -> leases held now
+        self.time = defaultdict(float)  # user -> sec held
+        self.peak = 0
+        self.violations = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def hold(self, user: str, limit: int, capacity: int):
+        with self._lock:
+            self.held[user] += 1
+            total = sum(self.held.values())
+            self.peak = max(self.peak, total)
+            if total > capacity:
+                self.violations.append(f"{total} leases for {capacity} slots")
+            if self.held[user] > limit:
+                self.violations.append(f"{user} held {self.held[user]} > {limit}")
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.held[user] -= 1
+                self.time[user] += time.monotonic() - start
+
+
+def make_controller(store, capacity: int, lease_ttl: float):
+    from logic_admission import AdmissionController, FairShareScheduler
+
+    return AdmissionController(store, FairShareScheduler(capacity, lease_ttl))
+
+
+def check_fairness(args, new_store, failures: list):
+    from logic_admission import AdmissionRejectedError, plan_policy
+
+    controller = make_controller(new_store(), args.capacity, lease_ttl=30)
+    occupancy = Occupancy()
+    users = [("std0", "standard")] + [
+        (f"free{i}", "free") for i in range(args.free_users)
+    ]
+    rejected = Counter()
+    stop = time.monotonic() + args.duration
+
+    def client(user: str, plan: str):
+        _, limit = plan_policy(plan)
+        # its own controller per client, as every Lambda invocation has
+        own = make_controller(new_store(), args.capacity, lease_ttl=30)
+        while time.monotonic() < stop:
+            try:
+                with own.admitted(user, plan, "generate", max_wait=args.duration):
+                    if time.monotonic() >= stop:
+                        # the queue drains with fewer users waiting, not counted
+                        break
+                    with occupancy.hold(user, limit, args.capacity):
+                        time.sleep(args.hold)
+            except AdmissionRejectedError as error:
+                rejected[type(error).__name__] += 1
+
+    threads = []
+    for user, plan in users:
+        _, limit = plan_policy(plan)
+        # one client more than the user may have in flight keeps it waiting
+        for _ in range(limit + 1):
+            threads.append(threading.Thread(target=client, args=(user, plan)))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    total = sum(occupancy.time.values())
+    standard = occupancy.time["std0"] / total
+    weight, _ = plan_policy("standard")
+    free_weight, _ = plan_policy("free")
+    expected = weight / (weight + free_weight)
+    free = [occupancy.time[user] for user, plan in users if plan == "free"]
+    print(
+        f"  fairness:   standard {standard:.0%} of the slot time (expected "
+        f"{expected:.0%}), free users {', '.join(f'{t / total:.0%}' for t in free)}, "
+        f"peak {occupancy.peak}/{args.capacity}, rejected {sum(rejected.values())}"
+    )
+    failures += occupancy.violations[:3]
+    if abs(standard - expected) > 0.1:
+        failures.append(f"standard got {standard:.0%} instead of {expected:.0%}")
+    if max(free) > 1.5 * min(free):
+        failures.append(f"unequal free shares {[round(t, 1) for t in free]}")
+    if rejected:
+        failures.append(f"rejected within the max wait: {dict(rejected)}")
+    if controller.snapshot()["inFlight"]:
+        failures.append("leases left after every client finished")
+
+
+def check_expiry(args, new_store, failures: list):
+    # capacity 1: the crashed holder's slot is the only one
+    lease_ttl = 4 * args.hold
+    crashed = make_controller(new_store(), 1, lease_ttl)
+    crashed.acquire("crashed", "free", "generate")
+    start = time.monotonic()
+    make_controller(new_store(), 1, lease_ttl).acquire(
+        "next", "free", "generate", max_wait=3 * lease_ttl
+    )
+    waited = time.monotonic() - start
+    print(f"  expiry:     slot of a crashed holder taken after {waited:.2f}s")
+    if not lease_ttl * 0.9 <= waited <= lease_ttl + 1.0:
+        failures.append(f"a lease of {lease_ttl}s expired after {waited:.2f}s")
+
+
+def check_renewal(args, new_store, failures: list):
+    from logic_admission import AdmissionRejectedError
+
+    lease_ttl = 4 * args.hold
+    held = 3 * lease_ttl
+    holder = make_controller(new_store(), 1, lease_ttl)
+    entered, done = threading.Event(), [0.0]
+
+    def hold():
+        with holder.admitted("holder", "free", "generate", max_wait=1):
+            entered.set()
+            time.sleep(held)
+        done[0] = time.monotonic()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    entered.wait()
+    waiter = make_controller(new_store(), 1, lease_ttl)
+    try:
+        waiter.acquire("waiter", "free", "generate", max_wait=held - lease_ttl)
+        failures.append("a renewed lease was taken by a waiter")
+    except AdmissionRejectedError:
+        pass
+    lease_id, _ = waiter.acquire("waiter", "free", "generate", max_wait=held)
+    got = time.monotonic()
+    thread.join()
+    waiter.release(lease_id)
+    late = got - done[0]
+    print(
+        f"  renewal:    held {held:.1f}s with a {lease_ttl:.1f}s lease, "
+        f"the waiter got the slot {late:.2f}s after its release"
+    )
+    if late > 3 * args.poll:
+        failures.append(f"the waiter got the released slot {late:.2f}s late")
+
+
+def check_units(args, new_store, failures: list):
+    from logic_admission import AdmissionRejectedError
+
+    used = [0, 0]  # slots held now, at most
+    done = Counter()
+    lock = threading.Lock()
+    stop = time.monotonic() + args.duration / 2
+
+    def client(user: str, units: int):
+        slots = min(units, args.capacity)
+        own = make_controller(new_store(), args.capacity, lease_ttl=30)
+        while time.monotonic() < stop:
+            try:
+                with own.admitted(
+                    user, "free", "generate", max_wait=args.duration, units=units
+                ):
+                    with lock:
+                        used[0] += slots
+                        used[1] = max(used)
+                    time.sleep(args.hold)
+                    with lock:
+                        used[0] -= slots
+                        done[units] += 1
+            except AdmissionRejectedError:
+                done["rejected"] += 1
+
+    # a sweep of more units than there are slots, and single ones beside it
+    clients = [("sweep", 2 * args.capacity)]
+    clients += [(f"single{i}", 1) for i in range(args.capacity)]
+    threads = [threading.Thread(target=client, args=c) for c in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(
+        f"  units:      {done[2 * args.capacity]} sweeps and {done[1]} single "
+        f"requests, at most {used[1]} of {args.capacity} slots held"
+    )
+    if used[1] > args.capacity:
+        failures.append(f"{used[1]} slots held of {args.capacity}")
+    if not done[2 * args.capacity] or not done[1]:
+        failures.append(f"a kind of request was starved: {dict(done)}")
+    if done["rejected"]:
+        failures.append(f"{done['rejected']} rejected within the max wait")
+
+
+def check_contention(args, new_store, failures: list, counter: CallCounter):
+    from logic_admission import AdmissionContentionError
+
+    updates = 20
+    applied = Counter()
+    counter.take()
+
+    def bump(state):
+        state["cost"]["check"] = state["cost"].get("check", 0) + 1
+
+    def run(i: int):
+        store = new_store()
+        for _ in range(updates):
+            try:
+                store.update(bump)
+            except AdmissionContentionError:
+                applied["gave up"] += 1
+                continue
+            applied["done"] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    calls = counter.take()
+    total = new_store().read(lambda state: state["cost"].get("check", 0))
+    n = args.threads * updates
+    print(
+        f"  contention: {total} of {n} updates by {args.threads} threads, "
+        f"{sum(calls.values()) / n:.2f} round trips per update ({dict(calls)})"
+    )
+    if total != applied["done"]:
+        failures.append(f"{applied['done'] - total} updates lost")
+    if applied["gave up"]:
+        failures.append(f"{applied['gave up']} updates gave up on the contention")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--capacity", type=int, default=2)
+    parser.add_argument("--free-users", type=int, default=3)
+    parser.add_argument("--duration", type=float, default=20.0, help="in sec")
+    parser.add_argument("--hold", type=float, default=1.0, help="in sec")
+    parser.add_argument("--threads", type=int, default=8, help="contention")
+    parser.add_argument("--dynamodb-endpoint", help="DynamoDB Local instead of moto")
+    args = parser.parse_args()
+    args.poll = args.hold / 4
+
+    os.environ.update(ENVIRONMENT)
+    os.environ["ADMISSION_COST_GENERATE"] = str(args.hold)
+    import logic_admission
+
+    logic_admission.POLL_INTERVAL = args.poll
+    logic_admission.MAX_POLL_INTERVAL = 4 * args.poll
+    failures = []
+
+    print("in memory")
+    for check in (check_fairness, check_expiry, check_renewal, check_units):
+        shared = logic_admission.InMemoryAdmissionStore()
+        check(args, lambda: shared, failures)
+
+    import boto3
+
+    if args.dynamodb_endpoint:
+        os.environ["AWS_ENDPOINT_URL_DYNAMODB"] = args.dynamodb_endpoint
+        mock = contextlib.nullcontext()
+    else:
+        mock = atomic_moto()
+    counter = CallCounter()
+    with mock:
+        # moto replaces the default session, so the hook comes after it starts
+        boto3.setup_default_session()
+        boto3.DEFAULT_SESSION.events.register("before-call.dynamodb", counter)
+        create_table()
+        table = boto3.resource("dynamodb").Table(ENVIRONMENT["DYNAMO_TABLE_NAME"])
+        print("dynamodb")
+        for check in (check_fairness, check_expiry, check_renewal, check_units):
+            table.delete_item(Key={"pk": "GLOBAL", "sk": "admission"})
+            counter.take()
+            check(args, logic_admission.DynamoAdmissionStore, failures)
+            if check is check_fairness:
+                calls = counter.take()
+                rates = ", ".join(
+                    f"{op} {n / args.duration:.1f}/s" for op, n in sorted(calls.items())
+                )
+                print(f"              on the admission item: {rates}")
+        table.delete_item(Key={"pk": "GLOBAL", "sk": "admission"})
+        check_contention(args, logic_admission.DynamoAdmissionStore, failures, counter)
+
+    for failure in failures:
+        print(f"FAILED {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
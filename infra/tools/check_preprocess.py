@@ -0,0 +1,184 @@
+"""Checks the geometry and timing of generate's preprocess_inputs/paste_back.
+
+On a synthetic noise image with a rectangular mask, asserts that
+  - a small input is passed through untouched,
+  - a large input is downscaled to the limit_size() of SD, mask and edge
+    alike, and the img2img payload asks for that size,
+  - with inpaintOnlyMasked, the inputs are cropped to the mask's bounding box
+    plus inpaintPadding, and a compact mask stays compact,
+  - paste_back returns the full-resolution image with the rendered crop
+    inside the mask and the original pixels outside it,
+and that preprocessing and pasting back each take less than --max-seconds
+(median of --repeat runs). Exits non-zero when a check fails.
+
+Needs numpy and opencv.
+
+    python tools/check_preprocess.py
+    python tools/check_preprocess.py --image-size 4000x3000 --repeat 3
+"""
+
+import argparse
+import base64
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+from bench_handlers import ENVIRONMENT  # noqa: E402
+
+
+def data_url(image: np.ndarray) -> str:
+    return (
+        "data:image/png;base64,"
+        + base64.b64encode(cv2.imencode(".png", image)[1]).decode()
+    )
+
+
+def decode(data: str) -> np.ndarray:
+    from logic_image import decode_image
+
+    return decode_image(data)
+
+
+def make_body(width: int, height: int, box: tuple, **extra) -> tuple:
+    # -> (body, image, mask); box is (top, bottom, left, right) of the mask
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    top, bottom, left, right = box
+    mask[top:bottom, left:right] = 255
+    body = {
+        "sampler": "DPM++ 2M Karras",
+        "steps": 20,
+        "seed": 1,
+        "width": width,
+        "height": height,
+        "maskBlur": 0,
+        "cfgScale": 7,
+        "denosing": 0.6,
+        "initialNoiseMultiplier": 1.0,
+        "controlMode": 0,
+        "controlWeight": 1.0,
+        "referenceControlMode": 0,
+        "referenceControlWeight": 1.0,
+        "inpaintingFill": 1,
+        "imageData": data_url(image),
+        "maskData": data_url(mask),
+        "edgeData": data_url(image[..., 0]),
+        "positivePrompt": "",
+        "negativePrompt": "",
+        "useEdge": True,
+        "useReference": True,
+        "useAnotherImageForReference": False,
+        "referenceImageData": "",
+        **extra,
+    }
+    return body, image, mask
+
+
+def size_of(data: str) -> tuple:
+    image = decode(data)
+    return image.shape[1], image.shape[0]
+
+
+def median_time(func, *args, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--image-size", default="2000x1500", help="WIDTHxHEIGHT")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=1.0)
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+
+    os.environ.update(ENVIRONMENT)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import generate
+    from logic_mask import encode_compact_mask, is_compact_mask
+
+    box = (height // 3, height // 3 + 200, width // 3, width // 3 + 300)
+    padding = generate.INPAINT_PADDING
+
+    # small inputs go to SD as they are
+    body, _, _ = make_body(512, 512, (100, 200, 100, 200))
+    out, context = generate.preprocess_inputs(body)
+    assert out is body and context is None, "a small input was processed"
+    print("small:   512x512 passed through")
+
+    # large inputs are downscaled to what SD renders at
+    body, _, _ = make_body(width, height, box)
+    out, context = generate.preprocess_inputs(body)
+    target = generate.limit_size(width, height)
+    assert context is None
+    for name in ("imageData", "maskData", "edgeData"):
+        assert size_of(out[name]) == target, (name, size_of(out[name]), target)
+    payload = generate.build_img2img_payload(out)
+    assert (payload["width"], payload["height"]) == target
+    pixels = width * height / (target[0] * target[1])
+    print(
+        f"default: {width}x{height} sent as {target[0]}x{target[1]}, "
+        f"{pixels:.1f}x fewer pixels"
+    )
+
+    # only the mask's bounding box, padded, with the original kept outside
+    body, image, mask = make_body(width, height, box, inpaintOnlyMasked=True)
+    out, context = generate.preprocess_inputs(body)
+    top, bottom, left, right = box
+    region = (top - padding, bottom + padding, left - padding, right + padding)
+    assert context["region"] == region, (context["region"], region)
+    crop = (region[3] - region[2], region[1] - region[0])
+    assert (out["width"], out["height"]) == crop
+    assert size_of(out["imageData"]) == crop, size_of(out["imageData"])
+    assert size_of(out["maskData"]) == crop
+    rendered = generate.limit_size(*crop)
+    payload = generate.build_img2img_payload(out)
+    assert (payload["width"], payload["height"]) == rendered
+
+    generated = np.full((rendered[1], rendered[0], 3), 7, dtype=np.uint8)
+    pasted = decode(generate.paste_back(data_url(generated), context))
+    assert pasted.shape == image.shape, pasted.shape
+    inside = mask > 0
+    assert (pasted[inside] == 7).all(), "the render is missing inside the mask"
+    assert (pasted[~inside] == image[~inside]).all(), "pixels outside changed"
+    print(
+        f"crop:    {crop[0]}x{crop[1]} sent, rendered at "
+        f"{rendered[0]}x{rendered[1]}, pasted into {width}x{height}"
+    )
+
+    # a compact mask is cropped but stays compact
+    body, _, mask = make_body(width, height, box, inpaintOnlyMasked=True)
+    body["maskData"] = encode_compact_mask(mask)
+    out, context = generate.preprocess_inputs(body)
+    assert is_compact_mask(out["maskData"]), "the compact mask was re-encoded"
+    assert (out["maskData"]["width"], out["maskData"]["height"]) == crop
+    print("compact: stays compact, cropped to the same region")
+
+    body, _, _ = make_body(width, height, box, inpaintOnlyMasked=True)
+    preprocess_time = median_time(generate.preprocess_inputs, body, repeat=args.repeat)
+    _, context = generate.preprocess_inputs(body)
+    out_image = data_url(generated)
+    paste_time = median_time(
+        lambda: generate.paste_back(out_image, dict(context, image=image.copy())),
+        repeat=args.repeat,
+    )
+    print(f"timing:  preprocess {preprocess_time:.3f}s, paste_back {paste_time:.3f}s")
+    assert preprocess_time < args.max_seconds, "preprocessing is too slow"
+    assert paste_time < args.max_seconds, "pasting back is too slow"
+
+
+if __name__ == "__main__":
+    main()
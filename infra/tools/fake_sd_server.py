@@ -0,0 +1,297 @@
+"""Fake Stable Diffusion WebUI API for local runs of the Lambdas.
+
+Answers the endpoints the Lambdas call with a PNG after a fixed delay per
+image. The PNG has the requested width/height, or --image-size, and is noise
+by default so that its size is close to a real render. Images of one batch
+take --batch-cost of the delay each after the first, as a GPU renders a
+batch faster than the same images one by one. Like the real server
+it runs one img2img job at a time, so concurrent requests queue up and show
+in ``/sdapi/v1/progress``. ``/internal/progress`` reports on the job of one
+force_task_id: queued, or the fraction done and a live preview every
+--preview-every steps while it runs. ControlNet
+detection and tagging are extension routes outside that queue, so they
+overlap; --delays gives them (or any path) a delay of their own.
+
+    python tools/fake_sd_server.py --port 7861 --delay 1.5 --image-size 512x768
+    python tools/fake_sd_server.py --delays /tagger/v1/interrogate=3
+"""
+
+import argparse
+import base64
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    chunk = kind + data
+    return struct.pack(">I", len(data)) + chunk + struct.pack(">I", zlib.crc32(chunk))
+
+
+@lru_cache(maxsize=16)
+def make_png(width: int, height: int, channels: int = 3, noise: bool = True) -> str:
+    # base64 PNG, 8 bit gray (channels=1) or RGB
+    row_size = width * channels
+    if noise:
+        pixels = os.urandom(row_size * height)
+    else:
+        pixels = bytes(range(256)) * (row_size * height // 256 + 1)
+    raw = b"".join(
+        b"\0" + pixels[y * row_size : (y + 1) * row_size] for y in range(height)
+    )
+    color_type = 0 if channels == 1 else 2
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    png = (
+        b"\x89PNG\r\n\x1a\n"
+        + _png_chunk(b"IHDR", header)
+        + _png_chunk(b"IDAT", zlib.compress(raw, 1))
+        + _png_chunk(b"IEND", b"")
+    )
+    return base64.b64encode(png).decode()
+
+
+class FakeSDServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port: int = 0,
+        delay: float = 1.0,
+        host: str = "127.0.0.1",
+        image_size: Optional[Tuple[int, int]] = None,
+        noise: bool = True,
+    ):
+        super().__init__((host, port), FakeSDHandler)
+        self.delay = delay
+        self.image_size = image_size  # (width, height), default as requested
+        self.noise = noise
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.gpu_lock = threading.Lock()
+        self.job_count = 0
+        self.n_requests = 0
+        self._count_lock = threading.Lock()
+        self._thread = None
+        self.stopped = False
+        self.preview_every = 5  # steps
+        self.batch_cost = 1.0  # of the delay, per image of a batch after the first
+        self.running = None  # (started at, duration, sampling steps, task id)
+        self.queued_tasks = set()
+        self.render = None  # img2img data -> base64 image, instead of image()
+        self.delays = {}  # path -> delay in sec, instead of delay
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeSDServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # also drops the keep-alive connections that are still open
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+
+    def image(self, width: int = 512, height: int = 512) -> str:
+        width, height = self.image_size or (width, height)
+        return make_png(width, height, noise=self.noise)
+
+    def progress(self) -> dict:
+        running = self.running
+        state = {"job_count": self.job_count, "job_no": 0}
+        if running is None:
+            return {"progress": 0.0, "eta_relative": 0.0, "state": state}
+        started_at, duration, steps, _ = running
+        elapsed = time.monotonic() - started_at
+        fraction = min(elapsed / duration, 1.0) if duration else 1.0
+        step = int(fraction * steps)
+        state.update(sampling_step=step, sampling_steps=steps)
+        current_image = None
+        if self.preview_every and step >= self.preview_every:
+            # a different (tiny) image per preview
+            shade = step // self.preview_every
+            current_image = make_png(64, 64 + shade % 2, noise=False)
+        return {
+            "progress": fraction,
+            "eta_relative": max(duration - elapsed, 0.0),
+            "state": state,
+            "current_image": current_image,
+        }
+
+    def task_progress(self, task_id: str, last_preview_id: int) -> dict:
+        # /internal/progress, of one task only
+        running = self.running
+        if running is None or running[3] != task_id:
+            queued = task_id in self.queued_tasks
+            return {"active": False, "queued": queued, "completed": not queued}
+        started_at, duration, steps, _ = running
+        elapsed = time.monotonic() - started_at
+        fraction = min(elapsed / duration, 1.0) if duration else 1.0
+        body = {
+            "active": True,
+            "queued": False,
+            "completed": False,
+            "progress": fraction,
+            "eta": max(duration - elapsed, 0.0),
+        }
+        step = int(fraction * steps)
+        preview_id = step // self.preview_every if self.preview_every else 0
+        if preview_id > 0 and preview_id != last_preview_id:
+            # a different (tiny) image per preview
+            body["live_preview"] = "data:image/png;base64," + make_png(
+                64, 64 + preview_id % 2, noise=False
+            )
+            body["id_live_preview"] = preview_id
+        return body
+
+    def count_bytes(self, received: int, sent: int):
+        with self._count_lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def run_job(
+        self,
+        n_images: int,
+        steps: int = 20,
+        n_iter: int = 1,
+        task_id: Optional[str] = None,
+    ):
+        with self._count_lock:
+            self.job_count += 1
+            self.n_requests += 1
+            self.queued_tasks.add(task_id)
+        try:
+            with self.gpu_lock:
+                self.queued_tasks.discard(task_id)
+                delay = self.delays.get("/sdapi/v1/img2img", self.delay)
+                batch = delay * (1 + (n_images - 1) * self.batch_cost)
+                duration = batch * n_iter
+                self.running = (time.monotonic(), duration, steps, task_id)
+                time.sleep(duration)
+                self.running = None
+        finally:
+            with self._count_lock:
+                self.job_count -= 1
+                self.queued_tasks.discard(task_id)
+
+    def run_extension(self, path: str):
+        # not queued behind img2img, as the WebUI's extension routes are not
+        with self._count_lock:
+            self.n_requests += 1
+        time.sleep(self.delays.get(path, self.delay))
+
+
+class FakeSDHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as uvicorn does
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_one_request(self):
+        if self.server.stopped:
+            self.close_connection = True
+            return
+        super().handle_one_request()
+
+    def _reply(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count_bytes(self._received, len(data))
+
+    def do_GET(self):
+        self._received = 0
+        path = self.path.split("?", 1)[0]
+        if path == "/sdapi/v1/options":
+            self._reply({"sd_model_checkpoint": "fake"})
+        elif path == "/sdapi/v1/progress":
+            self._reply(self.server.progress())
+        else:
+            self._reply({"detail": "Not Found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self._received = length
+        data = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?", 1)[0]
+        if path == "/sdapi/v1/img2img":
+            # like the WebUI, batch_size images per iteration whatever the
+            # number of init_images
+            batch_size = int(data.get("batch_size") or 1)
+            n_iter = int(data.get("n_iter") or 1)
+            self.server.run_job(
+                batch_size,
+                int(data.get("steps") or 20),
+                n_iter,
+                data.get("force_task_id"),
+            )
+            if self.server.render is not None:
+                image = self.server.render(data)
+            else:
+                image = self.server.image(
+                    data.get("width", 512), data.get("height", 512)
+                )
+            self._reply({"images": [image] * (batch_size * n_iter)})
+        elif path == "/internal/progress":
+            self._reply(
+                self.server.task_progress(
+                    data.get("id_task"), int(data.get("id_live_preview", -1))
+                )
+            )
+        elif path == "/controlnet/detect-only":
+            self.server.run_extension(path)
+            self._reply({"images": [self.server.image()]})
+        elif path == "/tagger/v1/interrogate":
+            self.server.run_extension(path)
+            self._reply({"caption": {"tag": {"1girl": 0.9}, "rating": {}}})
+        else:
+            self._reply({"detail": "Not Found"}, 404)
+
+
+def parse_delays(value: str) -> dict:
+    # "/tagger/v1/interrogate=3,/controlnet/detect-only=1" -> {path: sec}
+    delays = {}
+    for item in filter(None, value.split(",")):
+        path, _, delay = item.partition("=")
+        delays[path.strip()] = float(delay)
+    return delays
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--delay", type=float, default=1.0, help="sec per image")
+    parser.add_argument("--image-size", help="WIDTHxHEIGHT, default as requested")
+    parser.add_argument("--flat", action="store_true", help="compressible images")
+    parser.add_argument("--preview-every", type=int, default=5, help="steps")
+    parser.add_argument("--batch-cost", type=float, default=1.0, help="x delay")
+    parser.add_argument("--delays", default="", help="PATH=SEC,... per endpoint")
+    args = parser.parse_args()
+
+    image_size = None
+    if args.image_size:
+        image_size = tuple(int(v) for v in args.image_size.lower().split("x"))
+    server = FakeSDServer(args.port, args.delay, args.host, image_size, not args.flat)
+    server.preview_every = args.preview_every
+    server.batch_cost = args.batch_cost
+    server.delays = parse_delays(args.delays)
+    print(f"fake SD server on {server.url}, {args.delay}s per image")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
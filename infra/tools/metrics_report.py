@@ -0,0 +1,78 @@
+"""Per-stage latency percentiles from the metrics the Lambdas log.
+
+Every instrumented handler logs one CloudWatch Embedded Metric Format line per
+invocation (see lambda/logic_metrics.py). This collects those lines from log
+files or stdin, e.g. ``aws logs tail /aws/lambda/retouchapp-generate --since
+1h``, and prints p50/p95/p99 per function and stage plus the counter totals.
+
+    aws logs tail /aws/lambda/retouchapp-generate --since 1d | python tools/metrics_report.py
+    python tools/metrics_report.py generate.log edge.log --function generate
+"""
+
+import argparse
+import fileinput
+import json
+import statistics
+from collections import defaultdict
+
+
+def parse_line(line: str):
+    # log lines may be prefixed with the time and request id
+    start = line.find('{"_aws"')
+    if start < 0:
+        return None
+    try:
+        return json.loads(line[start:])
+    except ValueError:
+        return None
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="*", help="default: stdin")
+    parser.add_argument("--function", help="only this function")
+    args = parser.parse_args()
+
+    timings = defaultdict(lambda: defaultdict(list))  # function -> stage -> [ms]
+    counters = defaultdict(lambda: defaultdict(float))
+    for line in fileinput.input(args.files):
+        record = parse_line(line)
+        if record is None:
+            continue
+        function = record.get("Function", "unknown")
+        if args.function and function != args.function:
+            continue
+        for directive in record["_aws"]["CloudWatchMetrics"]:
+            for metric in directive["Metrics"]:
+                name = metric["Name"]
+                value = record.get(name)
+                if value is None:
+                    continue
+                if metric.get("Unit") == "Count":
+                    counters[function][name] += value
+                else:
+                    values = value if isinstance(value, list) else [value]
+                    timings[function][name].extend(values)
+
+    for function in sorted(set(timings) | set(counters)):
+        n_calls = len(timings[function].get("handler", []))
+        print(f"{function} ({n_calls} invocations)")
+        print(f"    {'stage':32}{'n':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'mean':>9}")
+        stages = sorted(timings[function].items(), key=lambda kv: -sum(kv[1]))
+        for stage, values in stages:
+            print(
+                f"    {stage:32}{len(values):7d}"
+                f"{percentile(values, 0.5):9.1f}{percentile(values, 0.95):9.1f}"
+                f"{percentile(values, 0.99):9.1f}{statistics.mean(values):9.1f}"
+            )
+        for name, total in sorted(counters[function].items()):
+            print(f"    {name:32}{total:7g}")
+
+
+if __name__ == "__main__":
+    main()
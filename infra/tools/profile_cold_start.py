@@ -0,0 +1,114 @@
+"""Cold start profile of the Lambdas in infra/lambda.
+
+For every handler module, a fresh interpreter imports it under
+``python -X importtime`` and reports the import (init) time with the heaviest
+top-level imports. With ``--event module=event.json`` the handler is also
+invoked twice in that interpreter, giving cold (first) and warm (second)
+request latency. Invocations talk to whatever AWS/SD endpoints the environment
+points at, e.g. a local DynamoDB and fake SD server.
+
+    python tools/profile_cold_start.py --runs 5 --top 8
+    python tools/profile_cold_start.py generate --event generate=ev.json
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+CHILD = """
+import json, sys, time
+sys.path.insert(0, {lambda_dir!r})
+start = time.perf_counter()
+import {module} as module
+result = {{"init": time.perf_counter() - start}}
+event_path = {event_path!r}
+if event_path:
+    with open(event_path) as f:
+        event = json.load(f)
+    for name in ("cold", "warm"):
+        start = time.perf_counter()
+        module.lambda_handler(event, None)
+        result[name] = time.perf_counter() - start
+print(json.dumps(result))
+"""
+
+
+def handler_modules() -> list:
+    modules = []
+    for filename in sorted(os.listdir(LAMBDA_DIR)):
+        if not filename.endswith(".py"):
+            continue
+        with open(os.path.join(LAMBDA_DIR, filename)) as f:
+            if "def lambda_handler(" in f.read():
+                modules.append(filename[:-3])
+    return modules
+
+
+def run_once(module: str, event_path: str = None) -> tuple:
+    code = CHILD.format(lambda_dir=LAMBDA_DIR, module=module, event_path=event_path)
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+
+    # what the handler module imports directly, i.e. one level of indentation
+    imports = {}
+    for line in completed.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match and len(match.group(3)) == 2:
+            imports[match.group(4)] = int(match.group(2)) / 1e6
+    return json.loads(completed.stdout.strip().splitlines()[-1]), imports
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("modules", nargs="*", help="default: every handler module")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--event", action="append", default=[], help="module=path")
+    args = parser.parse_args()
+    events = dict(e.split("=", 1) for e in args.event)
+
+    for module in args.modules or handler_modules():
+        samples = {"init": [], "cold": [], "warm": []}
+        imports = {}
+        try:
+            for _ in range(args.runs):
+                result, imports = run_once(module, events.get(module))
+                for name, value in result.items():
+                    samples[name].append(value)
+        except RuntimeError as error:
+            print(f"{module}: failed ({error})")
+            continue
+
+        summary = ", ".join(
+            f"{name} p50 {statistics.median(values) * 1000:.0f}ms"
+            f" p99 {percentile(values, 0.99) * 1000:.0f}ms"
+            for name, values in samples.items()
+            if values
+        )
+        print(f"{module}: {summary}")
+        heaviest = sorted(imports.items(), key=lambda kv: -kv[1])[: args.top]
+        for name, seconds in heaviest:
+            print(f"    {seconds * 1000:8.1f}ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
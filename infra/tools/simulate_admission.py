@@ -0,0 +1,250 @@
+"""Simulates mixed user populations against the SD backend with and without admission control.
+
+A discrete-event simulation of users who send generate and edge requests,
+wait for the answer and think for a while before the next one. Heavy users
+run several clients back to back. Each SD backend renders one request at a
+time in arrival order; a request whose answer takes longer than the client
+timeout fails, though the GPU still renders it. With --mode fair the requests
+go through FairShareScheduler (lambda/logic_admission.py) as in generate and
+edge: they wait for a slot up to the admission max wait, or are rejected with
+a retry-after that the client honours. Prints tail latency, timeouts,
+rejections and the share of GPU time per user class.
+
+    python tools/simulate_admission.py
+    python tools/simulate_admission.py --free 20 --heavy 3 --backends 2 --mode fair
+"""
+
+import argparse
+import heapq
+import itertools
+import math
+import os
+import random
+import sys
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+)
+os.environ.setdefault("PLAN_NAME_FREE", "free")
+os.environ.setdefault("PLAN_NAME_STANDARD", "standard")
+
+from logic_admission import COSTS, FairShareScheduler  # noqa: E402
+
+MODES = ("none", "fair")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Simulation:
+    def __init__(self, args, mode: str):
+        self.args = args
+        self.mode = mode
+        self.rng = random.Random(args.seed)
+        self.now = 0.0
+        self.events = []
+        self.seq = itertools.count()
+        self.busy_until = [0.0] * args.backends
+        self.queued = [0] * args.backends
+        self.scheduler = FairShareScheduler(
+            args.slots_per_backend * args.backends,
+            lease_ttl=math.inf,
+            ticket_ttl=math.inf,  # waiters are re-polled on every release
+        )
+        self.state = FairShareScheduler.new_state()
+        self.pending = {}  # ticket id -> request
+        self.results = []  # (user class, outcome, latency)
+        self.gpu_time = {}  # user class -> sec
+
+    def at(self, t: float, func, *args):
+        heapq.heappush(self.events, (t, next(self.seq), func, args))
+
+    def run(self, users: list) -> list:
+        for user in users:
+            for _ in range(user["clients"]):
+                self.at(self.rng.uniform(0, self.args.think), self.issue, user)
+        while self.events:
+            t, _, func, args = heapq.heappop(self.events)
+            if t > self.args.duration:
+                break
+            self.now = t
+            func(*args)
+        return self.results
+
+    def issue(self, user: dict, retry_of: dict = None):
+        # a retry after a rejection is the same task, with the same start
+        if retry_of is None:
+            kind = "edge" if self.rng.random() < self.args.edge_ratio else "generate"
+            task_start = self.now
+        else:
+            kind, task_start = retry_of["kind"], retry_of["taskStart"]
+        request = {
+            "id": next(self.seq),
+            "user": user,
+            "kind": kind,
+            "taskStart": task_start,
+            "deadline": self.now + self.args.max_wait,
+        }
+        if self.mode == "none":
+            self.dispatch(request)
+            return
+        ticket_id = str(request["id"])
+        granted, wait = self.scheduler.try_acquire(
+            self.state,
+            ticket_id,
+            user["name"],
+            user["plan"],
+            kind,
+            self.now,
+        )
+        if granted:
+            self.dispatch(request)
+        elif self.now + wait > request["deadline"]:
+            self.reject(request, wait)
+        else:
+            self.pending[ticket_id] = request
+            self.at(request["deadline"], self.expire, ticket_id)
+
+    def reject(self, request: dict, wait: float):
+        self.scheduler.withdraw(self.state, str(request["id"]))
+        self.results.append((request["user"]["class"], "rejected", None))
+        # the client comes back after Retry-After
+        retry_at = self.now + max(math.ceil(wait), 1)
+        self.at(retry_at, self.issue, request["user"], request)
+        self.poll()
+
+    def expire(self, ticket_id: str):
+        request = self.pending.pop(ticket_id, None)
+        if request is not None:
+            self.reject(request, self.args.max_wait)
+
+    def poll(self):
+        # the waiting requests retry in turn until no one gets a slot
+        granted_any = True
+        while granted_any and self.pending:
+            granted_any = False
+            for ticket_id in self.scheduler._queue(self.state):
+                request = self.pending.get(ticket_id)
+                if request is None:
+                    continue
+                granted, _ = self.scheduler.try_acquire(
+                    self.state,
+                    ticket_id,
+                    request["user"]["name"],
+                    request["user"]["plan"],
+                    request["kind"],
+                    self.now,
+                )
+                if granted:
+                    del self.pending[ticket_id]
+                    self.dispatch(request)
+                    granted_any = True
+                    break
+
+    def dispatch(self, request: dict):
+        # the pool sends it to the backend with the fewest requests queued
+        backend = min(range(self.args.backends), key=lambda b: self.queued[b])
+        mean = COSTS[request["kind"]] * self.args.gpu_speed
+        service = self.rng.lognormvariate(math.log(mean), 0.3)
+        start = max(self.now, self.busy_until[backend])
+        done = start + service
+        self.busy_until[backend] = done
+        self.queued[backend] += 1
+        cls = request["user"]["class"]
+        self.gpu_time[cls] = self.gpu_time.get(cls, 0.0) + service
+        self.at(done, self.gpu_done, backend)
+        timeout_at = self.now + self.args.timeout
+        if done > timeout_at:
+            # the Lambda gives up and releases its slot, the GPU carries on
+            self.at(timeout_at, self.respond, request, "timeout")
+        else:
+            self.at(done, self.respond, request, "ok")
+
+    def gpu_done(self, backend: int):
+        self.queued[backend] -= 1
+
+    def respond(self, request: dict, outcome: str):
+        # from the first attempt, including rejected ones, to the answer
+        latency = self.now - request["taskStart"]
+        self.results.append((request["user"]["class"], outcome, latency))
+        if self.mode != "none":
+            self.scheduler.release(self.state, str(request["id"]), self.now)
+            self.poll()
+        think = self.rng.expovariate(1 / request["user"]["think"])
+        self.at(self.now + think, self.issue, request["user"])
+
+
+def make_users(args) -> list:
+    users = []
+    for i in range(args.free):
+        users.append({"name": f"free{i}", "plan": "free", "class": "free"})
+    for i in range(args.standard):
+        users.append({"name": f"std{i}", "plan": "standard", "class": "standard"})
+    for user in users:
+        user.update(clients=1, think=args.think)
+    for i in range(args.heavy):
+        users.append(
+            {
+                "name": f"heavy{i}",
+                "plan": "free",
+                "class": "heavy (free)",
+                "clients": args.heavy_clients,
+                "think": 0.5,
+            }
+        )
+    return users
+
+
+def report(mode: str, results: list, gpu_time: dict, duration: float):
+    print(f"mode {mode}")
+    print(
+        f"    {'class':14}{'requests':>9}{'ok':>7}{'timeout':>9}{'rejected':>9}"
+        f"{'p50':>8}{'p95':>8}{'p99':>8}{'ok/min':>8}{'GPU':>6}"
+    )
+    total_gpu = sum(gpu_time.values()) or 1.0
+    for cls in ("free", "standard", "heavy (free)"):
+        rows = [r for r in results if r[0] == cls]
+        if not rows:
+            continue
+        ok = [latency for _, outcome, latency in rows if outcome == "ok"]
+        n_timeout = sum(outcome == "timeout" for _, outcome, _ in rows)
+        n_rejected = sum(outcome == "rejected" for _, outcome, _ in rows)
+        print(
+            f"    {cls:14}{len(rows):9d}{len(ok):7d}{n_timeout:9d}{n_rejected:9d}"
+            f"{percentile(ok, 0.5):8.1f}{percentile(ok, 0.95):8.1f}"
+            f"{percentile(ok, 0.99):8.1f}{len(ok) / duration * 60:8.2f}"
+            f"{gpu_time.get(cls, 0.0) / total_gpu:6.0%}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=MODES, help="default: both")
+    parser.add_argument("--free", type=int, default=10, help="free users")
+    parser.add_argument("--standard", type=int, default=4, help="standard users")
+    parser.add_argument("--heavy", type=int, default=2, help="heavy free users")
+    parser.add_argument("--heavy-clients", type=int, default=3, help="per heavy user")
+    parser.add_argument("--think", type=float, default=30, help="mean sec")
+    parser.add_argument("--edge-ratio", type=float, default=0.2)
+    parser.add_argument("--backends", type=int, default=1)
+    parser.add_argument("--slots-per-backend", type=int, default=2)
+    parser.add_argument("--gpu-speed", type=float, default=0.75, help="x the cost")
+    parser.add_argument("--timeout", type=float, default=30, help="sec")
+    parser.add_argument("--max-wait", type=float, default=8, help="admission, sec")
+    parser.add_argument("--duration", type=float, default=3600, help="sec")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    users = make_users(args)
+    for mode in [args.mode] if args.mode else MODES:
+        simulation = Simulation(args, mode)
+        results = simulation.run(users)
+        report(mode, results, simulation.gpu_time, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Replays a request trace through the GPU server scaling policy.
+
+Compares the predictive policy of shutdown_server with the plain idle timeout
+it replaces, on GPU hours and cost and on the cold start wait of requests
+that found the server stopped or booting. A request to a stopped server
+starts it, as a user pressing start would. The trace is a text file of
+request times, one per line as epoch sec or ISO 8601, e.g. exported from the
+access logs. Without one a synthetic daily pattern is generated.
+
+    python tools/simulate_scaling.py --trace requests.txt
+    python tools/simulate_scaling.py --synthetic 42 --boot-time 240
+"""
+
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda")
+)
+
+from logic_scaling_policy import (  # noqa: E402
+    DAY,
+    START,
+    STOP,
+    ArrivalStats,
+    ScalingPolicy,
+)
+
+
+def load_trace(path: str) -> list:
+    times = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                times.append(float(line))
+            except ValueError:
+                ts = datetime.fromisoformat(line.replace("Z", "+00:00"))
+                if ts.tzinfo is None:
+                    ts = ts.replace(tzinfo=timezone.utc)
+                times.append(ts.timestamp())
+    return sorted(times)
+
+
+def synthetic_trace(days: int, seed: int = 0) -> list:
+    # sessions of a few requests, mostly in the (JST) evening, fewer on weekdays
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    times = []
+    for day in range(days):
+        n_sessions = rng.randint(2, 6) if day % 7 < 5 else rng.randint(5, 10)
+        for _ in range(n_sessions):
+            hour = rng.gauss(12, 2.5) % 24  # 21:00 JST
+            t = start + day * DAY + hour * 3600
+            for _ in range(rng.randint(1, 15)):
+                times.append(t)
+                t += rng.expovariate(1 / 90)
+    return sorted(times)
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def simulate(
+    trace: list,
+    policy: ScalingPolicy,
+    predictive: bool,
+    check_interval: float,
+    history_days: int,
+    warmup: float,
+) -> dict:
+    report_from = trace[0] + warmup
+    counts = OrderedDict()  # minute -> requests, the history the policy sees
+    ready_at = None  # None while stopped
+    started_at = None
+    last_called = None
+    gpu_time = 0.0
+    waits = []
+
+    def stop(t: float):
+        nonlocal ready_at, gpu_time
+        if started_at >= report_from:
+            gpu_time += t - started_at
+        elif t > report_from:
+            gpu_time += t - report_from
+        ready_at = None
+
+    i = 0
+    now = math.floor(trace[0] / check_interval) * check_interval
+    end = trace[-1] + policy.max_idle + check_interval
+    while now < end:
+        # requests up to this check
+        while i < len(trace) and trace[i] < now:
+            t = trace[i]
+            if ready_at is None:
+                ready_at, started_at = t + policy.boot_time, t
+            if t >= report_from:
+                waits.append(max(ready_at - t, 0.0))
+            last_called = t
+            minute = int(t // 60 * 60)
+            counts[minute] = counts.get(minute, 0) + 1
+            i += 1
+        while counts and next(iter(counts)) < now - history_days * DAY:
+            counts.popitem(last=False)
+
+        running = ready_at is not None
+        if predictive:
+            stats = ArrivalStats(counts, now, history_days=history_days)
+        else:
+            stats = ArrivalStats({}, now, history_days=history_days)
+        last_active = max(last_called or 0, started_at or 0) if running else None
+        decision = policy.decide(now, running, last_active, stats)
+        if decision == STOP:
+            stop(now)
+        elif decision == START and predictive:
+            ready_at, started_at = now + policy.boot_time, now
+        now += check_interval
+    if ready_at is not None:
+        stop(now)
+
+    gpu_hours = gpu_time / 3600
+    cold = [w for w in waits if w > 0]
+    gpu_cost = gpu_hours * policy.gpu_cost * 3600
+    wait_cost = sum(waits) * policy.wait_cost
+    return {
+        "requests": len(waits),
+        "gpu hours": gpu_hours,
+        "gpu cost": gpu_cost,
+        "cold requests": len(cold),
+        "mean cold wait": statistics.mean(cold) if cold else 0.0,
+        "p95 wait": percentile(waits, 0.95),
+        "p99 wait": percentile(waits, 0.99),
+        "wait cost": wait_cost,
+        "total cost": gpu_cost + wait_cost,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trace", help="file of request times")
+    parser.add_argument("--synthetic", type=int, default=42, help="days")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--boot-time", type=float, default=300, help="sec")
+    parser.add_argument("--gpu-cost", type=float, default=0.71, help="per hour")
+    parser.add_argument("--wait-cost", type=float, default=20, help="per hour")
+    parser.add_argument("--idle", type=float, default=2400, help="idle timeout, sec")
+    parser.add_argument("--min-idle", type=float, default=600, help="sec")
+    parser.add_argument("--check-interval", type=float, default=300, help="sec")
+    parser.add_argument("--history-days", type=int, default=28)
+    parser.add_argument("--warmup-days", type=float, default=14)
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = load_trace(args.trace)
+    else:
+        trace = synthetic_trace(args.synthetic, args.seed)
+    days = (trace[-1] - trace[0]) / DAY
+    print(f"{len(trace)} requests over {days:.1f} days")
+
+    policy = ScalingPolicy(
+        boot_time=args.boot_time,
+        gpu_cost_per_hour=args.gpu_cost,
+        wait_cost_per_hour=args.wait_cost,
+        min_idle=args.min_idle,
+        max_idle=args.idle,
+    )
+    # the idle timeout alone is the policy with min_idle at the timeout
+    baseline = ScalingPolicy(
+        boot_time=args.boot_time,
+        gpu_cost_per_hour=args.gpu_cost,
+        wait_cost_per_hour=args.wait_cost,
+        min_idle=args.idle,
+        max_idle=args.idle,
+    )
+    # the predictive policy only knows the daily pattern after some history
+    warmup = args.warmup_days * DAY if days > args.warmup_days else 0
+    if warmup:
+        print(f"reporting after the first {args.warmup_days:g} days")
+    results = {
+        name: simulate(
+            trace, p, predictive, args.check_interval, args.history_days, warmup
+        )
+        for name, p, predictive in (
+            ("idle timeout", baseline, False),
+            ("predictive", policy, True),
+        )
+    }
+
+    names = list(results["predictive"])
+    print(f"{'':16}" + "".join(f"{name:>16}" for name in results))
+    for name in names:
+        row = "".join(f"{r[name]:16.2f}" for r in results.values())
+        print(f"{name:16}{row}")
+
+
+if __name__ == "__main__":
+    main()
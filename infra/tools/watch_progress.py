@@ -0,0 +1,133 @@
+"""Follows an async generate job through job_status against a fake SD server.
+
+Submits a render with asyncMode to generate.lambda_handler, runs it with
+generate_worker in a background thread and polls job_status.lambda_handler as
+the frontend does, printing every change of status, step and preview. Shows
+how soon a user sees something compared to the final image. AWS is mocked
+with moto.
+
+    python tools/watch_progress.py --sd-delay 6 --steps 30
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import threading
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TOOLS_DIR, "..", "lambda"), TOOLS_DIR]
+
+from bench_handlers import ENVIRONMENT, auth_token, create_table, seed_users  # noqa
+from fake_sd_server import FakeSDServer, make_png  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sd-delay", type=float, default=6, help="sec per image")
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="sec")
+    args = parser.parse_args()
+
+    os.environ.update(ENVIRONMENT, WORK_BUCKET_NAME="work", PROGRESS_INTERVAL="0.5")
+    server = FakeSDServer(delay=args.sd_delay).start()
+    os.environ["SD_SERVER_URL"] = server.url
+
+    from moto import mock_aws
+
+    with mock_aws():
+        import boto3
+
+        create_table()
+        seed_users(1, 100)
+        boto3.client("s3").create_bucket(
+            Bucket="work",
+            CreateBucketConfiguration={"LocationConstraint": "ap-northeast-1"},
+        )
+        queue_url = boto3.client("sqs").create_queue(QueueName="jobs")["QueueUrl"]
+        os.environ["JOB_QUEUE_URL"] = queue_url
+
+        import generate
+        import generate_worker
+        import job_status
+        from logic_job_queue import SqsJobQueue
+
+        image = "data:image/png;base64," + make_png(512, 512)
+        body = {
+            "sampler": "DPM++ 2M Karras",
+            "steps": args.steps,
+            "seed": -1,
+            "width": 512,
+            "height": 512,
+            "maskBlur": 4,
+            "cfgScale": 7,
+            "denosing": 0.6,
+            "initialNoiseMultiplier": 1.0,
+            "controlMode": 0,
+            "controlWeight": 1.0,
+            "referenceControlMode": 0,
+            "referenceControlWeight": 1.0,
+            "inpaintingFill": 1,
+            "imageData": image,
+            "maskData": image,
+            "edgeData": "",
+            "positivePrompt": "1girl",
+            "negativePrompt": "",
+            "useEdge": False,
+            "useReference": False,
+            "useAnotherImageForReference": False,
+            "antiGlareFilterFlag": 0,
+            "antiGlareFilterSigmaS": 0,
+            "antiGlareFilterSigmaR": 0,
+            "asyncMode": True,
+        }
+        headers = {"authorization": auth_token("user0")}
+        start = time.perf_counter()
+        response = generate.lambda_handler(
+            {"headers": headers, "body": json.dumps(body)}, None
+        )
+        job_id = json.loads(response["body"])["jobId"]
+
+        job_queue = SqsJobQueue()
+        job = job_queue.get("user0", job_id)
+        worker = threading.Thread(target=generate_worker.run_job, args=(job_queue, job))
+        worker.start()
+
+        seen = {"previewStep": None}
+        first = {}
+        while True:
+            params = {"jobId": job_id}
+            if seen["previewStep"] is not None:
+                params["previewStep"] = str(seen["previewStep"])
+            event = {"headers": headers, "queryStringParameters": params}
+            status = json.loads(job_status.lambda_handler(event, None)["body"])
+            elapsed = time.perf_counter() - start
+            line = f"{elapsed:6.2f}s {status['status']:9}"
+            if "step" in status:
+                line += f" step {status['step']}/{status['steps']}"
+                first.setdefault("progress", elapsed)
+            if "preview" in status:
+                size = len(base64.b64decode(status["preview"]))
+                line += f" preview {size}B"
+                seen["previewStep"] = status["previewStep"]
+                first.setdefault("preview", elapsed)
+            print(line)
+            if status["status"] in ("SUCCEEDED", "FAILED"):
+                first["final"] = elapsed
+                break
+            time.sleep(args.poll_interval)
+        worker.join()
+
+    server.stop()
+    print(
+        "first progress {progress:.2f}s, first preview {preview:.2f}s,"
+        " final image {final:.2f}s".format(
+            **{k: first.get(k, float("nan")) for k in ("progress", "preview", "final")}
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -33,12 +33,59 @@ export const getUserUsernameJson =
     return await response.json();
   };
 
+// imageData, maskData, edgeData and referenceImageData of generate take either
+// a data URL or the handle of an image uploaded before, see postRenderImageJson
+export const imageHandleReference = (handle: string) => `handle:${handle}`;
+
+// maskData may also be a binary mask in a few bytes instead of a PNG. Inside
+// bbox ([top, bottom, left, right], default the whole mask), row-major, "rle"
+// holds the lengths of alternating unset/set runs as base64 LEB128 varints,
+// starting with unset, and "bits" one bit per pixel, MSB first.
+export type CompactMaskData = {
+  format: "rle" | "bits";
+  width: number;
+  height: number;
+  bbox?: [number, number, number, number];
+  data: string;
+};
+
+export type PostRenderImageResponseJson = {
+  handle: string;
+};
+
+export const postRenderImageJson = async (
+  body: string,
+  abortSignal?: AbortSignal
+): Promise<PostRenderImageResponseJson> => {
+  const response = await fetch(
+    `${process.env.REACT_APP_API_ENDPOINT}/render/images`,
+    {
+      method: "post",
+      body: body,
+      headers: await getHeaders(),
+      signal: abortSignal,
+    }
+  );
+  checkResponse(response);
+  return await response.json();
+};
+
 export type PostRenderEdgeBodyData = string;
 
+export type PostRenderEdgeResponseJson = {
+  image: string;
+  imageHandle: string;
+  edgeHandle: string;
+  taggingResult: {
+    caption: { tag: Record<string, number>; rating: Record<string, number> };
+  };
+  remainingCredit: number;
+};
+
 export const postRenderEdgeJson = async (
   body: PostRenderEdgeBodyData,
   abortSignal?: AbortSignal
-) => {
+): Promise<PostRenderEdgeResponseJson> => {
   const response = await fetch(
     `${process.env.REACT_APP_API_ENDPOINT}/render/edge`,
     {
@@ -73,12 +120,36 @@ export type PostRenderGenerateBodyData = {
   antiGlareFilterSigmaS: number;
   antiGlareFilterSigmaR: number;
   imageData: string;
-  maskData: string;
+  maskData: string | CompactMaskData;
   edgeData: string;
   useEdge: boolean;
   useReference: boolean;
   useAnotherImageForReference: boolean;
   referenceImageData: string;
+  asyncMode?: boolean;
+  // several variants in one call, charged together; with asyncMode when it
+  // has more than 4 variants, the job's result then has variants, not image
+  sweep?: {
+    seeds?: number[];
+    count?: number; // random consecutive seeds, when seeds is not given
+    denosing?: number[];
+    cfgScale?: number[];
+  };
+  // the masked part at full resolution in overlapping tiles, charged per tile;
+  // not with sweep, and with asyncMode when it needs more than 2 tiles
+  tiled?: boolean;
+};
+
+export type PostRenderGenerateSweepResponseJson = {
+  variants: {
+    seed: number;
+    denosing: number;
+    cfgScale: number;
+    image: string | null; // null when its img2img call failed
+  }[];
+  remainingCredit: number;
+  queueWait: number;
+  errors?: { [seed: string]: string };
 };
 
 export const postRenderGenerateJson = async (
@@ -98,6 +169,47 @@ export const postRenderGenerateJson = async (
   return await response.json();
 };
 
+export type GetRenderJobResponseJson = {
+  jobId: string;
+  status: "QUEUED" | "RUNNING" | "SUCCEEDED" | "FAILED";
+  queueDepth: number;
+  waitTime: number | null;
+  runTime: number | null;
+  // while RUNNING
+  progress?: number;
+  etaRelative?: number;
+  step?: number;
+  steps?: number;
+  previewStep?: number;
+  preview?: string; // omitted when previewStep equals the one passed in
+  error?: string;
+  image?: string;
+  variants?: PostRenderGenerateSweepResponseJson["variants"]; // of a sweep
+  errors?: { [seed: string]: string };
+  remainingCredit?: number;
+};
+
+export const getRenderJobJson = async (
+  jobId: string,
+  abortSignal?: AbortSignal,
+  previewStep?: number
+): Promise<GetRenderJobResponseJson> => {
+  const params = new URLSearchParams({ jobId });
+  if (previewStep !== undefined) {
+    params.set("previewStep", String(previewStep));
+  }
+  const response = await fetch(
+    `${process.env.REACT_APP_API_ENDPOINT}/render/jobs?${params}`,
+    {
+      method: "get",
+      headers: await getHeaders(),
+      signal: abortSignal,
+    }
+  );
+  checkResponse(response);
+  return await response.json();
+};
+
 export const getSdServiceInfraStatusJson = async () => {
   const response = await fetch(
     `${process.env.REACT_APP_API_ENDPOINT}/sd-service/infra/status`,
@@ -792,7 +792,10 @@ export class AiStore {
     this.lastGenerationParams = {
       ...body,
       imageData: body.imageData.substring(0, 10) + " (trimmed)",
-      maskData: body.maskData.substring(0, 10) + " (trimmed)",
+      maskData:
+        typeof body.maskData === "string"
+          ? body.maskData.substring(0, 10) + " (trimmed)"
+          : body.maskData,
       edgeData: body.edgeData
         ? body.edgeData.substring(0, 10) + " (trimmed)"
         : "",